@@ -0,0 +1,318 @@
+"""
+Admission control for the AI endpoints.
+
+Every request to an endpoint that may call the model passes two checks
+whose state lives in a SQLite file shared by all gunicorn workers on the
+host:
+- a token bucket per client, keyed on the "sub" of the JWT issued by
+  /login when the request carries a valid one and on the client address
+  otherwise. Behind a proxy the address is only the client's when app.py
+  trusts X-Forwarded-For (TRUSTED_PROXY_COUNT); otherwise every client
+  shares the proxy's bucket. A client that has used up its burst gets 429
+  Too Many Requests;
+- a cap on the requests in flight to the model across all workers. A
+  request that finds every slot taken waits in a bounded queue. It gets 503
+  Service Unavailable when the queue is already AI_MAX_QUEUE deep or no
+  slot frees up within AI_QUEUE_TIMEOUT seconds.
+Both rejections carry Retry-After. Requests queued as background jobs are
+rate limited but do not take a slot, as the job queue bounds its own work.
+The batch valuation endpoint is admitted per listing through admitted():
+each listing spends a token and holds a slot while it is valued, and a
+listing that is turned away gets an error entry in the batch's results.
+
+A slot is held until the response is ready, or until a streamed response
+has been sent, and expires after AI_SLOT_TTL seconds in case its worker
+dies. If the state
+file cannot be used, requests are let through rather than failed.
+"""
+import contextlib
+import functools
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional, Tuple
+
+from flask import jsonify, make_response, request
+
+ENABLED = os.getenv("AI_ADMISSION_ENABLED", "1") == "1"
+STATE_PATH = os.getenv("AI_ADMISSION_PATH", os.path.join("cache", "admission.sqlite3"))
+# Sustained requests per minute and burst size of each client's bucket
+RATE_PER_MINUTE = float(os.getenv("AI_RATE_LIMIT_PER_MINUTE", 30))
+BURST = float(os.getenv("AI_RATE_LIMIT_BURST", 10))
+# Requests in flight to the model across all workers, and how many may wait for one of them
+MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", 16))
+MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", 32))
+QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", 10))
+SLOT_TTL = float(os.getenv("AI_SLOT_TTL", 300))
+# Seconds a shed request is asked to wait before retrying
+SHED_RETRY_AFTER = int(os.getenv("AI_SHED_RETRY_AFTER", 5))
+POLL_INTERVAL = 0.05
+
+# Callables notified of every admission decision, e.g. to record metrics
+_observers: List[Callable] = []
+
+
+class Overloaded(Exception):
+    """Raised when no model slot is available; retry_after is in seconds."""
+
+    def __init__(self, message: str, retry_after: int = SHED_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimited(Overloaded):
+    """Raised when the client has used up its tokens."""
+
+
+def add_admission_observer(observer: Callable) -> None:
+    """
+    Register observer(outcome) to be called for every request checked, with
+    outcome "admitted", "rate_limited", "queue_full" or "queue_timeout".
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def _notify(outcome: str) -> None:
+    for observer in _observers:
+        try:
+            observer(outcome)
+        except Exception as e:
+            print(f"Admission observer failed: {str(e)}")
+
+
+class AdmissionController:
+    def __init__(self, path: str = STATE_PATH, rate_per_minute: float = RATE_PER_MINUTE, burst: float = BURST,
+                 max_concurrent: int = MAX_CONCURRENT, max_queue: int = MAX_QUEUE,
+                 queue_timeout: float = QUEUE_TIMEOUT):
+        self.path = path
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS admission_buckets ("
+                "client TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            # state is "running" for a held slot and "waiting" for a queued request
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS admission_slots ("
+                "id TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write is atomic across workers
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def take_token(self, client: str) -> Tuple[bool, int]:
+        """Spend one of client's tokens. Returns (allowed, seconds until a token is available)."""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM admission_buckets WHERE client = ?", (client,)
+            ).fetchone()
+            tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO admission_buckets (client, tokens, updated_at) VALUES (?, ?, ?)",
+                (client, tokens, now),
+            )
+            if random.random() < 0.01:
+                # Buckets that have refilled completely carry no state worth keeping
+                conn.execute("DELETE FROM admission_buckets WHERE updated_at < ?", (now - self.burst / self.rate,))
+        return allowed, 0 if allowed else max(1, math.ceil((1 - tokens) / self.rate))
+
+    def acquire(self) -> str:
+        """Take a model slot, waiting in the queue if needed; raises Overloaded. Returns the slot id."""
+        slot = uuid.uuid4().hex
+        deadline = time.monotonic() + self.queue_timeout
+        queued = False
+        try:
+            while True:
+                with self._transaction() as conn:
+                    now = time.time()
+                    conn.execute("DELETE FROM admission_slots WHERE expires_at < ?", (now,))
+                    counts = dict(conn.execute(
+                        "SELECT state, COUNT(*) FROM admission_slots WHERE id != ? GROUP BY state", (slot,)
+                    ).fetchall())
+                    running, waiting = counts.get("running", 0), counts.get("waiting", 0)
+                    # Newcomers do not overtake requests that are already queued
+                    if running < self.max_concurrent and (queued or waiting == 0):
+                        conn.execute(
+                            "INSERT OR REPLACE INTO admission_slots (id, state, expires_at) VALUES (?, 'running', ?)",
+                            (slot, now + SLOT_TTL),
+                        )
+                        queued = False
+                        return slot
+                    if not queued:
+                        if waiting >= self.max_queue:
+                            _notify("queue_full")
+                            raise Overloaded("The AI service is overloaded, try again shortly")
+                        conn.execute(
+                            "INSERT INTO admission_slots (id, state, expires_at) VALUES (?, 'waiting', ?)",
+                            (slot, now + self.queue_timeout + 5),
+                        )
+                        queued = True
+                if time.monotonic() >= deadline:
+                    _notify("queue_timeout")
+                    raise Overloaded("Timed out waiting for the AI service, try again shortly")
+                time.sleep(POLL_INTERVAL)
+        finally:
+            if queued:
+                self.release(slot)
+
+    def release(self, slot: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM admission_slots WHERE id = ?", (slot,))
+
+    def stats(self) -> dict:
+        with contextlib.closing(self._connect()) as conn:
+            counts = dict(conn.execute(
+                "SELECT state, COUNT(*) FROM admission_slots WHERE expires_at >= ? GROUP BY state", (time.time(),)
+            ).fetchall())
+            (clients,) = conn.execute("SELECT COUNT(*) FROM admission_buckets").fetchone()
+        return {
+            "running": counts.get("running", 0),
+            "waiting": counts.get("waiting", 0),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "rate_per_minute": self.rate * 60,
+            "burst": self.burst,
+            "tracked_clients": clients,
+        }
+
+
+_controller = None
+_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        with _lock:
+            if _controller is None:
+                _controller = AdmissionController()
+    return _controller
+
+
+def client_key() -> str:
+    """The JWT subject of the request when it carries a valid token, otherwise its address."""
+    auth = request.headers.get("Authorization", "")
+    if auth.lower().startswith("bearer "):
+        import jwt
+
+        try:
+            claims = jwt.decode(auth[7:].strip(), os.getenv("JWT_KEY"), algorithms=["HS256"])
+            if claims.get("sub"):
+                return f"user:{claims['sub']}"
+        except (jwt.PyJWTError, TypeError, ValueError):
+            pass
+    return f"ip:{request.remote_addr}"
+
+
+def _reject(status: int, message: str, retry_after: int):
+    return jsonify({"error": message}), status, {"Retry-After": str(retry_after)}
+
+
+def _admit(client: str, take_slot: bool = True) -> Optional[str]:
+    """Spend one of client's tokens and take a model slot; raises RateLimited or Overloaded. Returns the slot id."""
+    try:
+        controller = get_controller()
+        allowed, retry_after = controller.take_token(client)
+        if not allowed:
+            _notify("rate_limited")
+            raise RateLimited("Too many AI requests, try again later", retry_after)
+        slot = controller.acquire() if take_slot else None
+    except sqlite3.Error as e:
+        print(f"Admission control unavailable, admitting request: {str(e)}")
+        slot = None
+    _notify("admitted")
+    return slot
+
+
+@contextlib.contextmanager
+def admitted(client: str):
+    """
+    Admit one unit of work for client outside the request that carried it,
+    such as one listing of a batch, holding a model slot until it is done.
+    Raises RateLimited or Overloaded.
+    """
+    slot = _admit(client) if ENABLED else None
+    try:
+        yield
+    finally:
+        if slot is not None:
+            _release(slot)
+
+
+def admission_controlled(view):
+    """Rate limit a view per client and hold a model slot while it runs, see the module docstring."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return view(*args, **kwargs)
+        try:
+            slot = _admit(client_key(), take_slot=request.args.get("background", "false").lower() != "true")
+        except RateLimited as e:
+            return _reject(429, str(e), e.retry_after)
+        except Overloaded as e:
+            return _reject(503, str(e), e.retry_after)
+        if slot is None:
+            return view(*args, **kwargs)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            _release(slot)
+            raise
+        if response.is_streamed:
+            # The model is still producing the body, so the slot is held until it has been sent
+            response.call_on_close(lambda: _release(slot))
+        else:
+            _release(slot)
+        return response
+    return wrapper
+
+
+def _release(slot: str) -> None:
+    try:
+        get_controller().release(slot)
+    except sqlite3.Error as e:
+        print(f"Could not release AI slot, it expires after {SLOT_TTL:.0f}s: {str(e)}")
+
+
+def admission_stats() -> dict:
+    return get_controller().stats() if ENABLED else {"enabled": False}
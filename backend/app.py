@@ -1,9 +1,31 @@
+import time
+_import_started = time.perf_counter()
+
+from dotenv import load_dotenv
+# Load .env once, before any module reads its configuration
+load_dotenv()
+
+import os
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from routes import register_blueprints
+import metrics
+import compression
 
 app = Flask(__name__)
+metrics.init_app(app)
+compression.init_app(app)
 register_blueprints(app)
 
+# Behind a reverse proxy (CapRover's nginx in production) the client's address
+# is in X-Forwarded-For; trust it from this many proxies, e.g. for rate limits
+trusted_proxies = int(os.getenv("TRUSTED_PROXY_COUNT", 0))
+if trusted_proxies:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies)
+
+# Clients are created lazily, so importing the app does no network or credential work
+metrics.record_startup("import", time.perf_counter() - _import_started)
+
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True) # allow the server and client running on different machine
@@ -0,0 +1,93 @@
+"""
+Chunked Firestore batched writes for the bulk endpoints.
+
+A bulk request is split into WriteBatch commits of at most BATCH_LIMIT
+writes, so N items cost ceil(N / 500) round trips instead of N. Each
+batch is atomic, so an update to a missing document would reject every
+write in its chunk; when that happens the chunk's targets are checked with
+one get_all and the writes to existing documents are committed again.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+# Firestore allows at most 500 writes per batch
+BATCH_LIMIT = 500
+# Items accepted by one bulk request
+MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000))
+
+# (reference, "set" or "update", data)
+Write = Tuple[object, str, Dict]
+
+
+def parse_items(data, key: str):
+    """
+    The list of items under key in a bulk request body. Returns (items, None)
+    or (None, error message).
+    """
+    items = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, f"'{key}' must be a non-empty list"
+    if len(items) > MAX_ITEMS:
+        return None, f"At most {MAX_ITEMS} items per request"
+    return items, None
+
+
+def _commit(db, writes: List[Write]) -> None:
+    import doc_cache
+
+    batch = db.batch()
+    for ref, operation, data in writes:
+        if operation == "set":
+            batch.set(ref, data)
+        else:
+            batch.update(ref, data)
+    try:
+        batch.commit()
+    finally:
+        doc_cache.invalidate(*(ref for ref, _, _ in writes))
+
+
+def _commit_chunk(db, writes: List[Write]) -> List[Optional[Dict]]:
+    from google.api_core.exceptions import NotFound
+
+    try:
+        _commit(db, writes)
+        return [None] * len(writes)
+    except NotFound:
+        pass
+    except Exception as e:
+        return [{"status": 500, "error": str(e)}] * len(writes)
+
+    # Some update targets do not exist; fail only those writes
+    refs = {ref.path: ref for ref, operation, _ in writes if operation == "update"}
+    existing = {snapshot.reference.path for snapshot in db.get_all(list(refs.values())) if snapshot.exists}
+    created = {ref.path for ref, operation, _ in writes if operation == "set"}
+    errors = [
+        {"status": 404, "error": f"Document {ref.id} not found"}
+        if operation == "update" and ref.path not in existing and ref.path not in created else None
+        for ref, operation, _ in writes
+    ]
+    retry = [write for write, error in zip(writes, errors) if error is None]
+    if retry:
+        try:
+            _commit(db, retry)
+        except Exception as e:
+            errors = [error or {"status": 500, "error": str(e)} for error in errors]
+    return errors
+
+
+def commit_in_chunks(db, writes: List[Write]) -> List[Optional[Dict]]:
+    """
+    Commit writes in order, BATCH_LIMIT at a time. Returns one entry per
+    write: None if it was applied, otherwise {"status", "error"}.
+    """
+    errors = []
+    for start in range(0, len(writes), BATCH_LIMIT):
+        errors.extend(_commit_chunk(db, writes[start:start + BATCH_LIMIT]))
+    return errors
+
+
+def summarize(results: List[Dict]) -> Dict:
+    """The response body of a bulk request from its per-item results."""
+    succeeded = sum(1 for result in results if result["status"] < 400)
+    return {"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}
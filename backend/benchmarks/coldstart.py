@@ -0,0 +1,68 @@
+"""
+Measure worker cold-start time.
+
+Each trial starts a fresh interpreter and times three phases:
+  import       - `import app`, which should do no network or credential work
+  warmup       - creating the Firestore/OpenAI/Stripe clients and calibrating
+                 bcrypt (run against the benchmark fakes, so only local cost is measured)
+  first_request - the first GET /api/products served by the new process
+
+Run from the backend directory:
+    python -m benchmarks.coldstart --trials 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+TRIAL = r"""
+import json, os, time
+timings = {}
+started = time.perf_counter()
+import app as app_module
+timings["import"] = time.perf_counter() - started
+
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.stubs import StubOpenAI
+import db_config
+from services import openai_client
+fake_db = FakeFirestore()
+db_config.get_db = lambda: fake_db
+openai_client._build_client = lambda api_key: StubOpenAI(latency=0)
+
+from warmup import warm_up
+started = time.perf_counter()
+warm_up()
+timings["warmup"] = time.perf_counter() - started
+
+client = app_module.app.test_client()
+started = time.perf_counter()
+client.get("/api/products").get_data()
+timings["first_request"] = time.perf_counter() - started
+print("RESULT " + json.dumps(timings))
+"""
+
+
+def run_trial():
+    completed = subprocess.run([sys.executable, "-c", TRIAL], capture_output=True, text=True, check=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    raise RuntimeError(f"Trial produced no result:\n{completed.stdout}\n{completed.stderr}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=5)
+    args = parser.parse_args()
+
+    trials = [run_trial() for _ in range(args.trials)]
+    print(f"{'phase':<15} {'mean ms':>9} {'min ms':>9} {'max ms':>9}")
+    for phase in ("import", "warmup", "first_request"):
+        values = [trial[phase] * 1000 for trial in trials]
+        print(f"{phase:<15} {statistics.mean(values):>9.1f} {min(values):>9.1f} {max(values):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+"""
+In-memory stand-in for the Firestore client returned by db_config.get_db.
+
+Covers the parts of the client API the routes use: collections and
+subcollections, document get/set/update/delete, equality and range
+filters, ordering, projections, cursors, limits, batched reads and writes and
+the ArrayUnion / Increment / DELETE_FIELD transforms. Every call can be
+given an artificial latency to approximate network round trips.
+"""
+import copy
+import random
+import string
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import transforms
+
+_ID_CHARS = string.ascii_letters + string.digits
+
+
+def _auto_id():
+    return "".join(random.choices(_ID_CHARS, k=20))
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _type_rank(value):
+    # Firestore orders values of different types by type first
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, FakeDocumentReference):
+        return 5
+    return 6
+
+
+def _sort_key(value):
+    if isinstance(value, FakeDocumentReference):
+        return (_type_rank(value), value.path)
+    if isinstance(value, (dict, list)):
+        return (_type_rank(value), repr(value))
+    return (_type_rank(value), value)
+
+
+def _get_path(data, field_path):
+    value = data
+    for part in field_path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+
+def _to_stored(value):
+    # Firestore stores naive datetimes as UTC and always returns aware ones
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, dict):
+        return {key: _to_stored(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_stored(item) for item in value]
+    return copy.deepcopy(value)
+
+
+def _apply_update(data, field_path, value):
+    parts = field_path.split(".")
+    target = data
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    key = parts[-1]
+
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(target.get(key) or [])
+        for item in value.values:
+            if item not in current:
+                current.append(_to_stored(item))
+        target[key] = current
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [item for item in target.get(key) or [] if item not in value.values]
+    elif isinstance(value, transforms.Increment):
+        target[key] = (target.get(key) or 0) + value.value
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[key] = _now()
+    else:
+        target[key] = _to_stored(value)
+
+
+class _Store:
+    """Backing storage shared by every reference created from one client."""
+
+    def __init__(self, latency=0.0):
+        self.docs = {}
+        self.lock = threading.RLock()
+        self.latency = latency
+        self.calls = 0
+
+    def round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data, create_time=None, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = _now()
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            raise KeyError(field_path)
+        return copy.deepcopy(_get_path(self._data, field_path))
+
+
+class _Watch:
+    def unsubscribe(self):
+        pass
+
+
+class FakeDocumentReference:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollectionReference(self._store, f"{self.path}/{name}")
+
+    def _snapshot(self):
+        entry = self._store.docs.get(self.path)
+        if entry is None:
+            return FakeDocumentSnapshot(self, None)
+        data, create_time, update_time = entry
+        return FakeDocumentSnapshot(self, data, create_time, update_time)
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        self._store.round_trip()
+        with self._store.lock:
+            return self._snapshot()
+
+    def _set(self, data, merge=False):
+        now = _now()
+        entry = self._store.docs.get(self.path)
+        if merge and entry is not None:
+            current = entry[0]
+            for key, value in data.items():
+                _apply_update(current, key, value)
+            self._store.docs[self.path] = (current, entry[1], now)
+        else:
+            current = {}
+            for key, value in data.items():
+                _apply_update(current, key, value)
+            self._store.docs[self.path] = (current, entry[1] if entry else now, now)
+
+    def _update(self, field_updates):
+        entry = self._store.docs.get(self.path)
+        if entry is None:
+            raise NotFound(f"No document to update: {self.path}")
+        data = entry[0]
+        for field_path, value in field_updates.items():
+            _apply_update(data, field_path, value)
+        self._store.docs[self.path] = (data, entry[1], _now())
+
+    def _delete(self):
+        self._store.docs.pop(self.path, None)
+
+    def set(self, document_data, merge=False):
+        self._store.round_trip()
+        with self._store.lock:
+            self._set(document_data, merge)
+
+    def update(self, field_updates, option=None):
+        self._store.round_trip()
+        with self._store.lock:
+            self._update(field_updates)
+
+    def delete(self, option=None):
+        self._store.round_trip()
+        with self._store.lock:
+            self._delete()
+
+    def on_snapshot(self, callback):
+        return _Watch()
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class FakeQuery:
+    def __init__(self, store, path, filters=(), orders=(), projection=None,
+                 limit=None, start_after=None):
+        self._store = store
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._projection = projection
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters,
+            "orders": self._orders,
+            "projection": self._projection,
+            "limit": self._limit,
+            "start_after": self._start_after,
+        }
+        state.update(changes)
+        return FakeQuery(self._store, self._path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields):
+        if isinstance(document_fields, FakeDocumentSnapshot):
+            values = document_fields.to_dict()
+            values["__name__"] = document_fields.reference
+            document_fields = values
+        return self._copy(start_after=document_fields)
+
+    def _matches(self, ref, data):
+        for field_path, op, expected in self._filters:
+            try:
+                actual = ref if field_path == "__name__" else _get_path(data, field_path)
+            except KeyError:
+                return False
+            if op == "==":
+                if actual != expected:
+                    return False
+            elif op == "in":
+                if actual not in expected:
+                    return False
+            elif op == "array-contains":
+                if not isinstance(actual, list) or expected not in actual:
+                    return False
+            else:
+                if _type_rank(actual) != _type_rank(expected):
+                    return False
+                a, b = _sort_key(actual), _sort_key(expected)
+                if op == "<" and not a < b:
+                    return False
+                if op == "<=" and not a <= b:
+                    return False
+                if op == ">" and not a > b:
+                    return False
+                if op == ">=" and not a >= b:
+                    return False
+        return True
+
+    def _run(self):
+        orders = list(self._orders) or [("__name__", "ASCENDING")]
+        prefix = self._path + "/"
+        depth = self._path.count("/") + 1
+        rows = []
+        with self._store.lock:
+            for path, (data, create_time, update_time) in self._store.docs.items():
+                if not path.startswith(prefix) or path.count("/") != depth:
+                    continue
+                ref = FakeDocumentReference(self._store, path)
+                if not self._matches(ref, data):
+                    continue
+                try:
+                    order_values = [ref if field == "__name__" else _get_path(data, field)
+                                    for field, _ in orders]
+                except KeyError:
+                    continue  # Firestore drops documents missing an order-by field
+                rows.append((order_values, ref, copy.deepcopy(data), create_time, update_time))
+
+        # Stable sorts from the last order key to the first give a multi-key ordering
+        for index in range(len(orders) - 1, -1, -1):
+            _, direction = orders[index]
+            rows.sort(key=lambda row: _sort_key(row[0][index]), reverse=direction == "DESCENDING")
+
+        if self._start_after is not None:
+            cursor_keys = [_sort_key(self._start_after.get(field)) for field, _ in orders]
+            directions = [direction for _, direction in orders]
+
+            def after_cursor(row):
+                for value, cursor_key, direction in zip(row[0], cursor_keys, directions):
+                    key = _sort_key(value)
+                    if key == cursor_key:
+                        continue
+                    return key > cursor_key if direction != "DESCENDING" else key < cursor_key
+                return False
+
+            rows = [row for row in rows if after_cursor(row)]
+
+        if self._limit is not None:
+            rows = rows[:self._limit]
+
+        for _, ref, data, create_time, update_time in rows:
+            if self._projection is not None:
+                projected = {}
+                for field in self._projection:
+                    try:
+                        _apply_update(projected, field, _get_path(data, field))
+                    except KeyError:
+                        pass
+                data = projected
+            yield FakeDocumentSnapshot(ref, data, create_time, update_time)
+
+    def stream(self, transaction=None, **kwargs):
+        self._store.round_trip()
+        return self._run()
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        # Deliver the initial snapshot from a listener thread as Firestore does;
+        # later writes are not pushed
+        docs = list(self.stream())
+        changes = [SimpleNamespace(type=SimpleNamespace(name="ADDED"), document=doc) for doc in docs]
+        threading.Thread(target=callback, args=(docs, changes, datetime.now(timezone.utc)), daemon=True).start()
+        return _Watch()
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, store, path):
+        super().__init__(store, path)
+
+    @property
+    def id(self):
+        return self._path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._store, f"{self._path}/{document_id or _auto_id()}")
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        ref.set(document_data)
+        return _now(), ref
+
+
+class FakeWriteBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference, lambda: reference._set(document_data, merge)))
+        return self
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(("update", reference, lambda: reference._update(field_updates)))
+        return self
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference, reference._delete))
+        return self
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self):
+        self._store.round_trip()
+        with self._store.lock:
+            # Batches are atomic: check every update target exists before applying anything
+            existing = set()
+            for kind, reference, _ in self._writes:
+                if kind == "set":
+                    existing.add(reference.path)
+                elif kind == "delete":
+                    existing.discard(reference.path)
+                elif reference.path not in existing and reference.path not in self._store.docs:
+                    raise NotFound(f"No document to update: {reference.path}")
+            for _, _, write in self._writes:
+                write()
+        self._writes = []
+        return []
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0):
+        self._store = _Store(latency)
+
+    @property
+    def calls(self):
+        return self._store.calls
+
+    def collection(self, name):
+        return FakeCollectionReference(self._store, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self._store, path)
+
+    def batch(self):
+        return FakeWriteBatch(self._store)
+
+    def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        self._store.round_trip()
+        with self._store.lock:
+            snapshots = [reference._snapshot() for reference in references]
+        return iter(snapshots)
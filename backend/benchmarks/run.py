@@ -0,0 +1,285 @@
+"""
+Offline load test for the backend.
+
+Boots app.app against an in-memory Firestore and stubbed OpenAI/Stripe
+clients, drives every blueprint with a weighted mix of requests at a fixed
+concurrency, and reports per-route latency percentiles, throughput and
+response sizes, along with what compression, conditional GETs and
+coalesced AI calls saved and how soon streamed AI responses deliver their
+first event.
+Each run is saved as JSON and compared with the previous one.
+
+Run from the backend directory:
+    python -m benchmarks.run --duration 30 --concurrency 16
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run the workload for")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent simulated clients")
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--firestore-latency-ms", type=float, default=5)
+    parser.add_argument("--openai-latency-ms", type=float, default=1500)
+    parser.add_argument("--stripe-latency-ms", type=float, default=300)
+    parser.add_argument("--image-latency-ms", type=float, default=200,
+                        help="Simulated download time of a listing photo")
+    parser.add_argument("--bcrypt-rounds", type=int, default=None,
+                        help="Pin the bcrypt cost instead of calibrating it")
+    parser.add_argument("--async-mode", action="store_true",
+                        help="Serve the AI routes through their async variants (AI_ASYNC_MODE=1)")
+    parser.add_argument("--accept-encoding", default="gzip, br",
+                        help="Accept-Encoding sent with every request; empty for uncompressed responses")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for the request mix")
+    parser.add_argument("--output", default=RESULTS_DIR, help="Directory results are written to")
+    parser.add_argument("--baseline", default=None,
+                        help="Result file to compare against (defaults to the most recent run)")
+    parser.add_argument("--fail-on-regression", type=float, default=None, metavar="PCT",
+                        help="Exit non-zero if any route's p95 is more than PCT%% slower than the baseline")
+    return parser.parse_args()
+
+
+def boot_app(args):
+    """Import the Flask app with Firestore, OpenAI and Stripe replaced by local fakes."""
+    os.environ.setdefault("OPEN_AI_API_KEY", "sk-benchmark")
+    os.environ.setdefault("JWT_KEY", "benchmark-secret")
+    os.environ.setdefault("STRIPE_KEY", "sk_test_benchmark")
+    if args.bcrypt_rounds:
+        os.environ["PASSWORD_HASH_ROUNDS"] = str(args.bcrypt_rounds)
+    if getattr(args, "async_mode", False):
+        os.environ["AI_ASYNC_MODE"] = "1"
+    # Exercise photo preprocessing, served by the image stub; start with an empty thumbnail cache and no recorded valuations
+    os.environ.setdefault("IMAGE_MODE", "inline")
+    os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="benchmark-images-"))
+    os.environ.setdefault("VALUATION_MODEL_PATH", os.path.join(os.environ["IMAGE_CACHE_DIR"], "valuations.sqlite3"))
+    # Every simulated client shares one address, so only the model concurrency cap is exercised
+    os.environ.setdefault("AI_ADMISSION_PATH", os.path.join(os.environ["IMAGE_CACHE_DIR"], "admission.sqlite3"))
+    os.environ.setdefault("AI_RATE_LIMIT_PER_MINUTE", "1000000")
+    os.environ.setdefault("AI_RATE_LIMIT_BURST", "1000000")
+
+    from benchmarks.fake_firestore import FakeFirestore
+    from benchmarks.stubs import StubAsyncOpenAI, StubOpenAI, install_image_stub, install_stripe_stub
+
+    fake_db = FakeFirestore(latency=args.firestore_latency_ms / 1000)
+    import db_config
+    db_config.get_db = lambda: fake_db
+
+    from services import openai_client
+    openai_latency = args.openai_latency_ms / 1000
+    openai_client._build_client = lambda api_key: StubOpenAI(latency=openai_latency)
+    openai_client._build_async_client = lambda api_key: StubAsyncOpenAI(latency=openai_latency)
+
+    from services import images
+    install_image_stub(images, latency=getattr(args, "image_latency_ms", 200) / 1000)
+
+    import stripe
+    install_stripe_stub(stripe, latency=args.stripe_latency_ms / 1000)
+
+    import app as app_module
+    return app_module.app, fake_db
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_workload(app, context, args):
+    from benchmarks.workload import OPERATIONS
+
+    operations = [operation for operation, _ in OPERATIONS]
+    weights = [weight for _, weight in OPERATIONS]
+    samples = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    body_bytes = defaultdict(int)
+    first_events = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def client_loop(worker):
+        rng = random.Random(None if args.seed is None else args.seed + worker)
+        client = app.test_client()
+        if getattr(args, "accept_encoding", ""):
+            client.environ_base["HTTP_ACCEPT_ENCODING"] = args.accept_encoding
+        while time.perf_counter() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            started = time.perf_counter()
+            size = 0
+            first_event_ms = None
+            try:
+                route, response = operation(client, context)
+                status = response.status_code
+                size = len(response.get_data())
+                first_event_ms = getattr(response, "first_event_ms", None)
+            except Exception as e:
+                route, status = operation.__name__, f"exception:{type(e).__name__}"
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with lock:
+                samples[route].append(elapsed_ms)
+                statuses[route][str(status)] += 1
+                body_bytes[route] += size
+                if first_event_ms is not None:
+                    first_events[route].append(first_event_ms)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(client_loop, worker) for worker in range(args.concurrency)]:
+            future.result()
+    wall_time = time.perf_counter() - started
+
+    routes = {}
+    for route, latencies in sorted(samples.items()):
+        latencies.sort()
+        errors = sum(count for status, count in statuses[route].items() if not status.startswith(("2", "3")))
+        routes[route] = {
+            "count": len(latencies),
+            "errors": errors,
+            "rps": len(latencies) / wall_time,
+            "mean_ms": sum(latencies) / len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": latencies[-1],
+            "mean_bytes": body_bytes[route] / len(latencies),
+            "statuses": dict(statuses[route]),
+        }
+        if first_events[route]:
+            firsts = sorted(first_events[route])
+            routes[route]["first_event_p50_ms"] = percentile(firsts, 50)
+            routes[route]["first_event_p95_ms"] = percentile(firsts, 95)
+
+    from compression import compression_stats
+    from services import single_flight_stats
+    total = sum(route["count"] for route in routes.values())
+    return {
+        "wall_time_s": wall_time, "total_requests": total, "total_rps": total / wall_time, "routes": routes,
+        "response_bytes": sum(body_bytes.values()),
+        "not_modified": sum(route["statuses"].get("304", 0) for route in routes.values()),
+        "compression": compression_stats(),
+        "single_flight": single_flight_stats(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latest_result(directory, exclude=None):
+    if not os.path.isdir(directory):
+        return None
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    files = [os.path.join(directory, name) for name in files]
+    files = [path for path in files if path != exclude]
+    return files[-1] if files else None
+
+
+def print_report(result, baseline=None):
+    header = f"{'route':<48} {'count':>6} {'err':>4} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'kB':>7}"
+    if baseline:
+        header += f" {'p95 Δ':>8}"
+    print(header)
+    print("-" * len(header))
+    for route, stats in result["routes"].items():
+        line = (f"{route:<48} {stats['count']:>6} {stats['errors']:>4} {stats['rps']:>7.1f} "
+                f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} "
+                f"{stats.get('mean_bytes', 0) / 1024:>7.1f}")
+        previous = (baseline or {}).get("routes", {}).get(route)
+        if previous and previous["p95_ms"]:
+            change = (stats["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] * 100
+            line += f" {change:>+7.1f}%"
+        print(line)
+    print(f"\n{result['total_requests']} requests in {result['wall_time_s']:.1f}s "
+          f"({result['total_rps']:.1f} req/s)")
+    streamed = {route: stats for route, stats in result["routes"].items() if "first_event_p50_ms" in stats}
+    for route, stats in streamed.items():
+        print(f"{route}: first event p50 {stats['first_event_p50_ms']:.1f} ms, "
+              f"p95 {stats['first_event_p95_ms']:.1f} ms (complete p50 {stats['p50_ms']:.1f} ms)")
+    compression = result.get("compression")
+    if compression:
+        saved = compression["bytes_saved"] / compression["original_bytes"] * 100 if compression["original_bytes"] else 0.0
+        print(f"{result['response_bytes'] / 1024:.0f} kB of response bodies sent; compression saved "
+              f"{compression['bytes_saved'] / 1024:.0f} kB ({saved:.0f}%) over {sum(compression['responses'].values())} "
+              f"responses; {result['not_modified']} answered 304 Not Modified")
+    for name, stats in result.get("single_flight", {}).items():
+        print(f"{name} calls: {stats['calls']}, {stats['collapsed'] + stats['shared']} shared an identical call in flight")
+
+
+def regressions(result, baseline, threshold_pct):
+    slower = []
+    for route, stats in result["routes"].items():
+        previous = baseline.get("routes", {}).get(route)
+        if previous and previous["p95_ms"]:
+            change = (stats["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] * 100
+            if change > threshold_pct:
+                slower.append((route, change))
+    return slower
+
+
+def main():
+    args = parse_args()
+    app, fake_db = boot_app(args)
+
+    from benchmarks.workload import seed
+    from passwords import get_hasher
+    context = seed(fake_db, get_hasher(), products=args.products, users=args.users, chats=args.chats)
+    if args.seed is not None:
+        context.rng.seed(args.seed)
+
+    print(f"Running {args.duration:.0f}s at concurrency {args.concurrency} "
+          f"({args.products} products, {args.users} users, {args.chats} chats)\n")
+    result = run_workload(app, context, args)
+    result.update({
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "firestore_calls": fake_db.calls,
+    })
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    baseline_path = args.baseline or latest_result(args.output, exclude=path)
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print_report(result, baseline)
+    print(f"\nSaved results to {path}")
+    if baseline_path:
+        print(f"Compared with {baseline_path}")
+
+    if baseline and args.fail_on_regression is not None:
+        slower = regressions(result, baseline, args.fail_on_regression)
+        for route, change in slower:
+            print(f"REGRESSION {route}: p95 {change:+.1f}%")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
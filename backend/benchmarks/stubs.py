@@ -0,0 +1,217 @@
+"""
+Latency-configurable stand-ins for the OpenAI and Stripe clients, so the
+AI and payment routes can be benchmarked without network access or keys.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import random
+import re
+import time
+import uuid
+from types import SimpleNamespace
+
+
+def _delay(latency, jitter):
+    return max(0.0, random.gauss(latency, latency * jitter)) if latency else 0.0
+
+
+def _sleep(latency, jitter):
+    if latency:
+        time.sleep(_delay(latency, jitter))
+
+
+def _listing(messages):
+    content = messages[-1]["content"] if messages else ""
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    match = re.match(r"(.*) \(Asking: EUR ([0-9.]+)\)", content, re.S)
+    return (match.group(1), float(match.group(2))) if match else (content, None)
+
+
+def _valuation(messages):
+    # The same product is valued consistently, within a few percent, as a real model would
+    desc, price = _listing(messages)
+    base = 50 + int(hashlib.sha256(desc.lower().encode("utf-8")).hexdigest(), 16) % 1450
+    value = round(base * random.uniform(0.97, 1.03))
+    return {
+        "fairMarketValue": value,
+        "goodDeal": price <= value if price is not None else random.random() < 0.5,
+        "suggestion": "Asking price is close to recent listings; reasonable purchase if condition matches photos.",
+    }
+
+
+def _condition():
+    return {
+        "appearance_cond": "Minor scuffs on the corners, screen intact, ports clean, camera lens free of scratches.",
+        "reliability": random.randint(60, 95),
+    }
+
+
+def _locations():
+    places = []
+    for index in range(3):
+        lat = 53.34 + random.uniform(-0.01, 0.01)
+        lon = -6.26 + random.uniform(-0.01, 0.01)
+        places.append({
+            "SuitableLocationName": f"Cafe {random.randint(1, 50)}",
+            "SuitableLocationGPSLat": f"{lat:.6f}",
+            "SuitableLocationGPSLong": f"{lon:.6f}",
+            "SuitableLocationGoogleMapsLink": f"https://maps.google.com/?q={lat:.6f},{lon:.6f}",
+        })
+    return {"data": places}
+
+
+def _answer_for(messages):
+    system = messages[0]["content"] if messages else ""
+    if "appearance_cond" in system and "fairMarketValue" in system:
+        return dict(_condition(), **_valuation(messages))
+    if "fairMarketValue" in system:
+        return _valuation(messages)
+    if "appearance_cond" in system:
+        return _condition()
+    return _locations()
+
+
+class _Stream:
+    """
+    A streamed completion: the first delta arrives after first_token_share of
+    the round trip and the rest of the output trickles in over the remainder.
+    """
+
+    def __init__(self, response, latency, jitter, first_token_share=0.2, chunk_chars=16, include_usage=False):
+        self.response = response
+        self.delay = _delay(latency, jitter)
+        self.first_token_share = first_token_share
+        self.chunk_chars = chunk_chars
+        self.include_usage = include_usage
+        self.closed = False
+
+    def _chunk(self, content=None, usage=None):
+        choices = [] if usage else [SimpleNamespace(index=0, delta=SimpleNamespace(content=content),
+                                                     finish_reason=None)]
+        return SimpleNamespace(id=self.response.id, model=self.response.model, choices=choices, usage=usage)
+
+    def __iter__(self):
+        content = self.response.choices[0].message.content
+        pieces = [content[start:start + self.chunk_chars] for start in range(0, len(content), self.chunk_chars)]
+        time.sleep(self.delay * self.first_token_share)
+        for index, piece in enumerate(pieces):
+            if self.closed:
+                return
+            if index:
+                time.sleep(self.delay * (1 - self.first_token_share) / len(pieces))
+            yield self._chunk(piece)
+        if self.include_usage:
+            yield self._chunk(usage=self.response.usage)
+
+    def close(self):
+        self.closed = True
+
+
+class _Completions:
+    def __init__(self, latency, jitter):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+
+    def create(self, model=None, messages=None, stream=False, stream_options=None, **kwargs):
+        self.calls += 1
+        if stream:
+            return _Stream(self._response(model, messages), self.latency, self.jitter,
+                           include_usage=bool((stream_options or {}).get("include_usage")))
+        _sleep(self.latency, self.jitter)
+        return self._response(model, messages)
+
+    def _response(self, model, messages):
+        content = json.dumps(_answer_for(messages or []))
+        images = sum(
+            1 for message in messages or [] if isinstance(message.get("content"), list)
+            for part in message["content"] if part.get("type") == "image_url"
+        )
+        return SimpleNamespace(
+            id=f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                finish_reason="stop",
+                message=SimpleNamespace(role="assistant", content=content),
+            )],
+            usage=SimpleNamespace(
+                prompt_tokens=400 + 765 * images,
+                completion_tokens=len(content) // 4,
+                total_tokens=400 + 765 * images + len(content) // 4,
+            ),
+        )
+
+
+class _AsyncCompletions(_Completions):
+    async def create(self, model=None, messages=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(_delay(self.latency, self.jitter))
+        return self._response(model, messages)
+
+
+class StubOpenAI:
+    """Mimics openai.OpenAI().chat.completions.create with a simulated round trip."""
+
+    def __init__(self, latency=1.0, jitter=0.2):
+        self.chat = SimpleNamespace(completions=_Completions(latency, jitter))
+
+
+class StubAsyncOpenAI:
+    """Mimics openai.AsyncOpenAI(); the simulated round trip yields to the event loop."""
+
+    def __init__(self, latency=1.0, jitter=0.2):
+        self.chat = SimpleNamespace(completions=_AsyncCompletions(latency, jitter))
+
+
+def install_stripe_stub(stripe, latency=0.3, jitter=0.2):
+    """Replace the Stripe API calls the routes make with local fakes."""
+
+    def account_create(**kwargs):
+        _sleep(latency, jitter)
+        return SimpleNamespace(id=f"acct_{uuid.uuid4().hex[:16]}")
+
+    def account_link_create(**kwargs):
+        _sleep(latency, jitter)
+        return SimpleNamespace(url=f"https://connect.stripe.com/setup/{uuid.uuid4().hex[:16]}")
+
+    def payment_intent_create(**kwargs):
+        _sleep(latency, jitter)
+        intent_id = f"pi_{uuid.uuid4().hex[:16]}"
+        return SimpleNamespace(id=intent_id, client_secret=f"{intent_id}_secret_{uuid.uuid4().hex[:8]}")
+
+    def session_create(**kwargs):
+        _sleep(latency, jitter)
+        return SimpleNamespace(id=f"cs_test_{uuid.uuid4().hex[:16]}")
+
+    stripe.Account.create = staticmethod(account_create)
+    stripe.AccountLink.create = staticmethod(account_link_create)
+    stripe.PaymentIntent.create = staticmethod(payment_intent_create)
+    stripe.checkout.Session.create = staticmethod(session_create)
+
+
+def install_image_stub(images, latency=0.2, jitter=0.2, variants=8, size=(2016, 1512)):
+    """
+    Serve listing photos from a few synthetic phone-sized JPEGs instead of
+    downloading them, so image preprocessing is exercised offline.
+    """
+    from PIL import Image
+
+    # Noise keeps the JPEGs about as large as real photos; tinting gives each variant distinct bytes
+    base = Image.blend(Image.effect_noise(size, 60).convert("RGB"),
+                       Image.linear_gradient("L").resize(size).convert("RGB"), 0.5)
+    photos = []
+    for variant in range(variants):
+        tint = Image.new("RGB", size, (variant * 30 % 256, variant * 70 % 256, variant * 110 % 256))
+        output = io.BytesIO()
+        Image.blend(base, tint, 0.2).save(output, format="JPEG", quality=90)
+        photos.append(output.getvalue())
+
+    def download(url):
+        _sleep(latency, jitter)
+        return photos[int(hashlib.sha256(url.encode("utf-8")).hexdigest(), 16) % variants]
+
+    images._download = download
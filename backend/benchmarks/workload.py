@@ -0,0 +1,351 @@
+"""
+Seed data and the weighted request mix used by the benchmark runner.
+
+Each operation takes a Flask test client and the shared seed context and
+returns (route label, response). Labels use the URL rule, so results
+aggregate per route rather than per concrete URL. Streamed responses also
+carry first_event_ms, the time until their first event arrived.
+"""
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from product_geo import inherited_geo_fields
+
+TITLES = [
+    "iPhone 13 128GB", "iPhone 14 Pro 256GB", "MacBook Air M1 2020", "MacBook Pro M1 Pro 14 Inch",
+    "PlayStation 5 Disc Edition", "Xbox Series X", "Nintendo Switch OLED", "Samsung Galaxy S22",
+    "iPad Air 5th Gen", "Dell XPS 13", "AirPods Pro 2", "Google Pixel 7",
+]
+CATEGORIES = ["phone", "laptop", "console", "tablet", "audio"]
+IMAGE_URLS = [
+    "https://images.example.com/listing/{}/front.jpg",
+    "https://images.example.com/listing/{}/back.jpg",
+]
+
+
+class SeedContext:
+    def __init__(self):
+        self.product_ids = []
+        self.chat_ids = []
+        self.users = []
+        # ETags of responses seen so far, which clients send back to revalidate
+        self.etags = {}
+        self.rng = random.Random()
+
+
+def seed(db, hasher, products=500, users=50, chats=200, messages_per_chat=20):
+    """Populate the fake Firestore with a catalogue, users and chat history."""
+    context = SeedContext()
+    rng = random.Random(8)
+
+    password_hash = hasher.hash("benchmark-password")
+    locations = {}
+    for index in range(users):
+        email = f"user{index}@example.com"
+        locations[email] = {"lattitude": 53.35 + rng.uniform(-0.1, 0.1), "longitude": -6.26 + rng.uniform(-0.1, 0.1)}
+        db.collection("user").document(email).set({
+            "email": email,
+            "password": password_hash,
+            "location": locations[email],
+            "chats": [],
+            "isSeller": index % 3 == 0,
+        })
+        context.users.append(email)
+
+    for index in range(products):
+        title = rng.choice(TITLES)
+        seller = rng.choice(context.users)
+        ref = db.collection("product").document()
+        ref.set({
+            "title": title,
+            "desc": f"Used {title}, lightly used, comes with charger",
+            "price": float(rng.randint(50, 1500)),
+            "seller": seller,
+            **inherited_geo_fields(locations[seller]),
+            "category": rng.choice(CATEGORIES),
+            "image_urls": [url.format(index) for url in IMAGE_URLS],
+            "appearance_cond": "Good",
+            "battery_cond": f"{rng.randint(75, 100)}%",
+            "storage": rng.choice(["64GB", "128GB", "256GB", "512GB"]),
+        })
+        context.product_ids.append(ref.id)
+
+    started = datetime.now(timezone.utc) - timedelta(days=1)
+    for index in range(chats):
+        chat_ref = db.collection("chat").document()
+        chat_ref.set({
+            "meetup": {"agreed": False, "location": {"lat": "", "long": ""}, "price": "", "time": ""},
+            "otp": {"confirmed": False, "token": "BENCHMARKOTP0001"},
+            "last_message": None,
+            "message_count": messages_per_chat,
+        })
+        for position in range(messages_per_chat):
+            chat_ref.collection("messages").document().set({
+                "sender": rng.choice(context.users),
+                "text": f"Message {position} about the listing",
+                "timestamp": started + timedelta(minutes=index * messages_per_chat + position),
+            })
+        context.chat_ids.append(chat_ref.id)
+
+    return context
+
+
+def _json(response):
+    response.get_data()
+    # A WSGI server closes every response once it is sent, which runs its cleanup
+    response.close()
+    return response
+
+
+def _revalidated_get(client, ctx, url):
+    """GET url as a polling client would, sending the ETag of its previous response."""
+    etag = ctx.etags.get(url)
+    response = _json(client.get(url, headers={"If-None-Match": etag} if etag else {}))
+    if response.headers.get("ETag"):
+        ctx.etags[url] = response.headers["ETag"]
+    return response
+
+
+def _streamed(client, url, body=None):
+    """POST url asking for an event stream and read it as it arrives, timing the first event."""
+    started = time.perf_counter()
+    response = client.post(url, query_string={"stream": "true"}, json=body, buffered=False)
+    iterable, chunks, first_event_ms = response.response, [], None
+    try:
+        for chunk in iterable:
+            if first_event_ms is None:
+                first_event_ms = (time.perf_counter() - started) * 1000
+            chunks.append(chunk)
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+    response.set_data(b"".join(chunks))
+    response.first_event_ms = first_event_ms
+    return response
+
+
+def list_products(client, ctx):
+    return "GET /api/products", _revalidated_get(client, ctx, "/api/products")
+
+
+def list_products_page(client, ctx):
+    url = f"/api/products?page_size=20&category={ctx.rng.choice(CATEGORIES)}&fields=title,price,image_urls"
+    return "GET /api/products (paged)", _json(client.get(url))
+
+
+def export_products(client, ctx):
+    return "GET /api/products (ndjson)", _json(client.get("/api/products?format=ndjson"))
+
+
+def search_products(client, ctx):
+    query = ctx.rng.choice(TITLES).split()[0].lower()
+    url = f"/api/products/search?q={query}&page_size=20&price_max={ctx.rng.choice([250, 500, 1000])}"
+    return "GET /api/products/search", _json(client.get(url))
+
+
+def nearby_products(client, ctx):
+    url = (f"/api/products/nearby?lat={53.35 + ctx.rng.uniform(-0.1, 0.1):.5f}"
+           f"&lon={-6.26 + ctx.rng.uniform(-0.1, 0.1):.5f}&radius_km={ctx.rng.choice([1, 2, 5])}&page_size=20")
+    return "GET /api/products/nearby", _json(client.get(url))
+
+
+def get_product(client, ctx):
+    return "GET /api/products/<id>", _revalidated_get(client, ctx, f"/api/products/{ctx.rng.choice(ctx.product_ids)}")
+
+
+def update_product(client, ctx):
+    product_id = ctx.rng.choice(ctx.product_ids)
+    return "PATCH /api/products/<id>", _json(client.patch(
+        f"/api/products/{product_id}", json={"price": float(ctx.rng.randint(50, 1500))}))
+
+
+def batch_update_products(client, ctx):
+    # A seller tool repricing a page of listings in one call
+    updates = [{"product_id": product_id, "fields": {"price": float(ctx.rng.randint(50, 1500))}}
+               for product_id in ctx.rng.sample(ctx.product_ids, 20)]
+    return "PATCH /api/products:batchUpdate", _json(client.patch("/api/products:batchUpdate", json={"updates": updates}))
+
+
+def create_product(client, ctx):
+    response = _json(client.post("/api/products", json={
+        "title": ctx.rng.choice(TITLES),
+        "desc": "Benchmark listing",
+        "price": float(ctx.rng.randint(50, 1500)),
+        "seller": ctx.rng.choice(ctx.users),
+        "category": ctx.rng.choice(CATEGORIES),
+        "image_urls": [url.format("new") for url in IMAGE_URLS],
+    }))
+    if response.status_code == 201:
+        ctx.product_ids.append(response.get_json()["product_id"])
+    return "POST /api/products", response
+
+
+def list_chats(client, ctx):
+    return "GET /api/chats", _json(client.get("/api/chats"))
+
+
+def get_chat(client, ctx):
+    return "GET /api/chats/<id>", _revalidated_get(client, ctx, f"/api/chats/{ctx.rng.choice(ctx.chat_ids)}?recent=5")
+
+
+def get_messages(client, ctx):
+    return "GET /api/chats/<id>/messages", _json(
+        client.get(f"/api/chats/{ctx.rng.choice(ctx.chat_ids)}/messages?page_size=20"))
+
+
+def add_message(client, ctx):
+    return "PATCH /api/chats/<id>/message", _json(client.patch(
+        f"/api/chats/{ctx.rng.choice(ctx.chat_ids)}/message",
+        json={"sender": ctx.rng.choice(ctx.users), "text": "Is this still available?"}))
+
+
+def create_chat(client, ctx):
+    response = _json(client.post("/api/chats"))
+    if response.status_code == 201:
+        ctx.chat_ids.append(response.get_json()["chat_id"])
+    return "POST /api/chats", response
+
+
+def update_chat(client, ctx):
+    return "PATCH /api/chats/<id>", _json(client.patch(
+        f"/api/chats/{ctx.rng.choice(ctx.chat_ids)}", json={"meetup.price": ctx.rng.randint(50, 1500)}))
+
+
+def agree_meetup(client, ctx):
+    return "PATCH /api/chats/<id>/meetup/agree", _json(client.patch(
+        f"/api/chats/{ctx.rng.choice(ctx.chat_ids)}/meetup/agree",
+        json={"time": "18:00", "location": {"lat": 53.34, "long": -6.26}, "price": 400}))
+
+
+def confirm_otp(client, ctx):
+    return "PATCH /api/chats/<id>/confirm-otp", _json(client.patch(
+        f"/api/chats/{ctx.rng.choice(ctx.chat_ids)}/confirm-otp", json={"otp": "BENCHMARKOTP0001"}))
+
+
+def signup(client, ctx):
+    email = f"new{ctx.rng.getrandbits(48)}@example.com"
+    return "POST /signup", _json(client.post("/signup", json={
+        "email": email, "password": "benchmark-password", "location": None}))
+
+
+def login(client, ctx):
+    return "POST /login", _json(client.post("/login", json={
+        "email": ctx.rng.choice(ctx.users), "password": "benchmark-password",
+        "location": {"latitude": 53.34, "longitude": -6.26}}))
+
+
+def get_user_location(client, ctx):
+    return "GET /api/users/<id>/location", _json(client.get(f"/api/users/{ctx.rng.choice(ctx.users)}/location"))
+
+
+def evaluate_price(client, ctx):
+    # A small set of listings so repeat evaluations behave like a popular catalogue
+    title = ctx.rng.choice(TITLES)
+    return "POST /api/evaluate-price", _json(client.post("/api/evaluate-price", json={
+        "desc": f"Used {title}", "price": ctx.rng.choice([200, 400, 600]),
+        "seller": ctx.rng.choice(ctx.users[:5]), "image_urls": [url.format(title) for url in IMAGE_URLS]}))
+
+
+def evaluate_viral_listing(client, ctx):
+    # A new listing every two seconds that every client values at once, as when one goes viral
+    listing = int(time.time() // 2)
+    return "POST /api/evaluate-price (viral)", _json(client.post("/api/evaluate-price", json={
+        "desc": f"Used {TITLES[listing % len(TITLES)]} #{listing}", "price": 500,
+        "seller": ctx.users[0], "image_urls": [IMAGE_URLS[0].format(listing)]}))
+
+
+def evaluate_price_stream(client, ctx):
+    title = ctx.rng.choice(TITLES)
+    return "POST /api/evaluate-price?stream", _streamed(client, "/api/evaluate-price", {
+        "desc": f"Used {title}", "price": ctx.rng.choice([200, 400, 600]),
+        "seller": ctx.rng.choice(ctx.users[:5]), "image_urls": [url.format(title) for url in IMAGE_URLS]})
+
+
+def evaluate_price_batch(client, ctx):
+    listings = [{
+        "id": index, "desc": f"Used {ctx.rng.choice(TITLES)}", "price": ctx.rng.randint(50, 1500),
+        "seller": ctx.rng.choice(ctx.users), "image_urls": [IMAGE_URLS[0].format(index)],
+    } for index in range(5)]
+    return "POST /api/evaluate-price/batch", _json(client.post(
+        "/api/evaluate-price/batch", json={"listings": listings, "concurrency": 5}))
+
+
+def evaluate_appearance(client, ctx):
+    return "POST /api/evaluate-appearance-cond/<id>", _json(
+        client.post(f"/api/evaluate-appearance-cond/{ctx.rng.choice(ctx.product_ids)}"))
+
+
+def evaluate_appearance_stream(client, ctx):
+    return "POST /api/evaluate-appearance-cond/<id>?stream", _streamed(
+        client, f"/api/evaluate-appearance-cond/{ctx.rng.choice(ctx.product_ids)}")
+
+
+def appraise_product(client, ctx):
+    return "POST /api/products/<id>/appraise", _json(
+        client.post(f"/api/products/{ctx.rng.choice(ctx.product_ids)}/appraise"))
+
+
+def generate_location(client, ctx):
+    return "POST /api/generate-location", _json(client.post("/api/generate-location", json={
+        "lat1": 53.34 + ctx.rng.uniform(-0.05, 0.05), "lon1": -6.26 + ctx.rng.uniform(-0.05, 0.05),
+        "lat2": 53.34 + ctx.rng.uniform(-0.05, 0.05), "lon2": -6.26 + ctx.rng.uniform(-0.05, 0.05)}))
+
+
+def generate_location_stream(client, ctx):
+    return "POST /api/generate-location?stream", _streamed(client, "/api/generate-location", {
+        "lat1": 53.34 + ctx.rng.uniform(-0.05, 0.05), "lon1": -6.26 + ctx.rng.uniform(-0.05, 0.05),
+        "lat2": 53.34 + ctx.rng.uniform(-0.05, 0.05), "lon2": -6.26 + ctx.rng.uniform(-0.05, 0.05)})
+
+
+def create_payment_intent(client, ctx):
+    return "POST /api/create-payment-intent", _json(client.post("/api/create-payment-intent", json={
+        "line_items": [{"price_data": {"currency": "eur", "unit_amount": 40000}, "quantity": 1}]}))
+
+
+def create_checkout_session(client, ctx):
+    return "POST /api/create-checkout-session", _json(client.post("/api/create-checkout-session", json={
+        "line_items": [{"price_data": {"currency": "eur", "unit_amount": 40000,
+                                       "product_data": {"name": "iPhone"}}, "quantity": 1}],
+        "return_url": "https://example.com/return"}))
+
+
+def create_connect_account(client, ctx):
+    return "POST /api/create-connect-account", _json(client.post("/api/create-connect-account", json={
+        "email": ctx.rng.choice(ctx.users), "return_url": "https://example.com/return"}))
+
+
+# (operation, relative weight) — reads dominate, AI and payment calls are rarer
+OPERATIONS = [
+    (list_products, 8),
+    (list_products_page, 12),
+    (export_products, 1),
+    (search_products, 8),
+    (nearby_products, 6),
+    (get_product, 15),
+    (update_product, 3),
+    (batch_update_products, 1),
+    (create_product, 2),
+    (list_chats, 1),
+    (get_chat, 15),
+    (get_messages, 5),
+    (add_message, 8),
+    (create_chat, 1),
+    (update_chat, 2),
+    (agree_meetup, 1),
+    (confirm_otp, 1),
+    (signup, 1),
+    (login, 3),
+    (get_user_location, 3),
+    (evaluate_price, 3),
+    (evaluate_price_stream, 2),
+    (evaluate_viral_listing, 2),
+    (evaluate_price_batch, 1),
+    (evaluate_appearance, 2),
+    (evaluate_appearance_stream, 1),
+    (appraise_product, 1),
+    (generate_location, 2),
+    (generate_location_stream, 1),
+    (create_payment_intent, 1),
+    (create_checkout_session, 1),
+    (create_connect_account, 1),
+]
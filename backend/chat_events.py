@@ -0,0 +1,160 @@
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+
+# Fields on the chat document that are pushed to subscribers when they change
+WATCHED_FIELDS = ("meetup", "otp")
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class Subscription(queue.Queue):
+    """Bounded event queue for one SSE client. `closed` is set once the hub drops it."""
+
+    def __init__(self):
+        super().__init__(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.closed = False
+        self.state = {}
+
+    def close(self):
+        self.closed = True
+        try:
+            self.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class ChatEventHub:
+    """
+    Holds the Firestore listeners for one chat and fans their events out to
+    every subscriber in this process. Events are (kind, payload) tuples:
+    ("message", DocumentSnapshot) for new messages and (field, value) for
+    changes to the watched chat fields.
+    """
+
+    def __init__(self, db, chat_id, chat_data=None):
+        from firebase_admin import firestore
+
+        self.chat_id = chat_id
+        self.subscribers = set()
+        self._lock = threading.Lock()
+        # Seeded from a chat document the caller already read, so a change made
+        # before the listener's first snapshot is still published
+        self._state = None if chat_data is None else _watched_state(chat_data)
+
+        chat_ref = db.collection("chat").document(chat_id)
+        # Only listen for messages created from now on, so the initial
+        # snapshot does not read the whole history
+        started_at = datetime.now(timezone.utc)
+        new_messages = (chat_ref.collection("messages")
+                        .where(filter=firestore.FieldFilter("timestamp", ">", started_at))
+                        .order_by("timestamp"))
+        self._watches = [
+            chat_ref.on_snapshot(self._on_chat_snapshot),
+            new_messages.on_snapshot(self._on_messages_snapshot),
+        ]
+
+    def _publish(self, event, subscribers=None):
+        if subscribers is None:
+            with self._lock:
+                subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Drop consumers that fall too far behind; they can resume
+                # with Last-Event-ID when they reconnect
+                self.remove(subscriber)
+                subscriber.close()
+
+    def _on_chat_snapshot(self, docs, changes, read_time):
+        for doc in docs:
+            state = _watched_state(doc.to_dict() or {})
+            # Subscribers added after the state changes receive it from add() instead
+            with self._lock:
+                previous, self._state = self._state, state
+                subscribers = list(self.subscribers)
+            if previous is None:
+                continue
+            for field in WATCHED_FIELDS:
+                if state[field] != previous[field]:
+                    self._publish((field, state[field]), subscribers)
+
+    def _on_messages_snapshot(self, docs, changes, read_time):
+        for change in changes:
+            if change.type.name == "ADDED":
+                self._publish(("message", change.document))
+
+    def add(self, subscriber):
+        """Add a subscriber. Returns the watched fields as of now, or None before they are known."""
+        with self._lock:
+            self.subscribers.add(subscriber)
+            return None if self._state is None else dict(self._state)
+
+    def remove(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+            return len(self.subscribers)
+
+    def close(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        with self._lock:
+            subscribers, self.subscribers = list(self.subscribers), set()
+        for subscriber in subscribers:
+            subscriber.close()
+
+
+def _watched_state(chat_data):
+    return {field: chat_data.get(field) for field in WATCHED_FIELDS}
+
+
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Listener threads do not survive a fork; each worker builds its own hubs
+    global _hubs, _hubs_lock
+    _hubs = {}
+    _hubs_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def subscribe(db, chat_id, chat_data=None):
+    """
+    Register a subscriber queue for a chat, starting its listeners if needed.
+    chat_data is the chat document as the caller last read it. The
+    subscriber's `state` holds the watched fields to start from: later
+    changes arrive as events.
+    """
+    subscriber = Subscription()
+    with _hubs_lock:
+        hub = _hubs.get(chat_id)
+        if hub is None:
+            hub = ChatEventHub(db, chat_id, chat_data)
+            _hubs[chat_id] = hub
+        state = hub.add(subscriber)
+    if state is None:
+        state = _watched_state(chat_data or {})
+    subscriber.state = state
+    return subscriber
+
+
+def unsubscribe(chat_id, subscriber):
+    """Remove a subscriber, stopping the chat's listeners when it was the last one."""
+    with _hubs_lock:
+        hub = _hubs.get(chat_id)
+        if hub is None:
+            return
+        if hub.remove(subscriber) == 0:
+            del _hubs[chat_id]
+            hub.close()
+
+
+def hub_stats():
+    with _hubs_lock:
+        return {chat_id: len(hub.subscribers) for chat_id, hub in _hubs.items()}
@@ -0,0 +1,134 @@
+"""
+Response compression for JSON and text bodies.
+
+Responses of at least COMPRESS_MIN_BYTES are encoded with brotli or gzip,
+whichever the client prefers in Accept-Encoding (brotli when it accepts
+both equally and the Brotli package is installed). Streamed responses such
+as the NDJSON exports and Server-Sent Events are left alone, so they are
+still delivered as they are produced.
+
+A compressed body is a different representation, so its ETag gets an
+encoding suffix; the suffix is stripped from If-None-Match again before the
+routes compare validators.
+"""
+import gzip
+import os
+import re
+import threading
+from typing import Callable, Dict, List, Optional
+
+from flask import request
+
+MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 4))
+ENABLED = os.getenv("COMPRESS_ENABLED", "1") == "1"
+MIMETYPES = ("application/json", "text/html", "text/plain", "text/csv")
+
+_ETAG_SUFFIX = re.compile(r'-(?:gzip|br)"')
+
+# Callables notified for every compressed response, e.g. to record metrics
+_observers: List[Callable] = []
+
+
+class CompressionStats:
+    """Running totals of what compression saved, for the benchmark report."""
+
+    def __init__(self):
+        self.responses = {}
+        self.original_bytes = 0
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, encoding: str, original_bytes: int, sent_bytes: int) -> None:
+        with self._lock:
+            self.responses[encoding] = self.responses.get(encoding, 0) + 1
+            self.original_bytes += original_bytes
+            self.sent_bytes += sent_bytes
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "responses": dict(self.responses),
+                "original_bytes": self.original_bytes,
+                "sent_bytes": self.sent_bytes,
+                "bytes_saved": self.original_bytes - self.sent_bytes,
+            }
+
+
+_stats = CompressionStats()
+
+
+def add_compression_observer(observer: Callable) -> None:
+    """Register observer(encoding, original_bytes, sent_bytes) to be called for every compressed response."""
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _choose_encoding() -> Optional[str]:
+    accept = request.accept_encodings
+    gzip_quality = accept.quality("gzip")
+    brotli_quality = accept.quality("br")
+    if brotli_quality and brotli_quality >= gzip_quality and _brotli() is not None:
+        return "br"
+    if gzip_quality:
+        return "gzip"
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return _brotli().compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _strip_etag_suffix():
+    if_none_match = request.environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match:
+        request.environ["HTTP_IF_NONE_MATCH"] = _ETAG_SUFFIX.sub('"', if_none_match)
+
+
+def _compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in MIMETYPES or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    data = response.get_data()
+    encoding = _choose_encoding()
+    if encoding is None or len(data) < MIN_BYTES:
+        return response
+
+    compressed = compress(data, encoding)
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+
+    _stats.record(encoding, len(data), len(compressed))
+    for observer in _observers:
+        try:
+            observer(encoding, len(data), len(compressed))
+        except Exception as e:
+            print(f"Compression observer failed: {str(e)}")
+    return response
+
+
+def compression_stats() -> Dict:
+    return _stats.snapshot()
+
+
+def init_app(app):
+    if not ENABLED:
+        return
+    app.before_request(_strip_etag_suffix)
+    app.after_request(_compress_response)
@@ -1,13 +1,63 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
+import os
+import threading
 
+_db = None
+_pid = None
+_lock = threading.Lock()
+_client_hooks = []
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def add_client_hook(hook):
+    """Register hook(db) to run whenever a process creates its Firestore client."""
+    _client_hooks.append(hook)
+
+
+def _get_app():
+    import firebase_admin
+    from firebase_admin import credentials
 
-def get_db():
     try:
-        firebase_admin.get_app()
+        return firebase_admin.get_app()
     except ValueError:
         # If not, initialize the app.
         cred = credentials.Certificate('firebase_config.json')
-        firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    return db
\ No newline at end of file
+        return firebase_admin.initialize_app(cred)
+
+
+def get_db():
+    """
+    Return this process's Firestore client, creating it on first use.
+    gRPC channels are not fork-safe, so a worker that was forked after the
+    parent created a client builds its own instead of inheriting it.
+    """
+    global _db, _pid
+    if _db is None or _pid != os.getpid():
+        with _lock:
+            if _db is None or _pid != os.getpid():
+                from google.cloud import firestore
+
+                app = _get_app()
+                _db = firestore.Client(project=app.project_id, credentials=app.credential.get_credential())
+                _pid = os.getpid()
+                for hook in _client_hooks:
+                    hook(_db)
+    return _db
+
+
+class _LazyClient:
+    """Module-level stand-in for the Firestore client that resolves it on first attribute access."""
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+
+db = _LazyClient()
@@ -0,0 +1,282 @@
+"""
+Read-through cache of Firestore document snapshots.
+
+Hot lookups (a product page, a chat, a user at login) go through
+get_document, which serves the snapshot from a per-worker LRU with a TTL
+and reads Firestore only on a miss. Snapshots are immutable and to_dict()
+returns a copy, so cached entries are never modified by their readers.
+
+Entries are dropped when they can no longer be trusted:
+- this worker's own writes call invalidate(ref);
+- snapshot listeners on the collections in DOC_CACHE_WATCH report writes
+  made by other workers and other clients;
+- the TTL bounds staleness for anything else.
+Callers that need a strong read, such as OTP confirmation, pass fresh=True.
+
+A collection listener reads every document of the collection and keeps it
+in memory, so only product is watched by default. Other modules that need
+the product stream, such as the search index, share its listener through
+add_snapshot_listener rather than opening their own. Fields in
+PRIVATE_FIELDS, such as password hashes, are never kept in the cache;
+code that needs them reads the document directly.
+
+The listeners also give each watched collection a version, its newest
+update time and document count, which the list endpoints use as a
+validator for conditional requests.
+"""
+import copy
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from services.cache import MemoryBackend, ResultCache
+
+TTL = float(os.getenv("DOC_CACHE_TTL", 30))
+MAX_ENTRIES = int(os.getenv("DOC_CACHE_MAX_ENTRIES", 5000))
+# Collections whose changes are pushed to every worker; set to "" to rely on the TTL alone
+WATCHED = [name.strip() for name in os.getenv("DOC_CACHE_WATCH", "product").split(",") if name.strip()]
+ENABLED = os.getenv("DOC_CACHE_ENABLED", "1") == "1"
+# Fields left out of cached snapshots, by collection
+PRIVATE_FIELDS = {"user": ("password",)}
+
+# Callables notified of cache events, e.g. to record metrics
+_observers: List[Callable] = []
+
+
+def add_cache_observer(observer: Callable) -> None:
+    """
+    Register observer(event, collection, count=1, source=None) to be called
+    for hit, miss, bypass, eviction and invalidation events. Invalidations
+    carry their source, "write" or "listener".
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def _notify(event: str, collection: str, count: int = 1, source: str = None) -> None:
+    for observer in _observers:
+        try:
+            observer(event, collection, count=count, source=source)
+        except Exception as e:
+            print(f"Document cache observer failed: {str(e)}")
+
+
+def _collection(path: str) -> str:
+    # "chat/abc/messages/xyz" belongs to "chat/messages"
+    return "/".join(path.split("/")[::2])
+
+
+def _redacted(snapshot):
+    private = PRIVATE_FIELDS.get(_collection(snapshot.reference.path))
+    data = getattr(snapshot, "_data", None)
+    if not private or not data or not any(field in data for field in private):
+        return snapshot
+    # Snapshots keep their fields in _data; to_dict() and get() read from it
+    redacted = copy.copy(snapshot)
+    redacted._data = {name: value for name, value in data.items() if name not in private}
+    return redacted
+
+
+class DocumentCache:
+    def __init__(self, db, ttl: float = TTL, max_entries: int = MAX_ENTRIES, watched=WATCHED):
+        self.cache = ResultCache("document", MemoryBackend(max_entries=max_entries), ttl)
+        # Invalidations by source: "write" or "listener"
+        self.invalidations = {}
+        self.bypasses = 0
+        # path -> token of the read in flight; a write in between stops the read from being cached
+        self._reading = {}
+        # collection -> [newest update time, document count], once its listener has caught up
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._db = db
+        # collection -> listener, its callbacks and its latest (docs, read_time)
+        self._watches = {}
+        self._callbacks = {}
+        self._snapshots = {}
+        # Held while callbacks run, so a new callback cannot see a change before the snapshot it applies to
+        self._dispatch_lock = threading.RLock()
+        for name in watched:
+            self.add_snapshot_listener(name, self._listener(name))
+
+    def get(self, ref, fresh: bool = False):
+        path = ref.path
+        collection = _collection(path)
+        if fresh:
+            with self._lock:
+                self.bypasses += 1
+            _notify("bypass", collection)
+        else:
+            snapshot = self.cache.get(path)
+            if snapshot is not None:
+                _notify("hit", collection)
+                return snapshot
+            _notify("miss", collection)
+
+        token = object()
+        with self._lock:
+            self._reading[path] = token
+        snapshot = _redacted(ref.get())
+        evicted = 0
+        with self._lock:
+            if self._reading.get(path) is token:
+                del self._reading[path]
+                evictions = self.cache.evictions
+                self.cache.set(path, snapshot)
+                evicted = self.cache.evictions - evictions
+        if evicted:
+            _notify("eviction", collection, evicted)
+        return snapshot
+
+    def invalidate(self, path: str, source: str = "write") -> None:
+        with self._lock:
+            self._reading.pop(path, None)
+            self.cache.backend.delete(path)
+            self.invalidations[source] = self.invalidations.get(source, 0) + 1
+            version = self._versions.get(path.split("/")[0])
+            if source == "write" and version is not None:
+                # Our own write must change the version before the listener reports it
+                version[0] = max(version[0], datetime.now(timezone.utc))
+        _notify("invalidation", _collection(path), source=source)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reading.clear()
+            self.cache.backend.clear()
+
+    def _listener(self, name: str):
+        state = {"initial": True}
+
+        def on_snapshot(docs, changes, read_time):
+            if state["initial"]:
+                # Entries cached before the listener caught up may have missed a write
+                state["initial"] = False
+                self.clear()
+                updated = max((doc.update_time for doc in docs if doc.update_time), default=read_time)
+                with self._lock:
+                    self._versions[name] = [updated, len(docs)]
+                return
+            for change in changes:
+                self.invalidate(change.document.reference.path, source="listener")
+            with self._lock:
+                version = self._versions[name]
+                for change in changes:
+                    if change.type.name == "REMOVED":
+                        # A delete leaves the newest update time unchanged, but not the count
+                        version[1] -= 1
+                        continue
+                    if change.type.name == "ADDED":
+                        version[1] += 1
+                    if change.document.update_time:
+                        version[0] = max(version[0], change.document.update_time)
+
+        return on_snapshot
+
+    def add_snapshot_listener(self, name: str, callback: Callable) -> None:
+        """
+        Call callback(docs, changes, read_time) for every snapshot of the
+        collection, starting with one that holds the whole collection. The
+        collection's listener is started if it is not running yet.
+        """
+        with self._dispatch_lock:
+            self._callbacks.setdefault(name, []).append(callback)
+            if name not in self._watches:
+                self._watches[name] = self._db.collection(name).on_snapshot(
+                    lambda docs, changes, read_time: self._dispatch(name, docs, changes, read_time))
+            elif name in self._snapshots:
+                docs, read_time = self._snapshots[name]
+                callback(docs, [], read_time)
+
+    def remove_snapshot_listener(self, name: str, callback: Callable) -> None:
+        with self._dispatch_lock:
+            if callback in self._callbacks.get(name, []):
+                self._callbacks[name].remove(callback)
+
+    def _dispatch(self, name: str, docs, changes, read_time) -> None:
+        with self._dispatch_lock:
+            self._snapshots[name] = (docs, read_time)
+            for callback in list(self._callbacks.get(name, [])):
+                try:
+                    callback(docs, changes, read_time)
+                except Exception as e:
+                    print(f"Snapshot listener on {name} failed: {str(e)}")
+
+    def version(self, collection: str) -> Optional[Tuple[datetime, int]]:
+        """(newest update time, document count) of a watched collection, or None until it is known."""
+        with self._lock:
+            version = self._versions.get(collection)
+            return tuple(version) if version else None
+
+    def stats(self) -> Dict:
+        stats = self.cache.stats()
+        stats.update({
+            "ttl": self.cache.ttl,
+            "watched": sorted(self._watches),
+            "bypasses": self.bypasses,
+            "invalidations": dict(self.invalidations),
+        })
+        return stats
+
+    def close(self) -> None:
+        for watch in self._watches.values():
+            watch.unsubscribe()
+
+
+_cache = None
+_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # Listener threads do not survive a fork, and a forked cache would never hear of new writes
+    global _cache, _pid, _lock
+    _cache = None
+    _pid = os.getpid()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_document_cache() -> DocumentCache:
+    """Return this worker's document cache, starting its listeners on first use."""
+    global _cache
+    if os.getpid() != _pid:
+        _reset_after_fork()
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                from db_config import get_db
+                _cache = DocumentCache(get_db())
+    return _cache
+
+
+def get_document(ref, fresh: bool = False):
+    """
+    Snapshot of the document at ref, served from the cache when possible.
+    Pass fresh=True for a strong read straight from Firestore; the cache is
+    refreshed with its result. Fields in PRIVATE_FIELDS are left out either way.
+    """
+    if not ENABLED:
+        return _redacted(ref.get())
+    return get_document_cache().get(ref, fresh=fresh)
+
+
+def collection_version(collection: str) -> Optional[Tuple[datetime, int]]:
+    """
+    Version of a collection watched by this worker's listeners. Writes from
+    other workers reach it with the listener's delay, typically well under
+    a second; None when the collection is not watched or not yet loaded.
+    """
+    if not ENABLED:
+        return None
+    return get_document_cache().version(collection)
+
+
+def invalidate(*refs) -> None:
+    """Drop the cached snapshots of documents this worker has just written."""
+    if _cache is None or os.getpid() != _pid:
+        return
+    for ref in refs:
+        _cache.invalidate(ref.path)
@@ -0,0 +1,45 @@
+import os
+
+# gunicorn loads this file automatically from the working directory.
+
+# The preloaded app creates its metric files as soon as it is imported, which
+# happens before on_starting, so the directory must exist before then. Stale
+# files are cleared by entrypoint.sh when the container starts; this file is
+# re-read on reload while workers still write there, so it never clears it.
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# Import the app once in the master so workers fork with the code already
+# loaded. Clients are created lazily per process, so nothing network-bound
+# is inherited across the fork.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Threaded workers, so an open chat event stream (GET /api/chats/<id>/events)
+# holds one thread rather than the whole worker; under "sync" workers that
+# route answers 503. With AI_ASYNC_MODE=1 a request waiting on OpenAI only
+# parks its thread on a future while the worker's event loop does the I/O,
+# so many threads can keep hundreds of AI calls in flight per process.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+# gthread workers heartbeat from their main loop, so this bounds a hung
+# worker rather than a request; streams end by themselves after
+# SSE_MAX_STREAM_SECONDS and clients reconnect.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+
+
+def post_worker_init(worker):
+    # Run jobs left in the shared queue by a restart or a dead worker
+    from jobs import start_workers
+    start_workers()
+
+    # Optionally create the Firestore, OpenAI and Stripe clients before the first request
+    if os.getenv("WARMUP_ON_FORK", "0") == "1":
+        from warmup import warm_up
+        warm_up()
+
+
+def child_exit(server, worker):
+    # Drop live gauges of exited workers; their counters and histograms are kept
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
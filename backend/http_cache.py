@@ -0,0 +1,68 @@
+"""
+Validators for conditional GETs.
+
+A single document's ETag and Last-Modified come from its Firestore
+update_time; a list's come from the version doc_cache keeps for the
+whole collection. The request URL's query string is part of the ETag, so
+every filter, page and projection of a resource has its own. Routes check
+the validators before serializing anything and answer 304 Not Modified
+when the client's copy is still current.
+"""
+import hashlib
+from datetime import datetime
+from typing import Optional, Tuple
+
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+import doc_cache
+
+Validators = Tuple[Optional[str], Optional[datetime]]
+
+
+def _timestamp(value: datetime) -> str:
+    # Firestore timestamps carry nanoseconds; the datetime part alone would hide a second write in the same microsecond
+    rfc3339 = getattr(value, "rfc3339", None)
+    return rfc3339() if rfc3339 is not None else value.isoformat()
+
+
+def _etag(*parts) -> str:
+    raw = "\0".join(str(part) for part in parts) + "\0" + request.query_string.decode("latin-1")
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def document_validators(snapshot) -> Validators:
+    update_time = getattr(snapshot, "update_time", None)
+    if not snapshot.exists or update_time is None:
+        return None, None
+    return _etag(snapshot.reference.path, _timestamp(update_time)), update_time
+
+
+def collection_validators(collection: str) -> Validators:
+    version = doc_cache.collection_version(collection)
+    if version is None:
+        return None, None
+    updated, count = version
+    return _etag(collection, _timestamp(updated), count), updated
+
+
+def is_modified(validators: Validators) -> bool:
+    """False when the request's If-None-Match or If-Modified-Since shows the client's copy is current."""
+    etag, last_modified = validators
+    if etag is None:
+        return True
+    return is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+
+def with_validators(response: Response, validators: Validators) -> Response:
+    etag, last_modified = validators
+    if etag is not None:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # Clients may keep the body but must revalidate it on every use
+        response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(validators: Validators) -> Response:
+    return with_validators(Response(status=304), validators)
@@ -0,0 +1,420 @@
+"""
+Background job queue for the AI evaluations.
+
+Routes enqueue a job and answer with its id straight away; a small pool of
+threads in each worker process runs it, retries failures with backoff and
+writes the result back onto the product or chat document. Identical jobs
+that are still pending or running are not queued twice.
+
+The queue lives in process memory by default. With JOB_QUEUE_BACKEND=sqlite
+it is kept in a SQLite file, so every gunicorn worker on the host shares
+one queue and jobs survive a restart: each worker starts its threads when
+gunicorn boots it (see start_workers) and picks up what was left pending.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+WORKERS = int(os.getenv("JOB_WORKERS", 2))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Seconds before the first retry, doubled on every further attempt
+RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 2))
+# A running job whose worker died is handed out again after this long
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 300))
+POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+# Finished jobs are kept this long for GET /api/jobs/<id>
+RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", 24 * 60 * 60))
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobError(Exception):
+    """Raised by a handler when the job failed and may be retried."""
+
+
+def dedup_key(kind: str, params: Dict) -> str:
+    payload = json.dumps({"kind": kind, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _new_job(kind: str, params: Dict, key: str, now: float) -> Dict:
+    return {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "params": params,
+        "dedup_key": key,
+        "status": PENDING,
+        "attempts": 0,
+        "result": None,
+        "error": None,
+        "run_after": now,
+        "lease_until": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+class MemoryJobStore:
+    """Jobs held in this process only; lost on restart and invisible to other workers."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, kind: str, params: Dict) -> Tuple[Dict, bool]:
+        key = dedup_key(kind, params)
+        now = time.time()
+        with self._lock:
+            for job in self._jobs.values():
+                if job["dedup_key"] == key and job["status"] in (PENDING, RUNNING):
+                    return dict(job), False
+            job = _new_job(kind, params, key, now)
+            self._jobs[job["id"]] = job
+            return dict(job), True
+
+    def claim(self) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            ready = [
+                job for job in self._jobs.values()
+                if (job["status"] == PENDING and job["run_after"] <= now)
+                or (job["status"] == RUNNING and job["lease_until"] < now)
+            ]
+            if not ready:
+                return None
+            job = min(ready, key=lambda job: job["run_after"])
+            job.update(status=RUNNING, attempts=job["attempts"] + 1,
+                       lease_until=now + LEASE_SECONDS, updated_at=now)
+            return dict(job)
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def purge(self, before: float) -> None:
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job["status"] in (SUCCEEDED, FAILED) and job["updated_at"] < before]:
+                del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """
+    Jobs kept in a SQLite file shared by every worker on the host. Claims run
+    in an immediate transaction, so a job is only ever handed to one worker.
+    """
+
+    COLUMNS = ("id", "kind", "params", "dedup_key", "status", "attempts", "result", "error",
+               "run_after", "lease_until", "created_at", "updated_at")
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, dedup_key TEXT NOT NULL, "
+                "status TEXT NOT NULL, attempts INTEGER NOT NULL, result TEXT, error TEXT, "
+                "run_after REAL NOT NULL, lease_until REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status)")
+
+    def _connect(self):
+        # Autocommit mode, so transactions are opened explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _to_job(self, row) -> Dict:
+        job = dict(zip(self.COLUMNS, row))
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def enqueue(self, kind: str, params: Dict) -> Tuple[Dict, bool]:
+        key = dedup_key(kind, params)
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE dedup_key = ? AND status IN (?, ?) LIMIT 1",
+                (key, PENDING, RUNNING),
+            ).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return self._to_job(row), False
+            job = _new_job(kind, params, key, time.time())
+            conn.execute(
+                f"INSERT INTO jobs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                tuple(json.dumps(job[column]) if column in ("params", "result") else job[column]
+                      for column in self.COLUMNS),
+            )
+            conn.execute("COMMIT")
+            return job, True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def claim(self) -> Optional[Dict]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs "
+                "WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_until < ?) "
+                "ORDER BY run_after LIMIT 1",
+                (PENDING, now, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            job = self._to_job(row)
+            job.update(status=RUNNING, attempts=job["attempts"] + 1,
+                       lease_until=now + LEASE_SECONDS, updated_at=now)
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                (RUNNING, job["attempts"], job["lease_until"], now, job["id"]),
+            )
+            conn.execute("COMMIT")
+            return job
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        conn = self._connect()
+        try:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        finally:
+            conn.close()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        finally:
+            conn.close()
+        return self._to_job(row) if row is not None else None
+
+    def purge(self, before: float) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (SUCCEEDED, FAILED, before))
+        finally:
+            conn.close()
+
+
+def make_store():
+    if os.getenv("JOB_QUEUE_BACKEND", "memory").lower() == "sqlite":
+        return SQLiteJobStore(os.getenv("JOB_QUEUE_PATH", os.path.join("cache", "jobs.sqlite3")))
+    return MemoryJobStore()
+
+
+# Job kind -> callable(params, job_id) returning the result to store
+_handlers: Dict[str, Callable[[Dict, str], Dict]] = {}
+
+
+def handler(kind: str):
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+class JobQueue:
+    """Runs queued jobs on a pool of daemon threads in this process."""
+
+    def __init__(self, store, workers: int = WORKERS):
+        self.store = store
+        self.workers = workers
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, kind: str, params: Dict) -> Tuple[Dict, bool]:
+        """Queue a job unless an identical one is pending or running. Returns (job, created)."""
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind {kind}")
+        self.start()
+        job, created = self.store.enqueue(kind, params)
+        if created:
+            self._wakeup.set()
+        return job, created
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        return self.store.get(job_id)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                job = self.store.claim()
+            except Exception as e:
+                print(f"Could not claim job: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            try:
+                self._execute(job)
+            except Exception as e:
+                # The lease runs out and another worker picks the job up again
+                print(f"Could not record outcome of job {job['id']}: {str(e)}")
+
+    def _execute(self, job: Dict) -> None:
+        try:
+            result = _handlers[job["kind"]](job["params"], job["id"])
+        except Exception as e:
+            if job["attempts"] < MAX_ATTEMPTS:
+                delay = RETRY_DELAY * 2 ** (job["attempts"] - 1)
+                print(f"Job {job['id']} failed, retrying in {delay:.1f}s: {str(e)}")
+                self.store.update(job["id"], status=PENDING, error=str(e), run_after=time.time() + delay)
+            else:
+                print(f"Job {job['id']} failed after {job['attempts']} attempts: {str(e)}")
+                self.store.update(job["id"], status=FAILED, error=str(e))
+        else:
+            self.store.update(job["id"], status=SUCCEEDED, result=result, error=None)
+        self.store.purge(time.time() - RETENTION_SECONDS)
+
+
+_queue = None
+_pid = os.getpid()
+_queue_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # Worker threads do not survive a fork; each process starts its own pool
+    global _queue, _pid, _queue_lock
+    _queue = None
+    _pid = os.getpid()
+    _queue_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_queue() -> JobQueue:
+    global _queue
+    if os.getpid() != _pid:
+        _reset_after_fork()
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue(make_store())
+    return _queue
+
+
+def start_workers() -> None:
+    """
+    Start this process's job threads without waiting for its first
+    submission, so jobs that a restart or a dead worker left in the SQLite
+    queue are picked up. Called from gunicorn's post_worker_init; an
+    in-memory queue starts empty, so it keeps starting on first use.
+    """
+    if os.getenv("JOB_QUEUE_BACKEND", "memory").lower() == "sqlite":
+        get_queue().start()
+
+
+def job_to_dict(job: Dict) -> Dict:
+    """Public view of a job for the API."""
+    def timestamp(value):
+        return datetime.fromtimestamp(value, timezone.utc).isoformat() if value else None
+
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": timestamp(job["created_at"]),
+        "updated_at": timestamp(job["updated_at"]),
+    }
+
+
+def _write_back(collection: str, document_id: Optional[str], field: str, result: Dict, job_id: str) -> None:
+    if not document_id:
+        return
+    import doc_cache
+    from db_config import get_db
+
+    ref = get_db().collection(collection).document(document_id)
+    ref.update({
+        field: dict(result, job_id=job_id, evaluated_at=datetime.now(timezone.utc).isoformat()),
+    })
+    doc_cache.invalidate(ref)
+
+
+@handler("evaluate_price")
+def _evaluate_price_job(params: Dict, job_id: str) -> Dict:
+    from services import evaluate_price
+
+    result = json.loads(evaluate_price(params["desc"], params["price"], params.get("seller"), params["image_urls"]))
+    if "error" in result:
+        raise JobError(result["error"])
+    _write_back("product", params.get("product_id"), "price_evaluation", result, job_id)
+    return result
+
+
+@handler("evaluate_condition")
+def _evaluate_condition_job(params: Dict, job_id: str) -> Dict:
+    import doc_cache
+    from db_config import get_db
+    from services import evaluate_condition
+
+    product_doc = doc_cache.get_document(get_db().collection("product").document(params["product_id"]))
+    if not product_doc.exists:
+        raise JobError(f"Product with id {params['product_id']} not found")
+    result = json.loads(evaluate_condition(product_doc.to_dict()["image_urls"]))
+    if "error" in result:
+        raise JobError(result["error"])
+    _write_back("product", params["product_id"], "condition_evaluation", result, job_id)
+    return result
+
+
+@handler("generate_location")
+def _generate_location_job(params: Dict, job_id: str) -> Dict:
+    from services import generate_location
+
+    result = json.loads(generate_location(params["lat1"], params["lon1"], params["lat2"], params["lon2"]))
+    _write_back("chat", params.get("chat_id"), "location_suggestions", result, job_id)
+    return result
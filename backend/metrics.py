@@ -0,0 +1,292 @@
+"""
+Prometheus instrumentation for the Flask app, Firestore and OpenAI calls.
+
+When PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py) every gunicorn
+worker writes its samples there and /metrics aggregates all of them;
+otherwise the metrics of the current process are served.
+"""
+import functools
+import os
+import threading
+import time
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess,
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request, until the response is returned",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "Requests handled, by response status", ["method", "route", "status"],
+)
+FIRESTORE_CALL_DURATION = Histogram(
+    "firestore_call_duration_seconds", "Firestore round trip time", ["operation"], buckets=LATENCY_BUCKETS,
+)
+FIRESTORE_CALLS = Counter(
+    "firestore_calls_total", "Firestore calls, by outcome", ["operation", "outcome"],
+)
+FIRESTORE_RETRIES = Counter(
+    "firestore_retries_total", "Firestore attempts that failed with a retryable error and were retried",
+    ["operation"],
+)
+OPENAI_CALL_DURATION = Histogram(
+    "openai_call_duration_seconds", "OpenAI call time including client-side retries",
+    ["model"], buckets=LATENCY_BUCKETS,
+)
+OPENAI_CALLS = Counter("openai_calls_total", "OpenAI calls, by outcome", ["model", "outcome"])
+OPENAI_RETRIES = Counter("openai_retries_total", "HTTP attempts beyond the first per OpenAI call", ["model"])
+OPENAI_TOKENS = Counter("openai_tokens_total", "Tokens reported by the OpenAI API", ["model", "kind"])
+OPENAI_IMAGES = Counter("openai_images_total", "Images sent to the OpenAI API", ["model"])
+IMAGE_BYTES = Counter(
+    "image_preprocess_bytes_total", "Listing photo sizes before and after preprocessing", ["stage"],
+)
+IMAGE_TOKENS = Counter(
+    "image_preprocess_tokens_total", "Estimated vision tokens before and after preprocessing", ["stage"],
+)
+IMAGES_PREPROCESSED = Counter(
+    "image_preprocess_total", "Photos sent to model calls, by thumbnail cache outcome", ["cache"],
+)
+DOC_CACHE_LOOKUPS = Counter(
+    "doc_cache_lookups_total", "Document reads through the cache, by outcome", ["collection", "outcome"],
+)
+DOC_CACHE_EVICTIONS = Counter(
+    "doc_cache_evictions_total", "Cached documents evicted to stay within the size limit", ["collection"],
+)
+DOC_CACHE_INVALIDATIONS = Counter(
+    "doc_cache_invalidations_total", "Cached documents dropped after a write, by source", ["collection", "source"],
+)
+RESPONSE_BYTES = Counter(
+    "http_response_compressed_bytes_total", "Sizes of compressed response bodies before and after encoding",
+    ["encoding", "stage"],
+)
+VALUATION_ESTIMATES = Counter(
+    "valuation_model_lookups_total", "Price checks tried against the local valuation model, by outcome", ["outcome"],
+)
+VALUATION_ESTIMATE_ERROR = Histogram(
+    "valuation_model_relative_error", "Relative error of local estimates against the model's later valuation",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.35, 0.5, 1),
+)
+AI_SINGLE_FLIGHT = Counter(
+    "ai_single_flight_calls_total", "AI calls by whether they ran or shared an identical call in flight",
+    ["name", "outcome"],
+)
+AI_ADMISSION = Counter(
+    "ai_admission_total", "Requests to the AI endpoints, admitted or rejected by admission control", ["outcome"],
+)
+STARTUP_DURATION = Gauge(
+    "app_startup_seconds", "Time spent in each startup phase of a worker", ["phase"],
+    multiprocess_mode="liveall",
+)
+
+
+def _route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else "<unmatched>"
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = _route_label()
+        HTTP_REQUEST_DURATION.labels(request.method, route).observe(time.perf_counter() - started)
+        HTTP_REQUESTS.labels(request.method, route, str(response.status_code)).inc()
+    return response
+
+
+# The Firestore operation running on this thread, so retries inside google.api_core can be attributed to it
+_firestore_operation = threading.local()
+
+
+def _timed(operation, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        outer = getattr(_firestore_operation, "name", None)
+        _firestore_operation.name = outer or operation
+        try:
+            result = fn(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            _firestore_operation.name = outer
+            FIRESTORE_CALL_DURATION.labels(operation).observe(time.perf_counter() - started)
+            FIRESTORE_CALLS.labels(operation, outcome).inc()
+    return wrapper
+
+
+def _counted_retry_target(retry_target):
+    # Every unary RPC with a google.api_core Retry goes through retry_target; on_error sees each retried failure
+    @functools.wraps(retry_target)
+    def wrapper(target, predicate, sleep_generator, timeout=None, on_error=None, **kwargs):
+        def count_retry(exc):
+            FIRESTORE_RETRIES.labels(getattr(_firestore_operation, "name", None) or "other").inc()
+            if on_error is not None:
+                on_error(exc)
+        return retry_target(target, predicate, sleep_generator, timeout=timeout, on_error=count_retry, **kwargs)
+    return wrapper
+
+
+def _counted_query_retry(fn):
+    # Query streams retry by themselves instead of through retry_target
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        retried = fn(*args, **kwargs)
+        if retried:
+            FIRESTORE_RETRIES.labels("query").inc()
+        return retried
+    return wrapper
+
+
+def _timed_stream(fn):
+    # Query results arrive lazily, so the call lasts until the stream is drained
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            for item in fn(*args, **kwargs):
+                yield item
+            outcome = "ok"
+        except GeneratorExit:
+            outcome = "ok"
+            raise
+        finally:
+            FIRESTORE_CALL_DURATION.labels("query").observe(time.perf_counter() - started)
+            FIRESTORE_CALLS.labels("query", outcome).inc()
+    return wrapper
+
+
+def instrument_firestore():
+    """Wrap the Firestore client's network calls with timing and retry metrics. Safe to call repeatedly."""
+    from google.api_core.retry import retry_unary
+    from google.cloud.firestore_v1 import client, document, query, batch
+
+    if getattr(document.DocumentReference.get, "_instrumented", False):
+        return
+    targets = [
+        (document.DocumentReference, "get", "document_get"),
+        (document.DocumentReference, "set", "document_set"),
+        (document.DocumentReference, "create", "document_create"),
+        (document.DocumentReference, "update", "document_update"),
+        (document.DocumentReference, "delete", "document_delete"),
+        (batch.WriteBatch, "commit", "batch_commit"),
+        (client.Client, "get_all", "get_all"),
+    ]
+    for cls, name, operation in targets:
+        wrapped = _timed(operation, getattr(cls, name))
+        wrapped._instrumented = True
+        setattr(cls, name, wrapped)
+
+    stream = _timed_stream(query.Query.stream)
+    stream._instrumented = True
+    query.Query.stream = stream
+
+    retry_unary.retry_target = _counted_retry_target(retry_unary.retry_target)
+    query.Query._retry_query_after_exception = _counted_query_retry(query.Query._retry_query_after_exception)
+
+
+def observe_openai_call(model, duration, response=None, messages=None, attempts=1, error=None):
+    """Observer registered with services.openai_client for every completion call."""
+    model = model or "unknown"
+    OPENAI_CALL_DURATION.labels(model).observe(duration)
+    OPENAI_CALLS.labels(model, "error" if error else "ok").inc()
+    if attempts > 1:
+        OPENAI_RETRIES.labels(model).inc(attempts - 1)
+
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        OPENAI_TOKENS.labels(model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+        OPENAI_TOKENS.labels(model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+    images = sum(
+        1 for message in messages or [] if isinstance(message.get("content"), list)
+        for part in message["content"] if part.get("type") == "image_url"
+    )
+    if images:
+        OPENAI_IMAGES.labels(model).inc(images)
+
+
+def observe_image(original_bytes, sent_bytes, original_tokens, sent_tokens, cached=False):
+    """Observer registered with services.images for every photo sent to a model."""
+    IMAGE_BYTES.labels("original").inc(original_bytes)
+    IMAGE_BYTES.labels("sent").inc(sent_bytes)
+    IMAGE_TOKENS.labels("original").inc(original_tokens)
+    IMAGE_TOKENS.labels("sent").inc(sent_tokens)
+    IMAGES_PREPROCESSED.labels("url" if cached is None else "hit" if cached else "miss").inc()
+
+
+def observe_doc_cache(event, collection, count=1, source=None):
+    """Observer registered with doc_cache for every cache event."""
+    if event == "eviction":
+        DOC_CACHE_EVICTIONS.labels(collection).inc(count)
+    elif event == "invalidation":
+        DOC_CACHE_INVALIDATIONS.labels(collection, source or "write").inc(count)
+    else:
+        DOC_CACHE_LOOKUPS.labels(collection, event).inc(count)
+
+
+def observe_compression(encoding, original_bytes, sent_bytes):
+    """Observer registered with compression for every compressed response."""
+    RESPONSE_BYTES.labels(encoding, "original").inc(original_bytes)
+    RESPONSE_BYTES.labels(encoding, "sent").inc(sent_bytes)
+
+
+def observe_valuation_estimate(outcome, error=None):
+    """Observer registered with services.valuation_model for every lookup and measured estimate."""
+    if outcome == "measured":
+        VALUATION_ESTIMATE_ERROR.observe(error)
+    else:
+        VALUATION_ESTIMATES.labels(outcome).inc()
+
+
+def observe_single_flight(name, outcome):
+    """Observer registered with services.single_flight for every coalesced call."""
+    AI_SINGLE_FLIGHT.labels(name, outcome).inc()
+
+
+def observe_admission(outcome):
+    """Observer registered with admission for every request to an AI endpoint."""
+    AI_ADMISSION.labels(outcome).inc()
+
+
+def record_startup(phase, seconds):
+    STARTUP_DURATION.labels(phase).set(seconds)
+
+
+def render_metrics():
+    """Return (body, content type) in the Prometheus text format."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_app(app):
+    import admission
+    import compression
+    import db_config
+    import doc_cache
+    from services import images, openai_client, single_flight, valuation_model
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    # Patch the Firestore classes only once a client is created, keeping the SDK import off the startup path
+    db_config.add_client_hook(lambda db: instrument_firestore())
+    openai_client.add_call_observer(observe_openai_call)
+    images.add_image_observer(observe_image)
+    doc_cache.add_cache_observer(observe_doc_cache)
+    compression.add_compression_observer(observe_compression)
+    valuation_model.add_estimate_observer(observe_valuation_estimate)
+    single_flight.add_flight_observer(observe_single_flight)
+    admission.add_admission_observer(observe_admission)
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+# bcrypt releases the GIL while hashing, so a small thread pool keeps the
+# work off the request thread without blocking other requests in the worker
+POOL_SIZE = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+# Requests wait at most this long for a free hashing slot before giving up
+QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", 5))
+TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", 250))
+# bcrypt.gensalt()'s default, so calibration can only raise the cost of new hashes
+MIN_ROUNDS = 12
+MAX_ROUNDS = 16
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when every hashing slot is taken for longer than QUEUE_TIMEOUT."""
+
+
+def calibrate_rounds(target_ms: float = TARGET_MS) -> int:
+    """Highest bcrypt cost whose hash time stays within target_ms on this machine."""
+    rounds = MIN_ROUNDS
+    salt = bcrypt.gensalt(rounds=rounds)
+    started = time.perf_counter()
+    bcrypt.hashpw(b"calibration", salt)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    # Each extra round doubles the cost
+    while rounds < MAX_ROUNDS and elapsed_ms * 2 <= target_ms:
+        rounds += 1
+        elapsed_ms *= 2
+    return rounds
+
+
+class PasswordHasher:
+    """Bounded executor for bcrypt hashing and verification."""
+
+    def __init__(self, pool_size: int = POOL_SIZE, rounds: int = None):
+        self.rounds = rounds or int(os.getenv("PASSWORD_HASH_ROUNDS", 0)) or calibrate_rounds()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="bcrypt")
+        # Caps queued plus running jobs so a login burst cannot grow the queue unbounded
+        self._slots = threading.BoundedSemaphore(pool_size * 4)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=QUEUE_TIMEOUT):
+            raise PasswordHasherBusy("Password hashing is overloaded, try again shortly")
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password: str) -> str:
+        hashed = self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds))
+        return hashed.decode('utf-8')
+
+    def verify(self, password: str, hashed: str) -> bool:
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed: str) -> bool:
+        # bcrypt hashes look like $2b$<rounds>$<salt+hash>
+        try:
+            return int(hashed.split("$")[2]) < self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+_hasher = None
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Executor threads do not survive a fork; the calibrated cost is kept
+    global _hasher, _lock
+    if _hasher is not None:
+        _hasher = PasswordHasher(rounds=_hasher.rounds)
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_hasher() -> PasswordHasher:
+    """Process-wide hasher; the bcrypt cost is calibrated once on first use."""
+    global _hasher
+    if _hasher is None:
+        with _lock:
+            if _hasher is None:
+                _hasher = PasswordHasher()
+                print(f"Password hashing calibrated to bcrypt cost {_hasher.rounds}")
+    return _hasher
@@ -0,0 +1,228 @@
+"""
+Geohash indexing of products for the nearby search.
+
+A product is placed at its seller's location unless it carries one of its
+own. Alongside the location it stores the location's geohash, so a nearby
+query becomes a handful of prefix range queries on one indexed string field
+(the cells covering the search circle) followed by an exact
+haversine check of the few documents they return.
+
+location_source records where the location came from: "product" for one
+given with the product, "seller" for one inherited from the seller. Only
+inherited locations follow the seller when they move. Products are listed
+publicly, so an inherited location is the centre of the seller's
+SELLER_GEOHASH_PRECISION cell rather than the point they logged in from.
+"""
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from batch_writes import commit_in_chunks
+from services import geohash
+
+# 9 characters is a cell of roughly 5m x 5m, finer than any radius a client asks for
+GEOHASH_PRECISION = 9
+MAX_RADIUS_KM = float(os.getenv("NEARBY_MAX_RADIUS_KM", 50))
+# Documents read per geohash cell, so a dense area cannot turn into a collection scan
+SCAN_LIMIT = int(os.getenv("NEARBY_SCAN_LIMIT", 500))
+# 6 characters is a cell of roughly 1.2km x 0.6km, which is all a listing reveals of where its seller is
+SELLER_GEOHASH_PRECISION = 6
+# Most prefix range queries one nearby search may run
+MAX_CELLS = 16
+# Sorts after every geohash character, closing the prefix range
+_PREFIX_END = "~"
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CELLS, thread_name_prefix="nearby-query")
+
+
+def coordinates(location) -> Optional[Tuple[float, float]]:
+    """(lat, lon) of a stored or client supplied location, or None if it has none."""
+    if not isinstance(location, dict):
+        return None
+    # User documents spell it "lattitude"; clients send "latitude"
+    lat = location.get("lattitude", location.get("latitude"))
+    lon = location.get("longitude")
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def geo_fields(location) -> Dict:
+    """The location fields to store on a product given its own location, or {} without a usable one."""
+    point = coordinates(location)
+    if point is None:
+        return {}
+    lat, lon = point
+    return {
+        "location": {"lattitude": lat, "longitude": lon},
+        "geohash": geohash.encode(lat, lon, GEOHASH_PRECISION),
+        "location_source": "product",
+    }
+
+
+def inherited_geo_fields(location) -> Dict:
+    """The location fields to store on a product placed at its seller's location, or {} without a usable one."""
+    point = coordinates(location)
+    if point is None:
+        return {}
+    lat, lon = geohash.decode(geohash.encode(*point, SELLER_GEOHASH_PRECISION))
+    return {
+        "location": {"lattitude": lat, "longitude": lon},
+        "geohash": geohash.encode(lat, lon, GEOHASH_PRECISION),
+        "location_source": "seller",
+    }
+
+
+def seller_geo_fields(db, seller) -> Dict:
+    if not seller:
+        return {}
+    import doc_cache
+
+    user_doc = doc_cache.get_document(db.collection("user").document(str(seller).lower()))
+    if not user_doc.exists:
+        return {}
+    return inherited_geo_fields((user_doc.to_dict() or {}).get("location"))
+
+
+def sellers_geo_fields(db, sellers) -> Dict:
+    """seller_geo_fields for several sellers with a single read."""
+    refs = {str(seller).lower(): db.collection("user").document(str(seller).lower()) for seller in sellers if seller}
+    found = {}
+    if refs:
+        for user_doc in db.get_all(list(refs.values()), field_paths=["location"]):
+            if user_doc.exists:
+                found[user_doc.id] = inherited_geo_fields((user_doc.to_dict() or {}).get("location"))
+    return {seller: found.get(str(seller).lower(), {}) for seller in sellers if seller}
+
+
+def inherits_location(product: Dict, seller_location=None) -> bool:
+    """
+    Whether a product is placed at its seller's location. Products stored
+    before location_source existed count as inherited when they sit at the
+    seller's previous location, exactly or at its cell centre.
+    """
+    source = product.get("location_source")
+    if source is not None:
+        return source == "seller"
+    if "geohash" not in product:
+        return True
+    previous = [fields.get("geohash") for fields in (geo_fields(seller_location), inherited_geo_fields(seller_location))]
+    return product.get("geohash") in previous
+
+
+def relocate_seller_products(db, seller: str, location, previous_location=None) -> int:
+    """
+    Move the products of a seller that inherit their location to the seller's
+    new location; products with a location of their own stay where they are.
+    previous_location identifies inherited products stored before
+    location_source existed. Returns the number updated.
+    """
+    from firebase_admin import firestore
+
+    fields = inherited_geo_fields(location)
+    if not fields:
+        return 0
+    query = db.collection("product").where(filter=firestore.FieldFilter("seller", "==", seller))
+    writes = []
+    for doc in query.select(["geohash", "location_source"]).stream():
+        product = doc.to_dict() or {}
+        if inherits_location(product, previous_location) and (
+                product.get("geohash") != fields["geohash"] or product.get("location_source") != "seller"):
+            writes.append((doc.reference, "update", fields))
+    errors = commit_in_chunks(db, writes)
+    return sum(1 for error in errors if error is None)
+
+
+def _grid(precision: int) -> Tuple[float, float]:
+    """(lat, lon) size in degrees of a cell at the given precision."""
+    lat_bits = (precision * 5) // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** (precision * 5 - lat_bits)
+
+
+def _covering(lat: float, lon: float, radius_km: float, precision: int) -> Optional[List[str]]:
+    """
+    The cells of one precision that intersect the circle around (lat, lon),
+    or None when the circle's bounding box spans too many of them to check.
+    """
+    dlat = math.degrees(radius_km / geohash.EARTH_RADIUS_KM)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    min_lon, max_lon = lon - dlon, lon + dlon
+    wraps = min_lon < -180 or max_lon > 180
+
+    lat_step, lon_step = _grid(precision)
+    rows = range(math.floor((min_lat + 90) / lat_step), math.floor((max_lat + 90) / lat_step) + 1)
+    cols = range(math.floor((min_lon + 180) / lon_step), math.floor((max_lon + 180) / lon_step) + 1)
+    if len(rows) * len(cols) > 4 * MAX_CELLS:
+        return None
+
+    cells = []
+    for row in rows:
+        cell_min_lat = min(row * lat_step - 90, 90 - lat_step)
+        for col in cols:
+            cell_min_lon = col * lon_step - 180
+            if not wraps:
+                # Nearest point of the cell to the centre; skip the cell if even that is too far
+                near_lat = min(max(lat, cell_min_lat), cell_min_lat + lat_step)
+                near_lon = min(max(lon, cell_min_lon), cell_min_lon + lon_step)
+                if geohash.haversine_km(lat, lon, near_lat, near_lon) > radius_km:
+                    continue
+            center_lon = (cell_min_lon + lon_step / 2 + 180) % 360 - 180
+            cell = geohash.encode(cell_min_lat + lat_step / 2, center_lon, precision)
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+def cells_for_radius(lat: float, lon: float, radius_km: float) -> List[str]:
+    """
+    The geohash cells to query for the circle around (lat, lon): the finest
+    covering of at most MAX_CELLS cells, so each query reads as little
+    outside the circle as possible.
+    """
+    best = _covering(lat, lon, radius_km, 1)
+    for precision in range(2, GEOHASH_PRECISION + 1):
+        cells = _covering(lat, lon, radius_km, precision)
+        if cells is None or len(cells) > MAX_CELLS:
+            break
+        best = cells
+    return best
+
+
+def _scan_cell(db, cell: str, fields: Optional[List[str]]):
+    from firebase_admin import firestore
+
+    query = (db.collection("product")
+             .where(filter=firestore.FieldFilter("geohash", ">=", cell))
+             .where(filter=firestore.FieldFilter("geohash", "<", cell + _PREFIX_END))
+             .order_by("geohash"))
+    if fields:
+        query = query.select(sorted(set(fields) | {"location"}))
+    return list(query.limit(SCAN_LIMIT).stream())
+
+
+def nearby(db, lat: float, lon: float, radius_km: float, fields: Optional[List[str]] = None) -> Tuple[List, bool]:
+    """
+    Products within radius_km of (lat, lon) as (distance_km, doc) pairs,
+    nearest first. The second value is True when a cell held more than
+    SCAN_LIMIT products, in which case some of its products were not considered.
+    """
+    cells = cells_for_radius(lat, lon, radius_km)
+    results = []
+    truncated = False
+    for docs in _executor.map(lambda cell: _scan_cell(db, cell, fields), cells):
+        truncated = truncated or len(docs) >= SCAN_LIMIT
+        for doc in docs:
+            point = coordinates((doc.to_dict() or {}).get("location"))
+            if point is None:
+                continue
+            distance = geohash.haversine_km(lat, lon, *point)
+            if distance <= radius_km:
+                results.append((distance, doc))
+    results.sort(key=lambda item: (item[0], item[1].id))
+    return results, truncated
@@ -6,6 +6,8 @@ from .user import user_bp
 from .service import service_bp
 from .product import product_bp
 from .stripe import stripe_bp
+from .metrics import metrics_bp
+from .job import job_bp
 
 # Define a function to register Blueprints
 def register_blueprints(app):
@@ -13,4 +15,6 @@ def register_blueprints(app):
     app.register_blueprint(chat_bp, url_prefix="/api")
     app.register_blueprint(product_bp, url_prefix="/api")
     app.register_blueprint(stripe_bp, url_prefix="/api")
-    app.register_blueprint(service_bp, url_prefix="/api")
\ No newline at end of file
+    app.register_blueprint(service_bp, url_prefix="/api")
+    app.register_blueprint(job_bp, url_prefix="/api")
+    app.register_blueprint(metrics_bp)
\ No newline at end of file
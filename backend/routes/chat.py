@@ -1,37 +1,235 @@
+import queue
+import time
+from collections import OrderedDict
 from datetime import datetime
 from flask import Blueprint, jsonify, request
-from db_config import get_db
-from firebase_admin import firestore
-from utils import generate_otp_token
+from db_config import db
+from utils import generate_otp_token, ndjson_response, encode_page_token, decode_page_token, sse_event, sse_response
+import chat_events
+import batch_writes
+import doc_cache
+import http_cache
 
 chat_bp = Blueprint("chat", __name__)
 
-db = get_db()
+def _chat_to_dict(doc):
+    chat_data = doc.to_dict()
+    chat_data['chat_id'] = doc.id
+    return chat_data
 
 # Get all chats
 @chat_bp.route("/chats", methods=["GET"])
 def get_all_chats():
+    validators = http_cache.collection_validators("chat")
+    if not http_cache.is_modified(validators):
+        return http_cache.not_modified(validators)
+
+    # ?format=ndjson streams one chat per line instead of building the whole list
+    if request.args.get("format") == "ndjson":
+        return http_cache.with_validators(
+            ndjson_response(_chat_to_dict(doc) for doc in db.collection("chat").stream()), validators)
+
     chats = []
     chat_docs = db.collection("chat").get()
     
     for doc in chat_docs:
-        chat_data = doc.to_dict()
-        chat_data['chat_id'] = doc.id
-        chats.append(chat_data)
+        chats.append(_chat_to_dict(doc))
     
-    return jsonify(chats), 200
+    return http_cache.with_validators(jsonify(chats), validators), 200
+
+DEFAULT_MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+
+
+def _message_to_dict(doc):
+    message_data = doc.to_dict()
+    message_data['message_id'] = doc.id
+    return message_data
+
+
+def _message_cursor(doc):
+    return encode_page_token([doc.get("timestamp").isoformat(), doc.id])
+
+
+def _decode_message_cursor(token):
+    """The (timestamp, message_id) of a cursor from _message_cursor; raises ValueError when malformed."""
+    values = decode_page_token(token)
+    if len(values) != 2 or not all(isinstance(value, str) for value in values) or "/" in values[1] or not values[1]:
+        raise ValueError("Malformed message cursor")
+    return datetime.fromisoformat(values[0]), values[1]
+
+
+def _get_messages_page(chat_ref, page_size, before=None, after=None):
+    """
+    Read one page of a chat's messages subcollection, oldest first.
+    Without a cursor the newest page is returned; `before` pages back in
+    history and `after` returns messages newer than the cursor.
+    """
+    from firebase_admin import firestore
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    messages_ref = chat_ref.collection("messages")
+    cursor_token = after or before
+    newest_first = after is None
+
+    direction = firestore.Query.DESCENDING if newest_first else firestore.Query.ASCENDING
+    query = (messages_ref
+             .order_by("timestamp", direction=direction)
+             .order_by(FieldPath.document_id(), direction=direction))
+
+    if cursor_token:
+        timestamp, message_id = _decode_message_cursor(cursor_token)
+        query = query.start_after({
+            "timestamp": timestamp,
+            "__name__": messages_ref.document(message_id),
+        })
+
+    docs = list(query.limit(page_size).stream())
+    if newest_first:
+        docs.reverse()
+    return docs
 
 # Get chat by id
 @chat_bp.route("/chats/<chat_id>", methods=["GET"])
 def get_chat(chat_id):
     chat_ref = db.collection("chat").document(chat_id)
-    chat_doc = chat_ref.get()
+    chat_doc = doc_cache.get_document(chat_ref)
     
-    if chat_doc.exists:
-        return jsonify(chat_doc.to_dict()), 200
-    else:
+    if not chat_doc.exists:
         return jsonify({"error": f"Chat with id {chat_id} not found"}), 404
 
+    # New messages also update the chat document, so its update_time covers ?recent
+    validators = http_cache.document_validators(chat_doc)
+    if not http_cache.is_modified(validators):
+        return http_cache.not_modified(validators)
+
+    chat_data = chat_doc.to_dict()
+
+    # ?recent=N embeds the newest N messages for clients that render the chat in one call
+    recent = min(request.args.get("recent", 0, type=int), MAX_MESSAGE_PAGE_SIZE)
+    if recent > 0:
+        docs = _get_messages_page(chat_ref, recent)
+        # Chats that have not been migrated yet still carry the legacy array
+        messages = chat_data.get("messages", []) + [_message_to_dict(doc) for doc in docs]
+        chat_data["messages"] = messages[-recent:]
+
+    return http_cache.with_validators(jsonify(chat_data), validators), 200
+
+# Get a page of chat history
+@chat_bp.route("/chats/<chat_id>/messages", methods=["GET"])
+def get_messages(chat_id):
+    """
+    Page through a chat's messages, returned oldest first.
+    Query parameters: page_size, and at most one of `before` / `after`,
+    which take the cursors returned by a previous call.
+    """
+    before = request.args.get("before")
+    after = request.args.get("after")
+    if before and after:
+        return jsonify({"error": "Use either 'before' or 'after', not both"}), 400
+
+    page_size = request.args.get("page_size", DEFAULT_MESSAGE_PAGE_SIZE, type=int)
+    page_size = max(1, min(page_size, MAX_MESSAGE_PAGE_SIZE))
+
+    chat_ref = db.collection("chat").document(chat_id)
+    try:
+        docs = _get_messages_page(chat_ref, page_size, before=before, after=after)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    return jsonify({
+        "messages": [_message_to_dict(doc) for doc in docs],
+        # Pass `before` to load older history and `after` to poll for new messages
+        "before": _message_cursor(docs[0]) if docs else before,
+        "after": _message_cursor(docs[-1]) if docs else after,
+    }), 200
+
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 3000
+# A stream ends after this long and the client reconnects with Last-Event-ID, so no thread is held indefinitely
+SSE_MAX_STREAM_SECONDS = 300
+# Ids of recently sent messages, remembered to drop a replayed message that the listener also delivers
+SSE_SENT_IDS = 2 * MAX_MESSAGE_PAGE_SIZE
+
+
+def _holds_whole_worker():
+    """True under a gunicorn sync worker, where an open stream would block every other request."""
+    return (request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn")
+            and not request.environ.get("wsgi.multithread"))
+
+
+# Live chat updates as Server-Sent Events
+@chat_bp.route("/chats/<chat_id>/events", methods=["GET"])
+def stream_chat_events(chat_id):
+    """
+    Push new messages ("message" events) and changes to the meetup and otp
+    fields ("meetup" / "otp" events) as they happen. Message events carry an
+    id, so a reconnecting client that sends Last-Event-ID first receives
+    every message it missed, or a "missed" event with the cursor to page
+    forward from when more than a page was missed. One set of Firestore
+    listeners per chat is shared by all subscribers in the worker.
+    """
+    if _holds_whole_worker():
+        error = "Live updates need threaded workers, poll /messages?after= instead"
+        return jsonify({"error": error}), 503, {"Retry-After": str(SSE_RETRY_MS // 1000)}
+
+    chat_ref = db.collection("chat").document(chat_id)
+    chat_doc = chat_ref.get()
+    if not chat_doc.exists:
+        return jsonify({"error": f"Chat with id {chat_id} not found"}), 404
+
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    if last_event_id:
+        try:
+            _decode_message_cursor(last_event_id)
+        except ValueError:
+            return jsonify({"error": "Invalid Last-Event-ID"}), 400
+
+    def generate():
+        subscriber = chat_events.subscribe(db, chat_id, chat_doc.to_dict())
+        sent = OrderedDict()
+
+        def send_message(doc):
+            sent[doc.id] = None
+            if len(sent) > SSE_SENT_IDS:
+                sent.popitem(last=False)
+            return sse_event("message", _message_to_dict(doc), _message_cursor(doc))
+
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+
+            # Resume: replay missed messages, then the current state
+            if last_event_id:
+                docs = _get_messages_page(chat_ref, MAX_MESSAGE_PAGE_SIZE + 1, after=last_event_id)
+                for doc in docs[:MAX_MESSAGE_PAGE_SIZE]:
+                    yield send_message(doc)
+                if len(docs) > MAX_MESSAGE_PAGE_SIZE:
+                    # Too many to replay; the client pages through the rest with GET /messages?after=
+                    yield sse_event("missed", {"after": _message_cursor(docs[MAX_MESSAGE_PAGE_SIZE - 1])})
+            for field in chat_events.WATCHED_FIELDS:
+                yield sse_event(field, subscriber.state.get(field))
+
+            deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+            while not subscriber.closed and time.monotonic() < deadline:
+                try:
+                    event = subscriber.get(timeout=min(SSE_HEARTBEAT_SECONDS, max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if event is None:
+                    break
+                kind, payload = event
+                if kind == "message":
+                    if payload.id in sent:
+                        continue
+                    yield send_message(payload)
+                else:
+                    yield sse_event(kind, payload)
+        finally:
+            chat_events.unsubscribe(chat_id, subscriber)
+
+    return sse_response(generate())
+
 # Add message to a specific chat
 @chat_bp.route("/chats/<chat_id>/message", methods=["PATCH"])
 def add_message(chat_id):
@@ -42,16 +240,31 @@ def add_message(chat_id):
     if "sender" not in message_data or "text" not in message_data:
         return jsonify({"error": "Missing required fields: 'sender' and 'text'"}), 400
 
-    if "time" not in message_data:
-        message_data["timestamp"] = datetime.utcnow()
+    from firebase_admin import firestore
+
+    # Messages are ordered by timestamp in the subcollection, so it is always set by the server
+    message_data["timestamp"] = datetime.utcnow()
 
     chat_ref = db.collection("chat").document(chat_id)
-    
+    message_ref = chat_ref.collection("messages").document()
+
+    # Store the message in its own document and keep only a summary on the chat
+    batch = db.batch()
+    batch.set(message_ref, message_data)
+    batch.update(chat_ref, {
+        "last_message": {
+            "message_id": message_ref.id,
+            "sender": message_data["sender"],
+            "text": message_data["text"],
+            "timestamp": message_data["timestamp"],
+        },
+        "message_count": firestore.Increment(1),
+    })
+
     try:
-        chat_ref.update({
-            "messages": firestore.ArrayUnion([message_data])
-        })
-        return jsonify({"message": "New message added successfully"}), 200
+        batch.commit()
+        doc_cache.invalidate(chat_ref)
+        return jsonify({"message": "New message added successfully", "message_id": message_ref.id}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -79,6 +292,7 @@ def agree_meetup(chat_id):
     chat_ref = db.collection("chat").document(chat_id)
     try:
         chat_ref.update(update_payload)
+        doc_cache.invalidate(chat_ref)
         return jsonify({
             "message": "Meetup agreed and document updated successfully.",
             "otp_token": otp_token  # Return OTP for reference (e.g., to send to the buyer)
@@ -98,7 +312,8 @@ def create_chat():
             "price": "",
             "time": ""
         },
-        "messages": [],
+        "last_message": None,
+        "message_count": 0,
         "otp": {
             "confirmed": False,
             "token": ""
@@ -107,16 +322,12 @@ def create_chat():
 
     chat_ref = db.collection("chat").document()
     chat_ref.set(chat_data)
+    # Moves the chat list's version on before the listener reports the new chat
+    doc_cache.invalidate(chat_ref)
 
     return jsonify({"message": "Chat created successfully", "chat_id": chat_ref.id}), 201
 
-# Update chat
-@chat_bp.route('/chats/<chat_id>', methods=['PATCH'])
-def update_chat(chat_id):
-    data = request.get_json()
-    if not data:
-        return jsonify({"error": "No chat data provided"}), 400
-    
+def _chat_update_payload(data):
     update_payload = {}
 
     for field in data.keys():
@@ -128,14 +339,61 @@ def update_chat(chat_id):
         update_payload["otp.token"] = otp_token
         update_payload["otp.confirmed"] = False
 
+    return update_payload
+
+# Update chat
+@chat_bp.route('/chats/<chat_id>', methods=['PATCH'])
+def update_chat(chat_id):
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "No chat data provided"}), 400
+    
+    update_payload = _chat_update_payload(data)
+
     chat_ref = db.collection("chat").document(chat_id)
     
     try:
         chat_ref.update(update_payload)
+        doc_cache.invalidate(chat_ref)
         return jsonify({"message": "Chat information updated successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Update many chats in one request
+@chat_bp.route('/chats:batchUpdate', methods=['PATCH'])
+def batch_update_chats():
+    """
+    Expects {"updates": [{"chat_id": ..., "fields": {...}}, ...]}, each
+    applied like PATCH /chats/<chat_id>. The response holds one result per
+    item, in request order: {"index", "status": 200, "chat_id"} or
+    {"index", "status", "error"}; a missing chat fails only its own item.
+    """
+    items, error = batch_writes.parse_items(request.get_json(silent=True), "updates")
+    if error:
+        return jsonify({"error": error}), 400
+
+    results = [None] * len(items)
+    writes, indexes = [], []
+    for index, item in enumerate(items):
+        chat_id = item.get("chat_id") if isinstance(item, dict) else None
+        fields = item.get("fields") if isinstance(item, dict) else None
+        if not isinstance(chat_id, str) or not chat_id or "/" in chat_id:
+            results[index] = {"index": index, "status": 400, "error": "'chat_id' is required"}
+            continue
+        if not isinstance(fields, dict) or not fields:
+            results[index] = {"index": index, "status": 400, "error": "No chat data provided"}
+            continue
+        writes.append((db.collection("chat").document(chat_id), "update", _chat_update_payload(fields)))
+        indexes.append(index)
+
+    for index, (chat_ref, _, _), error in zip(indexes, writes, batch_writes.commit_in_chunks(db, writes)):
+        if error:
+            results[index] = dict(error, index=index, chat_id=chat_ref.id)
+        else:
+            results[index] = {"index": index, "status": 200, "chat_id": chat_ref.id}
+
+    return jsonify(batch_writes.summarize(results)), 200
+
 @chat_bp.route('/chats/<chat_id>/confirm-otp', methods=['PATCH'])
 def confirm_otp(chat_id):
     data = request.get_json()
@@ -143,7 +401,8 @@ def confirm_otp(chat_id):
         return jsonify({"error": "No OTP provided"}), 400
 
     chat_ref = db.collection("chat").document(chat_id)
-    chat_doc = chat_ref.get()
+    # Checked against the stored token, never a cached copy
+    chat_doc = doc_cache.get_document(chat_ref, fresh=True)
 
     if not chat_doc.exists:
         return jsonify({"error": f"Chat with id {chat_id} not found"}), 404
@@ -153,6 +412,7 @@ def confirm_otp(chat_id):
         chat_ref.update({
             "otp.confirmed": True
         })
+        doc_cache.invalidate(chat_ref)
         return jsonify({"message": "OTP confirmed successfully"}), 200
     else:
         return jsonify({"error": "Invalid OTP"}), 400
\ No newline at end of file
@@ -0,0 +1,12 @@
+from flask import Blueprint, jsonify
+from jobs import get_queue, job_to_dict
+
+job_bp = Blueprint("job", __name__)
+
+# Get the status, and once finished the result, of a background job
+@job_bp.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = get_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job with id {job_id} not found"}), 404
+    return jsonify(job_to_dict(job)), 200
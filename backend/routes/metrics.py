@@ -0,0 +1,10 @@
+from flask import Blueprint
+from metrics import render_metrics
+
+metrics_bp = Blueprint("metrics", __name__)
+
+# Prometheus scrape endpoint, aggregated across gunicorn workers
+@metrics_bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    body, content_type = render_metrics()
+    return body, 200, {"Content-Type": content_type}
@@ -1,34 +1,257 @@
 from datetime import datetime
 from flask import Blueprint, jsonify, request
-from db_config import get_db
-from firebase_admin import firestore
-from utils import generate_otp_token
+from db_config import db
+from utils import generate_otp_token, ndjson_response, encode_page_token, decode_page_token, parse_price
+import search_index
+import product_geo
+import batch_writes
+import doc_cache
+import http_cache
 
 product_bp = Blueprint("product", __name__)
 
-db = get_db()
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def _build_product_query(args, fields):
+    """
+    Push the filters, projection and ordering from the query string down into
+    Firestore. Returns the query and the field paths it is ordered by, which
+    are also the values stored in the page token.
+    """
+    from firebase_admin import firestore
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    query = db.collection("product")
+    order_keys = []
+
+    seller = args.get("seller")
+    if seller:
+        query = query.where(filter=firestore.FieldFilter("seller", "==", seller))
+
+    category = args.get("category")
+    if category:
+        query = query.where(filter=firestore.FieldFilter("category", "==", category))
+
+    price_min = args.get("price_min", type=float)
+    price_max = args.get("price_max", type=float)
+    if price_min is not None:
+        query = query.where(filter=firestore.FieldFilter("price", ">=", price_min))
+    if price_max is not None:
+        query = query.where(filter=firestore.FieldFilter("price", "<=", price_max))
+    if price_min is not None or price_max is not None:
+        # Range filters require the first ordering to be on the same field
+        query = query.order_by("price")
+        order_keys.append("price")
+
+    query = query.order_by(FieldPath.document_id())
+
+    if fields:
+        query = query.select(sorted(set(fields) | set(order_keys)))
+
+    return query, order_keys
+
+
+def _normalize_price(product_data):
+    """
+    Store a given price as a number, as Firestore range filters never match
+    values of another type. Returns an error message when it is not one.
+    """
+    if "price" not in product_data:
+        return None
+    price = parse_price(product_data["price"])
+    if price is None:
+        return "price must be a number"
+    product_data["price"] = price
+    return None
+
+def _product_to_dict(doc, fields):
+    product_data = doc.to_dict()
+    if fields:
+        product_data = {k: v for k, v in product_data.items() if k in fields}
+    product_data['product_id'] = doc.id
+    return product_data
+
+def _geo_update(update_payload, product, seller_geo=None):
+    """
+    Fields that keep the geohash in step with where an updated product now
+    is. product holds the stored location fields; a new seller only moves a
+    product that inherits its location.
+    """
+    if "location" in update_payload:
+        return product_geo.geo_fields(update_payload["location"])
+    if "seller" in update_payload and product_geo.inherits_location(product):
+        if seller_geo is not None:
+            return seller_geo.get(update_payload["seller"], {})
+        return product_geo.seller_geo_fields(db, update_payload["seller"])
+    return {}
 
 # Get products
 @product_bp.route("/products", methods=["GET"])
 def get_all_products():
+    """
+    List products. Supports the following query parameters:
+    - seller, category: equality filters
+    - price_min, price_max: numeric price range. Only products whose price
+      is stored as a number match, see scripts/backfill_product_price.py
+    - fields: comma separated list of fields to return
+    - page_size, page_token: cursor pagination. When either is given the
+      response is {"products": [...], "next_page_token": ...} instead of a list.
+    - format=ndjson: stream every matching product as one JSON line each
+    """
+    # Taken before the query, so a concurrent write can only make the ETag older than the body
+    validators = http_cache.collection_validators("product")
+    if not http_cache.is_modified(validators):
+        return http_cache.not_modified(validators)
+
+    fields = [f.strip() for f in request.args.get("fields", "").split(",") if f.strip()]
+    paginated = "page_size" in request.args or "page_token" in request.args
+
+    query, order_keys = _build_product_query(request.args, fields)
+
+    if request.args.get("format") == "ndjson":
+        return http_cache.with_validators(
+            ndjson_response(_product_to_dict(doc, fields) for doc in query.stream()), validators)
+
+    if paginated:
+        page_size = request.args.get("page_size", DEFAULT_PAGE_SIZE, type=int)
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+
+        page_token = request.args.get("page_token")
+        if page_token:
+            try:
+                values = decode_page_token(page_token)
+            except ValueError:
+                return jsonify({"error": "Invalid page token"}), 400
+            if len(values) != len(order_keys) + 1:
+                return jsonify({"error": "Page token does not match the query filters"}), 400
+            if not isinstance(values[-1], str) or not values[-1] or "/" in values[-1]:
+                return jsonify({"error": "Invalid page token"}), 400
+            if any(isinstance(value, bool) or not isinstance(value, (int, float)) for value in values[:-1]):
+                return jsonify({"error": "Invalid page token"}), 400
+            cursor = dict(zip(order_keys, values[:-1]))
+            cursor["__name__"] = db.collection("product").document(values[-1])
+            query = query.start_after(cursor)
+
+        query = query.limit(page_size)
+
     products = []
-    product_docs = db.collection("product").get()
-    
-    for doc in product_docs:
-        product_data = doc.to_dict()
-        product_data['product_id'] = doc.id
-        products.append(product_data)
-    
-    return jsonify(products), 200
+    last_doc = None
+    for doc in query.stream():
+        products.append(_product_to_dict(doc, fields))
+        last_doc = doc
+
+    if not paginated:
+        return http_cache.with_validators(jsonify(products), validators), 200
+
+    next_page_token = None
+    if last_doc is not None and len(products) == page_size:
+        values = [last_doc.get(key) for key in order_keys] + [last_doc.id]
+        next_page_token = encode_page_token(values)
+
+    response = jsonify({"products": products, "next_page_token": next_page_token})
+    return http_cache.with_validators(response, validators), 200
+
+# Search products by text with facets, served from this worker's in-memory index
+@product_bp.route("/products/search", methods=["GET"])
+def search_products():
+    """
+    Query parameters:
+    - q: words to match in the title, description, category and storage
+    - seller, category, condition, price_min, price_max: filters
+    - sort: relevance (default), price_asc or price_desc
+    - page_size, page_token: pagination
+    """
+    page_size = request.args.get("page_size", DEFAULT_PAGE_SIZE, type=int)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    offset = 0
+    page_token = request.args.get("page_token")
+    if page_token:
+        try:
+            (offset,) = decode_page_token(page_token)
+        except ValueError:
+            return jsonify({"error": "Invalid page token"}), 400
+        if not isinstance(offset, int) or offset < 0:
+            return jsonify({"error": "Invalid page token"}), 400
+
+    sort = request.args.get("sort", "relevance")
+    if sort not in ("relevance", "price_asc", "price_desc"):
+        return jsonify({"error": "sort must be relevance, price_asc or price_desc"}), 400
+
+    filters = {
+        "seller": request.args.get("seller"),
+        "category": request.args.get("category"),
+        "condition": request.args.get("condition"),
+        "price_min": request.args.get("price_min", type=float),
+        "price_max": request.args.get("price_max", type=float),
+    }
+    result = search_index.get_search().index.search(
+        request.args.get("q", ""), filters, sort=sort, offset=offset, limit=page_size,
+    )
+
+    next_offset = offset + len(result["products"])
+    result["next_page_token"] = encode_page_token([next_offset]) if next_offset < result["total"] else None
+    return jsonify(result), 200
+
+# Get products near a point, nearest first
+@product_bp.route("/products/nearby", methods=["GET"])
+def get_nearby_products():
+    """
+    Query parameters:
+    - lat, lon: the point to search around
+    - radius_km: search radius, at most NEARBY_MAX_RADIUS_KM (default 5)
+    - fields: comma separated list of fields to return
+    - page_size, page_token: pagination
+    Each product carries its distance_km. truncated is true when an area had
+    more listings than a single query reads, so some of them were skipped.
+    """
+    lat = request.args.get("lat", type=float)
+    lon = request.args.get("lon", type=float)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({"error": "lat and lon must be valid coordinates"}), 400
+    radius_km = request.args.get("radius_km", 5.0, type=float)
+    if not 0 < radius_km <= product_geo.MAX_RADIUS_KM:
+        return jsonify({"error": f"radius_km must be between 0 and {product_geo.MAX_RADIUS_KM:g}"}), 400
+
+    fields = [f.strip() for f in request.args.get("fields", "").split(",") if f.strip()]
+    page_size = request.args.get("page_size", DEFAULT_PAGE_SIZE, type=int)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    cursor = None
+    page_token = request.args.get("page_token")
+    if page_token:
+        try:
+            cursor = decode_page_token(page_token)
+        except ValueError:
+            return jsonify({"error": "Invalid page token"}), 400
+        if len(cursor) != 2 or not isinstance(cursor[0], (int, float)) or not isinstance(cursor[1], str):
+            return jsonify({"error": "Invalid page token"}), 400
+
+    results, truncated = product_geo.nearby(db, lat, lon, radius_km, fields)
+    if cursor is not None:
+        # Results are ordered by (distance, id), so resume after the last one returned
+        results = [(distance, doc) for distance, doc in results if (distance, doc.id) > tuple(cursor)]
+
+    page = results[:page_size]
+    products = [dict(_product_to_dict(doc, fields), distance_km=round(distance, 3)) for distance, doc in page]
+    next_page_token = None
+    if len(results) > page_size:
+        distance, doc = page[-1]
+        next_page_token = encode_page_token([distance, doc.id])
+
+    return jsonify({"products": products, "next_page_token": next_page_token, "truncated": truncated}), 200
 
 # Get product by id
 @product_bp.route("/products/<product_id>", methods=["GET"])
 def get_product(product_id):
     product_ref = db.collection("product").document(product_id)
-    product_doc = product_ref.get()
+    product_doc = doc_cache.get_document(product_ref)
     
     if product_doc.exists:
-        return jsonify(product_doc.to_dict()), 200
+        validators = http_cache.document_validators(product_doc)
+        if not http_cache.is_modified(validators):
+            return http_cache.not_modified(validators)
+        return http_cache.with_validators(jsonify(product_doc.to_dict()), validators), 200
     else:
         return jsonify({"error": f"Chat with id {product_id} not found"}), 404
 
@@ -44,10 +267,20 @@ def update_product(product_id):
     for field in data.keys():
         update_payload[field] = data.get(field)
 
+    error = _normalize_price(update_payload)
+    if error:
+        return jsonify({"error": error}), 400
+
     product_ref = db.collection("product").document(product_id)
+    product = {}
+    if "seller" in update_payload and "location" not in update_payload:
+        product = doc_cache.get_document(product_ref).to_dict() or {}
+    update_payload.update(_geo_update(update_payload, product))
     
     try:
         product_ref.update(update_payload)
+        doc_cache.invalidate(product_ref)
+        search_index.update_indexed_product(product_id, update_payload)
         return jsonify({"message": "Product information updated successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -55,8 +288,113 @@ def update_product(product_id):
 @product_bp.route('/products', methods=['POST'])
 def create_chat():
     product_data = request.get_json()
+    if not product_data:
+        return jsonify({"error": "No product data provided"}), 400
+    error = _normalize_price(product_data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Index the product at its own location if it has one, otherwise at the seller's
+    geo = product_geo.geo_fields(product_data.get("location"))
+    product_data.update(geo or product_geo.seller_geo_fields(db, product_data.get("seller")))
 
     product_ref = db.collection("product").document()
     product_ref.set(product_data)
+    doc_cache.invalidate(product_ref)
+    search_index.index_product(product_ref.id, product_data)
+
+    return jsonify({"message": "Product created successfully", "product_id": product_ref.id}), 201
+
+# Create many products in one request
+@product_bp.route('/products:batchCreate', methods=['POST'])
+def batch_create_products():
+    """
+    Expects {"products": [{...}, ...]}. The products are written in batches
+    and the response holds one result per item, in request order:
+    {"index", "status": 201, "product_id"} or {"index", "status", "error"}.
+    """
+    items, error = batch_writes.parse_items(request.get_json(silent=True), "products")
+    if error:
+        return jsonify({"error": error}), 400
+
+    seller_geo = product_geo.sellers_geo_fields(
+        db, {item.get("seller") for item in items if isinstance(item, dict) and isinstance(item.get("seller"), str)})
+    results = [None] * len(items)
+    writes, indexes = [], []
+    for index, product_data in enumerate(items):
+        if not isinstance(product_data, dict) or not product_data:
+            results[index] = {"index": index, "status": 400, "error": "No product data provided"}
+            continue
+        error = _normalize_price(product_data)
+        if error:
+            results[index] = {"index": index, "status": 400, "error": error}
+            continue
+        product_data.update(product_geo.geo_fields(product_data.get("location"))
+                            or seller_geo.get(product_data.get("seller"), {}))
+        writes.append((db.collection("product").document(), "set", product_data))
+        indexes.append(index)
+
+    for index, (product_ref, _, product_data), error in zip(indexes, writes, batch_writes.commit_in_chunks(db, writes)):
+        if error:
+            results[index] = dict(error, index=index)
+        else:
+            search_index.index_product(product_ref.id, product_data)
+            results[index] = {"index": index, "status": 201, "product_id": product_ref.id}
+
+    return jsonify(batch_writes.summarize(results)), 200
+
+# Update many products in one request
+@product_bp.route('/products:batchUpdate', methods=['PATCH'])
+def batch_update_products():
+    """
+    Expects {"updates": [{"product_id": ..., "fields": {...}}, ...]}, each
+    applied like PATCH /products/<product_id>. The response holds one result
+    per item, in request order: {"index", "status": 200, "product_id"} or
+    {"index", "status", "error"}; a missing product fails only its own item.
+    """
+    items, error = batch_writes.parse_items(request.get_json(silent=True), "updates")
+    if error:
+        return jsonify({"error": error}), 400
+
+    moves = [
+        item for item in items
+        if isinstance(item, dict) and isinstance(item.get("fields"), dict) and "location" not in item["fields"]
+        and isinstance(item["fields"].get("seller"), str)
+        and isinstance(item.get("product_id"), str) and item["product_id"] and "/" not in item["product_id"]
+    ]
+    seller_geo = product_geo.sellers_geo_fields(db, {item["fields"]["seller"] for item in moves})
+    # Whether the products changing seller inherit their location, read in one call
+    products = {}
+    if moves:
+        refs = [db.collection("product").document(item["product_id"]) for item in moves]
+        for product_doc in db.get_all(refs, field_paths=["geohash", "location_source"]):
+            if product_doc.exists:
+                products[product_doc.id] = product_doc.to_dict() or {}
+    results = [None] * len(items)
+    writes, indexes = [], []
+    for index, item in enumerate(items):
+        product_id = item.get("product_id") if isinstance(item, dict) else None
+        fields = item.get("fields") if isinstance(item, dict) else None
+        if not isinstance(product_id, str) or not product_id or "/" in product_id:
+            results[index] = {"index": index, "status": 400, "error": "'product_id' is required"}
+            continue
+        if not isinstance(fields, dict) or not fields:
+            results[index] = {"index": index, "status": 400, "error": "No product data provided"}
+            continue
+        update_payload = dict(fields)
+        error = _normalize_price(update_payload)
+        if error:
+            results[index] = {"index": index, "status": 400, "error": error}
+            continue
+        update_payload.update(_geo_update(update_payload, products.get(product_id, {}), seller_geo))
+        writes.append((db.collection("product").document(product_id), "update", update_payload))
+        indexes.append(index)
+
+    for index, (product_ref, _, update_payload), error in zip(indexes, writes, batch_writes.commit_in_chunks(db, writes)):
+        if error:
+            results[index] = dict(error, index=index, product_id=product_ref.id)
+        else:
+            search_index.update_indexed_product(product_ref.id, update_payload)
+            results[index] = {"index": index, "status": 200, "product_id": product_ref.id}
 
-    return jsonify({"message": "Product created successfully", "product_id": product_ref.id}), 201
\ No newline at end of file
+    return jsonify(batch_writes.summarize(results)), 200
@@ -1,10 +1,54 @@
+import os
 from flask import Blueprint, jsonify, request
-from services import evaluate_price, generate_location, evaluate_condition
+from services import evaluate_price, evaluate_prices, generate_location, evaluate_condition, valuation_cache, pool_stats
+from services import appraise_product, appraisal_input_hash, location_cache, poi_index
+from services import evaluate_price_async, generate_location_async, evaluate_condition_async, run_on_loop
+from services import image_stats, valuation_model_stats, single_flight_stats
+from services import evaluate_price_stream, generate_location_stream, evaluate_condition_stream
 from db_config import get_db
+from jobs import get_queue
+import doc_cache
+from admission import admission_controlled, admission_stats, admitted, client_key
+from utils import ndjson_response, sse_event, sse_response
 
 service_bp = Blueprint("service", __name__)
 
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("EVALUATE_BATCH_CONCURRENCY", 4))
+BATCH_MAX_CONCURRENCY = int(os.getenv("EVALUATE_BATCH_MAX_CONCURRENCY", 16))
+BATCH_MAX_LISTINGS = int(os.getenv("EVALUATE_BATCH_MAX_LISTINGS", 100))
+# Run the AI calls as coroutines on the worker's shared event loop, see services/event_loop.py
+ASYNC_MODE = os.getenv("AI_ASYNC_MODE", "0") == "1"
+
+def _run_in_background():
+    return request.args.get("background", "false").lower() == "true"
+
+def _stream_format():
+    """None for a single JSON answer, otherwise "sse" or "ndjson" from ?stream=true|sse|ndjson."""
+    value = request.args.get("stream", "false").lower()
+    if value in ("true", "sse"):
+        return "sse"
+    if value == "ndjson":
+        return "ndjson"
+    return None
+
+def _stream_events(events, stream_format):
+    """
+    Forward the (event, data) pairs of a streamed model call as they are
+    produced: as Server-Sent Events, or as one {"event", "data"} record per
+    line for clients that read the chunked body directly.
+    """
+    if stream_format == "ndjson":
+        return ndjson_response({"event": event, "data": data} for event, data in events)
+    return sse_response(sse_event(event, data) for event, data in events)
+
+def _submit_job(kind, params):
+    """Queue a background job and answer 202 with its id; identical pending jobs are reused."""
+    job, _ = get_queue().submit(kind, params)
+    response = jsonify({"job_id": job["id"], "status": job["status"]})
+    return response, 202, {"Location": f"/api/jobs/{job['id']}"}
+
 @service_bp.route('/generate-location', methods=['POST'])
+@admission_controlled
 def call_generate_location():
     # Get parameters from the JSON body
     data = request.get_json()
@@ -20,10 +64,40 @@ def call_generate_location():
     if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
         return jsonify({"error": "Missing parameters"}), 400
 
-    result = generate_location(lat1, lon1, lat2, lon2)
+    try:
+        lat1, lon1, lat2, lon2 = float(lat1), float(lon1), float(lat2), float(lon2)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Coordinates must be numbers"}), 400
+
+    # ?background=true queues the call; the suggestions are stored on the chat when chat_id is given
+    if _run_in_background():
+        return _submit_job("generate_location", {
+            "lat1": lat1, "lon1": lon1, "lat2": lat2, "lon2": lon2, "chat_id": data.get("chat_id"),
+        })
+
+    # ?stream=true sends the model's output as it is generated, ending with a "result" event
+    stream_format = _stream_format()
+    if stream_format:
+        return _stream_events(generate_location_stream(lat1, lon1, lat2, lon2), stream_format)
+
+    try:
+        if ASYNC_MODE:
+            result = run_on_loop(generate_location_async(lat1, lon1, lat2, lon2))
+        else:
+            result = generate_location(lat1, lon1, lat2, lon2)
+    except ValueError as e:
+        # The model answered with something other than the prescribed JSON
+        print(f"Error during location suggestion: {str(e)}")
+        return jsonify({"error": str(e)}), 502
     return result, 200
 
+# Cell-pair cache and nearby-place index counters for location suggestions
+@service_bp.route('/generate-location/cache', methods=['GET'])
+def get_location_cache_stats():
+    return jsonify({"cache": location_cache.stats(), "poi_index": poi_index.stats()}), 200
+
 @service_bp.route('/evaluate-price', methods=['POST'])
+@admission_controlled
 def call_evaluate_price():
     # Get parameters from the JSON body
     data = request.get_json()
@@ -43,16 +117,88 @@ def call_evaluate_price():
     if desc is None or price is None or image_urls is None:
         return jsonify({"error": "Missing parameters"}), 400
 
-    result = evaluate_price(desc, price, seller_name, image_urls)
+    # ?background=true queues the call; the valuation is stored on the product when product_id is given
+    if _run_in_background():
+        return _submit_job("evaluate_price", {
+            "desc": desc, "price": price, "seller": seller_name, "image_urls": image_urls,
+            "product_id": data.get("product_id"),
+        })
+
+    stream_format = _stream_format()
+    if stream_format:
+        return _stream_events(evaluate_price_stream(desc, price, seller_name, image_urls), stream_format)
+
+    if ASYNC_MODE:
+        result = run_on_loop(evaluate_price_async(desc, price, seller_name, image_urls))
+    else:
+        result = evaluate_price(desc, price, seller_name, image_urls)
     return result, 200
 
+# Evaluate many listings at once, streaming NDJSON results as they complete
+# Each listing is admitted on its own, so a batch costs as much as its listings sent one by one
+@service_bp.route('/evaluate-price/batch', methods=['POST'])
+def call_evaluate_price_batch():
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "No JSON payload provided"}), 400
+
+    listings = data.get("listings")
+    if not isinstance(listings, list) or not listings:
+        return jsonify({"error": "Missing parameters"}), 400
+    if len(listings) > BATCH_MAX_LISTINGS:
+        return jsonify({"error": f"At most {BATCH_MAX_LISTINGS} listings per batch"}), 400
+
+    concurrency = data.get("concurrency", BATCH_DEFAULT_CONCURRENCY)
+    if not isinstance(concurrency, int) or concurrency < 1:
+        return jsonify({"error": "concurrency must be a positive integer"}), 400
+    concurrency = min(concurrency, BATCH_MAX_CONCURRENCY, len(listings))
+
+    client = client_key()
+    return ndjson_response(evaluate_prices(listings, concurrency, admit=lambda: admitted(client)))
+
+# Hit/miss counters for the valuation cache
+@service_bp.route('/evaluate-price/cache', methods=['GET'])
+def get_valuation_cache_stats():
+    return jsonify(valuation_cache.stats()), 200
+
+# Hit rate and measured error of the local valuation model
+@service_bp.route('/evaluate-price/local-model', methods=['GET'])
+def get_valuation_model_stats():
+    return jsonify(valuation_model_stats()), 200
+
+# Connection reuse for the shared OpenAI client in this worker
+@service_bp.route('/openai/pool-stats', methods=['GET'])
+def get_openai_pool_stats():
+    return jsonify(pool_stats()), 200
+
+# Model slots in use and queued across the workers on this host
+@service_bp.route('/openai/admission', methods=['GET'])
+def get_admission_stats():
+    return jsonify(admission_stats()), 200
+
+# Identical AI calls that shared one model call in this worker
+@service_bp.route('/openai/single-flight', methods=['GET'])
+def get_single_flight_stats():
+    return jsonify(single_flight_stats()), 200
+
+# Bytes and vision tokens saved by shrinking listing photos in this worker
+@service_bp.route('/images/stats', methods=['GET'])
+def get_image_stats():
+    return jsonify(image_stats()), 200
+
+# Hit/miss/eviction counters for the document cache in this worker
+@service_bp.route('/documents/cache', methods=['GET'])
+def get_document_cache_stats():
+    return jsonify(doc_cache.get_document_cache().stats()), 200
+
 # Evaluate product appearance condition by id
 @service_bp.route('/evaluate-appearance-cond/<product_id>', methods=['POST'])
+@admission_controlled
 def call_evaluate_appearance(product_id):
     # get product by id
     db = get_db()
     product_ref = db.collection("product").document(product_id)
-    product_doc = product_ref.get()
+    product_doc = doc_cache.get_document(product_ref)
     image_urls = product_doc.to_dict()["image_urls"]
     # image_urls = [
     #     "https://forums.macrumors.com/attachments/1721668/",
@@ -63,5 +209,47 @@ def call_evaluate_appearance(product_id):
     if image_urls is None:
         return jsonify({"error": "Missing parameters"}), 400
 
-    result = evaluate_condition(image_urls)
-    return result, 200
\ No newline at end of file
+    # ?background=true queues the evaluation and stores it on the product
+    if _run_in_background():
+        return _submit_job("evaluate_condition", {"product_id": product_id})
+
+    stream_format = _stream_format()
+    if stream_format:
+        return _stream_events(evaluate_condition_stream(image_urls), stream_format)
+
+    if ASYNC_MODE:
+        result = run_on_loop(evaluate_condition_async(image_urls))
+    else:
+        result = evaluate_condition(image_urls)
+    return result, 200
+
+# Appraise condition and price together, storing the result on the product
+@service_bp.route('/products/<product_id>/appraise', methods=['POST'])
+@admission_controlled
+def call_appraise_product(product_id):
+    db = get_db()
+    product_ref = db.collection("product").document(product_id)
+    product_doc = doc_cache.get_document(product_ref)
+    if not product_doc.exists:
+        return jsonify({"error": f"Product with id {product_id} not found"}), 404
+
+    product = product_doc.to_dict()
+    if not product.get("image_urls"):
+        return jsonify({"error": "Missing parameters"}), 400
+
+    # Reuse the stored appraisal while the listing itself is unchanged
+    stored = product.get("appraisal")
+    refresh = request.args.get("refresh", "false").lower() == "true"
+    if stored and not refresh and stored.get("input_hash") == appraisal_input_hash(product):
+        return jsonify(stored), 200
+
+    result = appraise_product(product, request.args.get("mode", "fused"))
+    if "error" in result["condition"] or "error" in result["market"]:
+        return jsonify(result), 502
+
+    try:
+        product_ref.update({"appraisal": result})
+        doc_cache.invalidate(product_ref)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify(result), 200
\ No newline at end of file
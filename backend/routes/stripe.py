@@ -1,14 +1,20 @@
 from flask import Blueprint, jsonify, request
-import stripe
 import os
 
 stripe_bp = Blueprint("stripe", __name__)
 
-stripe.api_key = os.getenv('STRIPE_KEY')
 deploy_url = os.getenv('DEPLOY_URL')
 
+def get_stripe():
+    """Import and configure the Stripe SDK on first use; it is slow to import."""
+    import stripe
+    if stripe.api_key is None:
+        stripe.api_key = os.getenv('STRIPE_KEY')
+    return stripe
+
 @stripe_bp.route('/create-connect-account', methods=['POST'])
 def create_connect_account():
+    stripe = get_stripe()
     try:
         account = stripe.Account.create(
             type='express',
@@ -30,6 +36,7 @@ def create_connect_account():
 
 @stripe_bp.route('/create-payment-intent', methods=['POST'])
 def create_payment_intent():
+    stripe = get_stripe()
     try:
         data = request.json
         line_items = data.get('line_items', [])
@@ -58,6 +65,7 @@ def create_payment_intent():
     
 @stripe_bp.route('/create-checkout-session', methods=['POST'])
 def create_checkout_session():
+    stripe = get_stripe()
     try:
         print("Running")
         session = stripe.checkout.Session.create(
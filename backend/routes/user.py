@@ -1,15 +1,13 @@
 import jwt
-import bcrypt
 import datetime
 from flask import Blueprint, request, jsonify
-from db_config import get_db
+from db_config import db
+from passwords import get_hasher, PasswordHasherBusy
+import product_geo
+import doc_cache
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 user_bp = Blueprint("user", __name__)
-db = get_db()
 
 # Secret key for JWT signing – in production, load this from an environment variable
 SECRET_KEY = os.getenv("JWT_KEY")
@@ -38,14 +36,14 @@ def signup():
     user_ref = db.collection("user").document(user_id)
 
     # Check if the user already exists
-    if user_ref.get().exists:
+    if doc_cache.get_document(user_ref, fresh=True).exists:
         return jsonify({"error": "User already exists"}), 400
     
-    # Hash the password using bcrypt
-    hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    # Decode to store as a string in Firestore
-    hashed_pw_str = hashed_pw.decode('utf-8')
-    user_data["password"] = hashed_pw_str
+    # Hash the password using bcrypt on the hashing pool
+    try:
+        user_data["password"] = get_hasher().hash(password)
+    except PasswordHasherBusy as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
     user_data["email"] = email.lower()  # Ensure email is stored consistently
     user_data["location"] = location
     user_data["chats"] = []
@@ -53,6 +51,7 @@ def signup():
     # Create the new user document in Firestore
     try:
         user_ref.set(user_data)
+        doc_cache.invalidate(user_ref)
         return jsonify({"message": "User created successfully", "user_id": user_id}), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -76,6 +75,7 @@ def login():
 
     user_id = email.lower()
     user_ref = db.collection("user").document(user_id)
+    # Password hashes are kept out of the document cache
     user_doc = user_ref.get()
     if not user_doc.exists:
         return jsonify({"error": "User does not exist"}), 404
@@ -83,7 +83,13 @@ def login():
     user = user_doc.to_dict()
     stored_hashed_pw = user.get("password")
     # Compare the provided password with the stored hashed password
-    if bcrypt.checkpw(password.encode('utf-8'), stored_hashed_pw.encode('utf-8')):
+    hasher = get_hasher()
+    try:
+        password_matches = hasher.verify(password, stored_hashed_pw)
+    except PasswordHasherBusy as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+
+    if password_matches:
         # Create a JWT payload with an expiration time (e.g., 2 hour)
         payload = {
             "sub": user_id,
@@ -91,22 +97,41 @@ def login():
         }
         token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
         
+        update_payload = {}
+
         # If location data is provided, update the user's location in Firestore
         if location and isinstance(location, dict):
             lat = location.get("latitude")
             lon = location.get("longitude")
             if lat is not None and lon is not None:
-                try:
-                    db.collection("user").document(user_id).update({
-                        "location": {
-                            "lattitude": lat,
-                            "longitude": lon
-                        }
-                    })
-                except Exception as e:
-                    return jsonify({"error": f"Failed to update location: {str(e)}"}), 500
+                update_payload["location"] = {
+                    "lattitude": lat,
+                    "longitude": lon
+                }
+
+        # Upgrade hashes created with an older, cheaper bcrypt cost
+        if hasher.needs_rehash(stored_hashed_pw):
+            try:
+                update_payload["password"] = hasher.hash(password)
+            except PasswordHasherBusy:
+                pass  # Try again on the next login
+
+        if update_payload:
+            try:
+                user_ref.update(update_payload)
+                doc_cache.invalidate(user_ref)
+            except Exception as e:
+                return jsonify({"error": f"Failed to update user: {str(e)}"}), 500
+
+        # Listings without a location of their own follow the seller when they move to another cell
+        new_geo = product_geo.inherited_geo_fields(update_payload.get("location"))
+        if new_geo and new_geo != product_geo.inherited_geo_fields(user.get("location")):
+            try:
+                product_geo.relocate_seller_products(db, user_id, update_payload["location"], user.get("location"))
+            except Exception as e:
+                print(f"Failed to relocate products of {user_id}: {str(e)}")
         
-        return jsonify({"message": "Login successful", "token": token, "isSeller": user_doc.to_dict()["isSeller"]}), 200
+        return jsonify({"message": "Login successful", "token": token, "isSeller": user["isSeller"]}), 200
     else:
         # Password does not match
         return jsonify({"error": "Invalid credentials"}), 401
@@ -123,7 +148,7 @@ def logout():
 @user_bp.route("/api/users/<user_id>/location", methods=["GET"])
 def get_user(user_id):
     user_ref = db.collection("user").document(user_id)
-    user_doc = user_ref.get()
+    user_doc = doc_cache.get_document(user_ref)
     
     if user_doc.exists:
         return jsonify(user_doc.to_dict()["location"]), 200
@@ -0,0 +1,69 @@
+"""
+Give existing products the location, geohash and location_source fields
+used by GET /api/products/nearby. A product keeps a location of its own;
+otherwise it is placed at the centre of its seller's cell.
+
+Run from the backend directory:
+    python -m scripts.backfill_product_geohash [--dry-run] [--force]
+
+Products that already have a location_source are skipped unless --force is
+given, so the backfill can be re-run safely if it is interrupted. Products
+indexed before location_source existed are rewritten: those at their
+seller's exact location are treated as inherited, so the seller's login
+coordinates are no longer stored on them.
+"""
+import argparse
+import doc_cache
+from db_config import get_db
+from batch_writes import BATCH_LIMIT
+from product_geo import geo_fields, inherited_geo_fields, inherits_location
+
+
+def _seller_location(db, seller):
+    if not seller:
+        return None
+    user_doc = doc_cache.get_document(db.collection("user").document(str(seller).lower()))
+    return (user_doc.to_dict() or {}).get("location") if user_doc.exists else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be updated without writing")
+    parser.add_argument("--force", action="store_true", help="Recompute products that already have a location_source")
+    args = parser.parse_args()
+
+    db = get_db()
+    sellers = {}
+    batch = db.batch()
+    updated = skipped = 0
+    for product_doc in db.collection("product").stream():
+        product = product_doc.to_dict() or {}
+        if product.get("location_source") and not args.force:
+            continue
+        seller = product.get("seller")
+        if seller not in sellers:
+            sellers[seller] = _seller_location(db, seller)
+        own = geo_fields(product.get("location"))
+        if own and not inherits_location(dict(product, geohash=own["geohash"]), sellers[seller]):
+            fields = own
+        else:
+            fields = inherited_geo_fields(sellers[seller])
+        if not fields:
+            skipped += 1
+            continue
+        updated += 1
+        if args.dry_run:
+            continue
+        batch.update(product_doc.reference, fields)
+        if len(batch) >= BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+    if not args.dry_run and len(batch):
+        batch.commit()
+
+    action = "Would update" if args.dry_run else "Updated"
+    print(f"{action} {updated} products; {skipped} have no location and no seller location")
+
+
+if __name__ == "__main__":
+    main()
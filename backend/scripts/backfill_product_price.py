@@ -0,0 +1,54 @@
+"""
+Store the price of existing products as a number, so the price_min and
+price_max filters of GET /api/products match them. Firestore range filters
+never match a value of another type, and older listings stored the price
+as a string.
+
+Run from the backend directory:
+    python -m scripts.backfill_product_price [--dry-run]
+
+Products whose price is already a number are skipped, so the backfill can
+be re-run safely if it is interrupted. Prices that are not numbers are
+reported and left as they are.
+"""
+import argparse
+from db_config import get_db
+from batch_writes import BATCH_LIMIT
+from utils import parse_price
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be updated without writing")
+    args = parser.parse_args()
+
+    db = get_db()
+    batch = db.batch()
+    updated = 0
+    invalid = []
+    for product_doc in db.collection("product").stream():
+        product = product_doc.to_dict() or {}
+        if "price" not in product or not isinstance(product["price"], str):
+            continue
+        price = parse_price(product["price"])
+        if price is None:
+            invalid.append(product_doc.id)
+            continue
+        updated += 1
+        if args.dry_run:
+            continue
+        batch.update(product_doc.reference, {"price": price})
+        if len(batch) >= BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+    if not args.dry_run and len(batch):
+        batch.commit()
+
+    action = "Would update" if args.dry_run else "Updated"
+    print(f"{action} {updated} products; {len(invalid)} have a price that is not a number")
+    for product_id in invalid:
+        print(f"  {product_id}")
+
+
+if __name__ == "__main__":
+    main()
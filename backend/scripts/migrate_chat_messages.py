@@ -0,0 +1,99 @@
+"""
+Move chat messages from the legacy `messages` array on each chat document
+into the `chat/<chat_id>/messages` subcollection.
+
+Run from the backend directory:
+    python -m scripts.migrate_chat_messages [--dry-run] [--keep-array]
+
+Message documents get deterministic ids, so the migration can be re-run
+safely if it is interrupted.
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+from db_config import get_db
+from firebase_admin import firestore
+
+# Firestore allows at most 500 writes per batch
+BATCH_LIMIT = 500
+
+
+def _message_timestamp(message, fallback):
+    timestamp = message.get("timestamp")
+    if isinstance(timestamp, datetime):
+        return timestamp
+    for value in (timestamp, message.get("time")):
+        if isinstance(value, str):
+            try:
+                return datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                pass
+    return fallback
+
+
+def migrate_chat(db, chat_doc, dry_run=False, keep_array=False):
+    """Migrate a single chat. Returns the number of messages moved."""
+    messages = chat_doc.to_dict().get("messages")
+    if not messages:
+        return 0
+
+    chat_ref = chat_doc.reference
+    messages_ref = chat_ref.collection("messages")
+    # Keep the original array order for messages without a usable timestamp
+    previous = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    writes = []
+    for index, message in enumerate(messages):
+        timestamp = _message_timestamp(message, previous + timedelta(microseconds=1))
+        previous = timestamp
+        message_data = dict(message, timestamp=timestamp)
+        writes.append((messages_ref.document(f"legacy-{index:06d}"), message_data))
+
+    last_ref, last_message = writes[-1]
+    chat_update = {
+        "last_message": {
+            "message_id": last_ref.id,
+            "sender": last_message.get("sender"),
+            "text": last_message.get("text"),
+            "timestamp": last_message["timestamp"],
+        },
+        "message_count": len(writes),
+    }
+    if not keep_array:
+        chat_update["messages"] = firestore.DELETE_FIELD
+
+    if dry_run:
+        return len(writes)
+
+    # Message writes go first; the chat update only lands with the final batch
+    for start in range(0, len(writes), BATCH_LIMIT - 1):
+        batch = db.batch()
+        for message_ref, message_data in writes[start:start + BATCH_LIMIT - 1]:
+            batch.set(message_ref, message_data)
+        if start + BATCH_LIMIT - 1 >= len(writes):
+            batch.update(chat_ref, chat_update)
+        batch.commit()
+
+    return len(writes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing")
+    parser.add_argument("--keep-array", action="store_true", help="Leave the legacy messages array in place")
+    args = parser.parse_args()
+
+    db = get_db()
+    chats = messages = 0
+    for chat_doc in db.collection("chat").stream():
+        moved = migrate_chat(db, chat_doc, dry_run=args.dry_run, keep_array=args.keep_array)
+        if moved:
+            chats += 1
+            messages += moved
+            print(f"{chat_doc.id}: {moved} messages")
+
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{action} {messages} messages across {chats} chats")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+In-memory full-text and faceted search over the product collection.
+
+Each worker keeps an inverted index of the product text fields, filled by
+the product listener it shares with doc_cache: the listener's first snapshot builds
+the index and later snapshots apply every create, update and delete, from
+whichever worker made it. The product routes also apply their own writes
+straight away, so a seller sees a new listing in search immediately.
+Queries never touch Firestore.
+"""
+import bisect
+import math
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional
+
+# Relative weight of a term occurring in each field
+FIELD_WEIGHTS = {"title": 3.0, "category": 2.0, "storage": 1.5, "desc": 1.0}
+# Upper bounds of the price facet buckets; the last bucket is open ended
+PRICE_BUCKETS = (50, 100, 250, 500, 1000)
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Seconds a query waits for the initial snapshot before reading the collection directly
+READY_TIMEOUT = float(os.getenv("PRODUCT_SEARCH_READY_TIMEOUT", 10))
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text) -> List[str]:
+    return _TOKEN.findall(str(text).lower()) if text is not None else []
+
+
+def price_bucket(price) -> Optional[str]:
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        return None
+    lower = 0
+    for upper in PRICE_BUCKETS:
+        if price < upper:
+            return f"{lower}-{upper}"
+        lower = upper
+    return f"{lower}+"
+
+
+def _condition(product: Dict) -> Optional[str]:
+    condition = " ".join(str(product.get("appearance_cond") or "").split()).lower()
+    return condition or None
+
+
+class ProductIndex:
+    def __init__(self):
+        self._products = {}
+        # term -> {product_id: weighted term frequency}
+        self._postings = {}
+        self._lengths = {}
+        self._total_length = 0.0
+        self._sorted_terms = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def _remove(self, product_id: str) -> None:
+        product = self._products.pop(product_id, None)
+        if product is None:
+            return
+        for term in product["_terms"]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(product_id, None)
+                if not postings:
+                    del self._postings[term]
+                    self._sorted_terms = None
+        self._total_length -= self._lengths.pop(product_id, 0.0)
+
+    def _add(self, product_id: str, product: Dict) -> None:
+        frequencies = {}
+        length = 0.0
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(product.get(field)):
+                frequencies[term] = frequencies.get(term, 0.0) + weight
+                length += weight
+        for term, frequency in frequencies.items():
+            if term not in self._postings:
+                self._postings[term] = {}
+                self._sorted_terms = None
+            self._postings[term][product_id] = frequency
+        self._products[product_id] = dict(product, _terms=tuple(frequencies))
+        self._lengths[product_id] = length
+        self._total_length += length
+
+    def upsert(self, product_id: str, product: Dict) -> None:
+        with self._lock:
+            self._remove(product_id)
+            self._add(product_id, product)
+
+    def update(self, product_id: str, fields: Dict) -> None:
+        """Merge changed fields into an indexed product, as a PATCH does."""
+        with self._lock:
+            current = self._products.get(product_id)
+            if current is None:
+                return
+            product = {k: v for k, v in current.items() if k != "_terms"}
+            product.update(fields)
+            self._remove(product_id)
+            self._add(product_id, product)
+
+    def delete(self, product_id: str) -> None:
+        with self._lock:
+            self._remove(product_id)
+
+    def replace_all(self, products: Iterable) -> None:
+        with self._lock:
+            self._products, self._postings, self._lengths = {}, {}, {}
+            self._total_length = 0.0
+            self._sorted_terms = None
+            for product_id, product in products:
+                self._add(product_id, product)
+
+    def _expand(self, term: str, prefix: bool) -> List[str]:
+        if not prefix:
+            return [term] if term in self._postings else []
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self._postings)
+        start = bisect.bisect_left(self._sorted_terms, term)
+        end = bisect.bisect_left(self._sorted_terms, term + "\uffff")
+        return self._sorted_terms[start:end]
+
+    def _score(self, terms: List[str]) -> Dict[str, float]:
+        """BM25 scores of the products matching every query term; the last term also matches as a prefix."""
+        count = len(self._products)
+        average_length = self._total_length / count if count else 0.0
+        scores = None
+        for position, term in enumerate(terms):
+            term_scores = {}
+            for expanded in self._expand(term, prefix=position == len(terms) - 1):
+                postings = self._postings[expanded]
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for product_id, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self._lengths[product_id] / average_length) if average_length else K1
+                    score = idf * frequency * (K1 + 1) / (frequency + norm)
+                    term_scores[product_id] = max(term_scores.get(product_id, 0.0), score)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {product_id: score + term_scores[product_id]
+                          for product_id, score in scores.items() if product_id in term_scores}
+            if not scores:
+                return {}
+        return scores
+
+    def search(self, text: str = "", filters: Dict = None, sort: str = "relevance",
+               offset: int = 0, limit: int = 20, facet_size: int = 10) -> Dict:
+        """
+        Products matching every word of text (all products when it is empty)
+        and the filters seller, category, condition, price_min and price_max.
+        Facet counts for price bucket, condition and seller ignore their own
+        filter, so a client can offer the other values alongside the selected one.
+        """
+        filters = filters or {}
+        terms = tokenize(text)
+
+        def passes(product, skip=None):
+            if skip != "seller" and filters.get("seller") and product.get("seller") != filters["seller"]:
+                return False
+            if filters.get("category") and product.get("category") != filters["category"]:
+                return False
+            if skip != "condition" and filters.get("condition") and _condition(product) != filters["condition"].lower():
+                return False
+            if skip != "price" and (filters.get("price_min") is not None or filters.get("price_max") is not None):
+                try:
+                    price = float(product.get("price"))
+                except (TypeError, ValueError):
+                    return False
+                if filters.get("price_min") is not None and price < filters["price_min"]:
+                    return False
+                if filters.get("price_max") is not None and price > filters["price_max"]:
+                    return False
+            return True
+
+        with self._lock:
+            scores = self._score(terms) if terms else dict.fromkeys(self._products, 0.0)
+            matches = [(product_id, self._products[product_id]) for product_id in scores]
+
+            facets = {"price": {}, "condition": {}, "seller": {}}
+            for facet, value_of in (("price", lambda p: price_bucket(p.get("price"))),
+                                    ("condition", _condition),
+                                    ("seller", lambda p: p.get("seller"))):
+                counts = facets[facet]
+                for _, product in matches:
+                    if passes(product, skip=facet):
+                        value = value_of(product)
+                        if value is not None:
+                            counts[value] = counts.get(value, 0) + 1
+
+            results = [(product_id, product) for product_id, product in matches if passes(product)]
+
+            if sort in ("price_asc", "price_desc"):
+                def price_key(item):
+                    try:
+                        return float(item[1].get("price"))
+                    except (TypeError, ValueError):
+                        return math.inf if sort == "price_asc" else -math.inf
+                results.sort(key=price_key, reverse=sort == "price_desc")
+            elif terms:
+                results.sort(key=lambda item: (-scores[item[0]], item[0]))
+            else:
+                results.sort(key=lambda item: (str(item[1].get("title", "")).lower(), item[0]))
+
+            page = [
+                dict({k: v for k, v in product.items() if k != "_terms"},
+                     product_id=product_id, score=round(scores[product_id], 4))
+                for product_id, product in results[offset:offset + limit]
+            ]
+
+        # Lists rather than objects, since the JSON encoder sorts object keys
+        price_order = {price_bucket(upper - 1): index for index, upper in enumerate(PRICE_BUCKETS)}
+        ordered = {"price": sorted(facets["price"].items(), key=lambda item: price_order.get(item[0], len(price_order)))}
+        for facet in ("condition", "seller"):
+            ordered[facet] = sorted(facets[facet].items(), key=lambda item: (-item[1], item[0]))[:facet_size]
+        facets = {facet: [{"value": value, "count": count} for value, count in items] for facet, items in ordered.items()}
+
+        return {"products": page, "total": len(results), "facets": facets}
+
+
+class ProductSearch:
+    """The index of this worker and the listener that keeps it current."""
+
+    def __init__(self, db):
+        import doc_cache
+
+        self.index = ProductIndex()
+        self.ready = threading.Event()
+        self._db = db
+        self._build_lock = threading.Lock()
+        self._watch = doc_cache.get_document_cache()
+        self._watch.add_snapshot_listener("product", self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        if not self.ready.is_set():
+            # The first snapshot holds the whole collection
+            self.index.replace_all((doc.id, doc.to_dict() or {}) for doc in docs)
+            self.ready.set()
+            return
+        for change in changes:
+            if change.type.name == "REMOVED":
+                self.index.delete(change.document.id)
+            else:
+                self.index.upsert(change.document.id, change.document.to_dict() or {})
+
+    def wait_ready(self, timeout: float = READY_TIMEOUT) -> None:
+        if self.ready.wait(timeout):
+            return
+        with self._build_lock:
+            if self.ready.is_set():
+                return
+            # No snapshot arrived in time; build from a direct read instead
+            print("Product search listener not ready, reading the collection directly")
+            self.index.replace_all((doc.id, doc.to_dict() or {}) for doc in self._db.collection("product").stream())
+            self.ready.set()
+
+    def close(self) -> None:
+        self._watch.remove_snapshot_listener("product", self._on_snapshot)
+
+
+_search = None
+_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # Listener threads do not survive a fork; each worker builds its own index
+    global _search, _pid, _lock
+    _search = None
+    _pid = os.getpid()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_search(wait: bool = True) -> ProductSearch:
+    """Return this worker's product search, starting its listener on first use."""
+    global _search
+    if os.getpid() != _pid:
+        _reset_after_fork()
+    if _search is None:
+        with _lock:
+            if _search is None:
+                from db_config import get_db
+                _search = ProductSearch(get_db())
+    if wait:
+        _search.wait_ready()
+    return _search
+
+
+def index_product(product_id: str, product: Dict) -> None:
+    """Apply a product write made by this worker without waiting for the listener."""
+    if _search is not None and os.getpid() == _pid:
+        _search.index.upsert(product_id, product)
+
+
+def update_indexed_product(product_id: str, fields: Dict) -> None:
+    if _search is not None and os.getpid() == _pid:
+        _search.index.update(product_id, fields)
@@ -1,5 +1,11 @@
-from .market_analyzer import evaluate_price
-from .location_advice import generate_location
-from .condition_evaluator import evaluate_condition
+from .market_analyzer import evaluate_price, evaluate_price_async, evaluate_price_stream, evaluate_prices, valuation_cache
+from .location_advice import generate_location, generate_location_async, generate_location_stream, location_cache, poi_index
+from .condition_evaluator import evaluate_condition, evaluate_condition_async, evaluate_condition_stream
+from .openai_client import get_client, get_async_client, pool_stats, add_call_observer
+from .appraisal import appraise_product, appraisal_input_hash
+from .event_loop import run_on_loop
+from .images import image_stats
+from .valuation_model import valuation_model_stats
+from .single_flight import single_flight_stats
 
-__all__ = ['evaluate_price', 'generate_location', 'evaluate_condition']
\ No newline at end of file
+__all__ = ['evaluate_price', 'evaluate_price_async', 'evaluate_price_stream', 'evaluate_prices', 'generate_location', 'generate_location_async', 'generate_location_stream', 'location_cache', 'poi_index', 'evaluate_condition', 'evaluate_condition_async', 'evaluate_condition_stream', 'valuation_cache', 'get_client', 'get_async_client', 'pool_stats', 'add_call_observer', 'appraise_product', 'appraisal_input_hash', 'run_on_loop', 'image_stats', 'valuation_model_stats', 'single_flight_stats']
\ No newline at end of file
@@ -0,0 +1,119 @@
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Dict
+import os
+from .openai_client import get_client
+from .images import image_parts
+from .condition_evaluator import ConditionEvaluator
+from .market_analyzer import MarketAnalyzer, analyze_listing
+
+class ProductAppraiser:
+    """
+    Appraises a listing's condition and market value together. In "fused" mode
+    both answers come from one vision call, so the images are only sent once
+    and the valuation can take the observed condition into account. In
+    "parallel" mode the existing condition and market analyses run side by side.
+    """
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.client = get_client(api_key)
+        self.system_prompt = """You are an appraiser of second-hand electronic devices for the Republic of Ireland market.
+        First assess the device's external condition strictly from the provided images:
+        - Screen & Body: visible scratches, cracks, dents or other damage.
+        - Buttons & Ports: whether buttons are intact and ports show wear or damage.
+        - Camera & Lenses: dust, cracks or blurriness.
+
+        Then calculate the fair market value (in EUR) using listings from Amazon, Facebook Marketplace, CEX, Ebay,
+        Currys etc., factoring in the condition you observed, the model specifications, the seller and the
+        difference between asking price and market value. If there are dents, the product is broken or has extreme
+        wear and tear, do not recommend purchasing the product.
+
+        Reliability is 80-100 if the images clearly show all key areas, lower if details are missing or unclear,
+        and below 50 if critical areas are obscured.
+
+        Respond ONLY with a JSON object in this exact format:
+        {
+            "appearance_cond": "<Concise 20-word description of the device's condition>",
+            "reliability": <number>,
+            "fairMarketValue": <number>,
+            "goodDeal": <boolean>,
+            "suggestion": "<20-word recommendation>"
+        }"""
+
+    def prepare_messages(self, prompt: str, image_urls: List[str] = None) -> List[Dict]:
+        content = [{"type": "text", "text": prompt}]
+        content.extend(image_parts(image_urls))
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": content},
+        ]
+
+    def appraise_fused(self, desc, price, seller_name, image_urls: List[str]) -> Dict:
+        prompt = f'{desc} (Asking: EUR {price}) sold by {seller_name}'
+        try:
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                response_format={"type": "json_object"},
+                messages=self.prepare_messages(prompt, image_urls),
+                max_tokens=1000,
+                temperature=0.7
+            )
+            output = response.choices[0].message.content.strip()
+            output = output.replace('```json', '').replace('```', '').strip()
+            result = json.loads(output)
+            # Hold the fused answer to the same checks as the separate condition and market calls
+            ConditionEvaluator(self.api_key).validate(result)
+            MarketAnalyzer(self.api_key).validate(result)
+        except Exception as e:
+            print(f"Error during appraisal: {str(e)}")
+            return {"condition": {"error": str(e)}, "market": {"error": str(e)}}
+
+        return {
+            "condition": {
+                "appearance_cond": result.get("appearance_cond"),
+                "reliability": result.get("reliability"),
+            },
+            "market": {
+                "fairMarketValue": result.get("fairMarketValue"),
+                "goodDeal": result.get("goodDeal"),
+                "suggestion": result.get("suggestion"),
+            },
+        }
+
+    def appraise_parallel(self, desc, price, seller_name, image_urls: List[str]) -> Dict:
+        evaluator = ConditionEvaluator(self.api_key)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            condition = executor.submit(evaluator.evalute_condition, "start evaluation", image_urls)
+            market = executor.submit(analyze_listing, desc, price, seller_name, image_urls)
+            return {"condition": condition.result(), "market": market.result()}
+
+
+def appraisal_input_hash(product: Dict) -> str:
+    """Fingerprint of the product fields an appraisal depends on."""
+    payload = {
+        "desc": product.get("desc") or product.get("title"),
+        "price": product.get("price"),
+        "seller": product.get("seller"),
+        "image_urls": product.get("image_urls") or [],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def appraise_product(product: Dict, mode: str = "fused") -> Dict:
+    desc = product.get("desc") or product.get("title")
+    api_key = os.getenv("OPEN_AI_API_KEY")
+    appraiser = ProductAppraiser(api_key)
+
+    if mode == "parallel":
+        result = appraiser.appraise_parallel(desc, product.get("price"), product.get("seller"), product.get("image_urls"))
+    else:
+        mode = "fused"
+        result = appraiser.appraise_fused(desc, product.get("price"), product.get("seller"), product.get("image_urls"))
+
+    result["mode"] = mode
+    result["input_hash"] = appraisal_input_hash(product)
+    result["appraised_at"] = datetime.now(timezone.utc).isoformat()
+    return result
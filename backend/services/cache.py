@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class MemoryBackend:
+    """In-process LRU store with per-entry expiry. Values must be JSON serializable."""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float) -> int:
+        """Store a value and return how many entries were evicted to make room."""
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """
+    On-disk LRU store shared by every worker process on the host. A new
+    connection is opened per operation so the backend stays safe across forks.
+    """
+
+    def __init__(self, path: str, table: str, max_entries: int = 1000):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: float) -> int:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now),
+            )
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now,))
+            (count,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+            evicted = max(0, count - self.max_entries)
+            if evicted:
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN ("
+                    f"SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)",
+                    (evicted,),
+                )
+        return evicted
+
+    def delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            (count,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        return count
+
+
+class ResultCache:
+    """TTL cache in front of a pluggable backend, with hit/miss/eviction counters."""
+
+    def __init__(self, name: str, backend, ttl: float):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        evicted = self.backend.set(key, value, self.ttl)
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any],
+                       should_cache: Callable[[Any], bool] = lambda value: True) -> Any:
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = compute()
+        if should_cache(value):
+            self.set(key, value)
+        return value
+
+    async def get_or_compute_async(self, key: str, compute: Callable[[], Awaitable[Any]],
+                                   should_cache: Callable[[Any], bool] = lambda value: True) -> Any:
+        """get_or_compute for coroutines; backend calls run in a thread so a SQLite cache never blocks the loop."""
+        value = await asyncio.to_thread(self.get, key)
+        if value is not None:
+            return value
+        value = await compute()
+        if should_cache(value):
+            await asyncio.to_thread(self.set, key, value)
+        return value
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "backend": type(self.backend).__name__,
+            "size": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def make_cache(name: str, default_ttl: float, default_max_entries: int = 1000) -> ResultCache:
+    """
+    Build a cache configured from <NAME>_CACHE_* environment variables:
+    BACKEND (memory or sqlite), PATH (sqlite file), TTL (seconds), MAX_ENTRIES.
+    """
+    prefix = f"{name.upper()}_CACHE_"
+    ttl = float(os.getenv(prefix + "TTL", default_ttl))
+    max_entries = int(os.getenv(prefix + "MAX_ENTRIES", default_max_entries))
+
+    if os.getenv(prefix + "BACKEND", "memory").lower() == "sqlite":
+        path = os.getenv(prefix + "PATH", os.path.join("cache", "ai_cache.sqlite3"))
+        backend = SQLiteBackend(path, table=f"{name.lower()}_cache", max_entries=max_entries)
+    else:
+        backend = MemoryBackend(max_entries=max_entries)
+
+    return ResultCache(name, backend, ttl)
@@ -1,14 +1,19 @@
-import openai
+import asyncio
+import hashlib
 import json
-from typing import List, Dict
+from typing import Iterator, List, Dict
 import os
-from dotenv import load_dotenv
+from .openai_client import get_client, get_async_client
+from .images import image_parts
+from .streaming import Event, stream_json
+from .single_flight import SingleFlight
 
-load_dotenv()
+# Concurrent evaluations of the same photos share one model call
+condition_flight = SingleFlight("condition")
 
 class ConditionEvaluator:
     def __init__(self, api_key: str):
-        self.client = openai.OpenAI(api_key=api_key)
+        self.api_key = api_key
         self.system_prompt = """
             You are an AI-powered evaluator specializing in assessing the appearance condition of second-hand electronic devices based on images. Your goal is to analyze the device's external condition strictly based on the provided images.
 
@@ -29,6 +34,11 @@ class ConditionEvaluator:
             - If critical areas are obscured or not visible, lower the reliability significantly (below 50%).
             Do not include any extra text or explanation outside the JSON response.
             """
+        self.prompt_version = hashlib.sha256(self.system_prompt.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def client(self):
+        return get_client(self.api_key)
 
     def prepare_messages(self, prompt: str, image_urls: List[str] = None) -> List[Dict]:
         messages = [
@@ -37,12 +47,7 @@ class ConditionEvaluator:
 
         if image_urls:
             content = [{"type": "text", "text": prompt}]
-            
-            for url in image_urls:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {"url": url}
-                })
+            content.extend(image_parts(image_urls))
             
             messages.append({
                 "role": "user",
@@ -53,42 +58,104 @@ class ConditionEvaluator:
 
         return messages
 
+    def completion_request(self, prompt: str, image_urls: List[str] = None) -> Dict:
+        return {
+            "model": "gpt-4o-mini" if image_urls else "gpt-4",  # Fixed model name
+            "response_format": {"type": "json_object"},  # Force JSON response
+            "messages": self.prepare_messages(prompt, image_urls),
+            "max_tokens": 1000,
+            "temperature": 0.7,
+        }
+
+    def parse_response(self, response) -> Dict:
+        return self.parse_output(response.choices[0].message.content)
+
+    def parse_output(self, output: str) -> Dict:
+        output = output.strip()
+        output = output.replace('```json', '').replace('```', '').strip()
+        try:
+            return json.loads(output)
+        except json.JSONDecodeError as je:
+            print(f"JSON parsing error. Raw response: {output}")
+            raise je
+
+    def validate(self, result: Dict) -> None:
+        """Raise ValueError unless result has the fields the system prompt asks for."""
+        if not isinstance(result, dict):
+            raise ValueError("Expected a JSON object")
+        if not isinstance(result.get("appearance_cond"), str):
+            raise ValueError("appearance_cond must be a string")
+        # The model sometimes writes the percentage as "85%"
+        reliability = result.get("reliability")
+        if isinstance(reliability, bool) or not isinstance(reliability, (int, float, str)):
+            raise ValueError("reliability must be a percentage")
+
     def evalute_condition(self, prompt: str, image_urls: List[str] = None) -> Dict:
-        messages = self.prepare_messages(prompt, image_urls)
-        
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini" if image_urls else "gpt-4",  # Fixed model name
-                response_format={"type": "json_object"},  # Force JSON response
-                messages=messages,
-                max_tokens=1000,
-                temperature=0.7 
-            )
-            
-            output = response.choices[0].message.content.strip()
-            output = output.replace('```json', '').replace('```', '').strip()
-            try:
-                return json.loads(output)
-            except json.JSONDecodeError as je:
-                print(f"JSON parsing error. Raw response: {output}")
-                raise je
-                
+            response = self.client.chat.completions.create(**self.completion_request(prompt, image_urls))
+            return self.parse_response(response)
         except Exception as e:
             print(f"Error during analysis: {str(e)}")
             return {
                 "error": str(e),
             }
 
+    async def evaluate_condition_async(self, prompt: str, image_urls: List[str] = None) -> Dict:
+        try:
+            client = get_async_client(self.api_key)
+            # Preparing the images may download them, which must not block the loop
+            request = await asyncio.to_thread(self.completion_request, prompt, image_urls)
+            response = await client.chat.completions.create(**request)
+            return self.parse_response(response)
+        except Exception as e:
+            print(f"Error during analysis: {str(e)}")
+            return {
+                "error": str(e),
+            }
+
+    def evaluate_condition_stream(self, prompt: str, image_urls: List[str] = None) -> Iterator[Event]:
+        """evalute_condition as delta events followed by the validated result, see services/streaming.py."""
+        try:
+            request = self.completion_request(prompt, image_urls)
+        except Exception as e:
+            print(f"Error during analysis: {str(e)}")
+            yield "error", {"error": str(e)}
+            return
+        yield from stream_json(self.client, request, self.parse_output, self.validate)
+
+def condition_key(image_urls, prompt_version: str) -> str:
+    payload = {"images": sorted(str(url) for url in image_urls or []), "prompt_version": prompt_version}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
 def evaluate_condition(image_urls):
     prompt = "start evaluation"
     api_key = os.getenv("OPEN_AI_API_KEY")
     evaluator = ConditionEvaluator(api_key)
     
-    result = evaluator.evalute_condition(prompt, image_urls)
+    result = condition_flight.do(condition_key(image_urls, evaluator.prompt_version),
+                                 lambda: evaluator.evalute_condition(prompt, image_urls))
+    print("Evaluation Result:")
+    print(json.dumps(result, indent=4))
+    return json.dumps(result, indent=4)
+
+async def evaluate_condition_async(image_urls):
+    prompt = "start evaluation"
+    api_key = os.getenv("OPEN_AI_API_KEY")
+    evaluator = ConditionEvaluator(api_key)
+
+    result = await condition_flight.do_async(condition_key(image_urls, evaluator.prompt_version),
+                                             lambda: evaluator.evaluate_condition_async(prompt, image_urls))
     print("Evaluation Result:")
     print(json.dumps(result, indent=4))
     return json.dumps(result, indent=4)
 
+def evaluate_condition_stream(image_urls) -> Iterator[Event]:
+    prompt = "start evaluation"
+    api_key = os.getenv("OPEN_AI_API_KEY")
+    evaluator = ConditionEvaluator(api_key)
+
+    yield from evaluator.evaluate_condition_stream(prompt, image_urls)
+
 # evaluate_condition([
 #             "https://forums.macrumors.com/attachments/1721668/",
 #             "https://www.thesun.co.uk/wp-content/uploads/2020/11/IMG_0577-2.jpg?strip=all&w=960"
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import threading
+
+_loop = None
+_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # The loop's thread does not survive a fork, so each worker starts its own
+    global _loop, _pid, _lock
+    _loop = None
+    _pid = os.getpid()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return this process's service event loop, starting it on first use. The
+    async OpenAI client lives on this loop, so every request in the worker
+    shares one connection pool however many calls are in flight.
+    """
+    global _loop
+    if os.getpid() != _pid:
+        _reset_after_fork()
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="service-event-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def run_on_loop(coro, timeout: float = None):
+    """
+    Run a service coroutine on the shared loop and wait for its result. The
+    calling request thread only waits on a future; the network I/O of every
+    in-flight call is multiplexed on the loop.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout)
+    except BaseException:
+        future.cancel()
+        raise
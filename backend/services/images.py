@@ -0,0 +1,325 @@
+"""
+Preprocessing of listing photos before they are sent to the vision models.
+
+In the default "low_detail" mode the model receives the original URL and
+is asked for low detail, so it does not tile the full-resolution photo.
+In "inline" mode each URL is downloaded once, identified by the hash of its
+bytes, scaled so its longest side is at most IMAGE_MAX_SIDE pixels,
+re-encoded as JPEG and cached on disk. The model then receives the small
+JPEG as a data URL. "off" sends the URL unchanged.
+
+Low-detail photos are never downloaded, so their savings are estimated
+from IMAGE_ASSUMED_SIZE, a typical phone photo, unless the disk cache
+already knows the photo's real size.
+
+The URLs come from clients, so inline mode only downloads http(s) URLs
+whose host resolves to public addresses, and connects to the address that
+was checked so a second DNS answer cannot point it elsewhere. Redirects are
+followed by hand, at most IMAGE_MAX_REDIRECTS times, and every hop is
+checked the same way.
+"""
+import base64
+import hashlib
+import io
+import ipaddress
+import math
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+IMAGE_MODE = os.getenv("IMAGE_MODE", "low_detail").lower()
+MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 512))
+JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 80))
+DETAIL = os.getenv("IMAGE_DETAIL", "low")
+CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join("cache", "images"))
+FETCH_TIMEOUT = float(os.getenv("IMAGE_FETCH_TIMEOUT", 10))
+MAX_DOWNLOAD_BYTES = int(os.getenv("IMAGE_MAX_DOWNLOAD_BYTES", 20 * 1024 * 1024))
+FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY", 8))
+MAX_REDIRECTS = int(os.getenv("IMAGE_MAX_REDIRECTS", 3))
+ASSUMED_SIZE = tuple(int(side) for side in os.getenv("IMAGE_ASSUMED_SIZE", "4032x3024").lower().split("x"))
+
+# Vision token accounting as documented by OpenAI
+LOW_DETAIL_TOKENS = 85
+TILE_TOKENS = 170
+
+
+def vision_tokens(width: int, height: int, detail: str = "high") -> int:
+    """Tokens the model charges for an image of this size."""
+    if detail == "low":
+        return LOW_DETAIL_TOKENS
+    # Fit within 2048x2048, then scale the shortest side down to 768 and count 512px tiles
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return LOW_DETAIL_TOKENS + TILE_TOKENS * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+class ImageStats:
+    """Running totals of what preprocessing saved, for /api/images/stats."""
+
+    def __init__(self):
+        self.images = 0
+        self.estimated = 0
+        self.downloads = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self.original_bytes = 0
+        self.sent_bytes = 0
+        self.original_tokens = 0
+        self.sent_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "mode": IMAGE_MODE,
+                "detail": DETAIL,
+                "max_side": MAX_SIDE,
+                "images": self.images,
+                # Images whose original token count assumes IMAGE_ASSUMED_SIZE
+                "estimated": self.estimated,
+                "downloads": self.downloads,
+                "cache_hits": self.cache_hits,
+                "failures": self.failures,
+                "original_bytes": self.original_bytes,
+                "sent_bytes": self.sent_bytes,
+                "bytes_saved": self.original_bytes - self.sent_bytes,
+                "original_tokens": self.original_tokens,
+                "sent_tokens": self.sent_tokens,
+                "tokens_saved": self.original_tokens - self.sent_tokens,
+            }
+
+
+_stats = ImageStats()
+_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="image-fetch")
+# Callables notified for every processed image, e.g. to record metrics
+_observers: List[Callable] = []
+
+
+def add_image_observer(observer: Callable) -> None:
+    """
+    Register observer(original_bytes, sent_bytes, original_tokens, sent_tokens, cached=)
+    to be called for every image sent to a model. cached is None for photos
+    passed by URL, whose bytes never go through the server.
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def _public_address(url: str) -> str:
+    """
+    The address to connect to for url. Raises ValueError unless url is
+    http(s) and its host only resolves to public addresses.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("Only http and https image URLs are fetched")
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                       proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as e:
+        raise ValueError(f"Could not resolve {parts.hostname}: {str(e)}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"{parts.hostname} resolves to a non-public address")
+    return addresses[0][4][0]
+
+
+def _download(url: str) -> bytes:
+    import certifi
+    import urllib3
+
+    for _ in range(MAX_REDIRECTS + 1):
+        address = _public_address(url)
+        parts = urlsplit(url)
+        # Connect to the checked address; the host name is only used for the Host header, SNI and the certificate
+        options = {"timeout": urllib3.Timeout(FETCH_TIMEOUT), "retries": False, "maxsize": 1}
+        if parts.scheme == "https":
+            pool = urllib3.HTTPSConnectionPool(
+                address, parts.port or 443, server_hostname=parts.hostname, assert_hostname=parts.hostname,
+                cert_reqs="CERT_REQUIRED", ca_certs=certifi.where(), **options)
+        else:
+            pool = urllib3.HTTPConnectionPool(address, parts.port or 80, **options)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        if ":" in parts.hostname:
+            host = f"[{parts.hostname}]" if parts.port is None else f"[{parts.hostname}]:{parts.port}"
+        with pool:
+            response = pool.urlopen("GET", path, headers={"Host": host}, redirect=False, preload_content=False)
+            try:
+                location = response.headers.get("Location")
+                if response.status in (301, 302, 303, 307, 308) and location:
+                    url = urljoin(url, location)
+                    continue
+                if response.status >= 400:
+                    raise ValueError(f"Image request failed with HTTP {response.status}")
+                data = response.read(MAX_DOWNLOAD_BYTES + 1, decode_content=True)
+            finally:
+                response.release_conn()
+        if len(data) > MAX_DOWNLOAD_BYTES:
+            raise ValueError(f"Image larger than {MAX_DOWNLOAD_BYTES} bytes")
+        return data
+    raise ValueError(f"More than {MAX_REDIRECTS} redirects")
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # Several workers may process the same image; readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _read(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def shrink(data: bytes) -> Tuple[bytes, Tuple[int, int], Tuple[int, int]]:
+    """Downscale and re-encode an image. Returns (jpeg bytes, original size, new size)."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        original_size = image.size
+        # Let the JPEG decoder scale down by 1/2 to 1/8 while decoding; much cheaper than resizing afterwards
+        image.draft("RGB", (MAX_SIDE, MAX_SIDE))
+        # Phone photos are often stored sideways with an EXIF rotation
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return output.getvalue(), original_size, image.size
+
+
+def _url_path(url: str) -> str:
+    # Holds the content hash of the bytes last downloaded from url
+    return os.path.join(CACHE_DIR, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+
+def content_hash(url: str) -> str:
+    """
+    The sha256 of the image at url, so re-uploads of the same photo can be
+    recognised. Known URLs are answered from the disk cache; others are
+    downloaded with the same checks as inline mode, which raise on failure.
+    """
+    cached = _read(_url_path(url))
+    if cached is not None:
+        return cached.decode()
+    data = _download(url)
+    _stats.record(downloads=1)
+    digest = hashlib.sha256(data).hexdigest()
+    _write_atomic(_url_path(url), digest.encode())
+    return digest
+
+
+def _thumbnail(url: str) -> Tuple[bytes, bool]:
+    """Return the cached JPEG for url, downloading and shrinking it on first use."""
+    url_path = _url_path(url)
+    settings = f"{MAX_SIDE}-{JPEG_QUALITY}"
+
+    content_hash = _read(url_path)
+    if content_hash is not None:
+        thumbnail = _read(os.path.join(CACHE_DIR, f"{content_hash.decode()}-{settings}.jpg"))
+        meta = _read(os.path.join(CACHE_DIR, f"{content_hash.decode()}.meta"))
+        if thumbnail is not None and meta is not None:
+            _stats.record(cache_hits=1)
+            _notify(thumbnail, meta, cached=True)
+            return thumbnail, True
+
+    data = _download(url)
+    _stats.record(downloads=1)
+    content_hash = hashlib.sha256(data).hexdigest()
+    thumbnail_path = os.path.join(CACHE_DIR, f"{content_hash}-{settings}.jpg")
+    meta_path = os.path.join(CACHE_DIR, f"{content_hash}.meta")
+
+    # The same photo uploaded under another URL is only shrunk once
+    thumbnail = _read(thumbnail_path)
+    meta = _read(meta_path)
+    if thumbnail is None or meta is None:
+        thumbnail, (width, height), _ = shrink(data)
+        meta = f"{len(data)} {width} {height}".encode()
+        _write_atomic(thumbnail_path, thumbnail)
+        _write_atomic(meta_path, meta)
+    _write_atomic(url_path, content_hash.encode())
+    _notify(thumbnail, meta, cached=False)
+    return thumbnail, False
+
+
+def _notify(thumbnail: bytes, meta: bytes, cached: bool) -> None:
+    original_bytes, width, height = (int(value) for value in meta.split())
+    original_tokens = vision_tokens(width, height)
+    sent_tokens = LOW_DETAIL_TOKENS if DETAIL == "low" else vision_tokens(MAX_SIDE, MAX_SIDE)
+    _stats.record(images=1, original_bytes=original_bytes, sent_bytes=len(thumbnail),
+                  original_tokens=original_tokens, sent_tokens=sent_tokens)
+    for observer in _observers:
+        try:
+            observer(original_bytes, len(thumbnail), original_tokens, sent_tokens, cached=cached)
+        except Exception as e:
+            print(f"Image observer failed: {str(e)}")
+
+
+def _notify_by_url(url: str) -> None:
+    """Record the tokens a photo sent by URL at DETAIL saves over the default high detail."""
+    meta = None
+    digest = _read(_url_path(url))
+    if digest is not None:
+        meta = _read(os.path.join(CACHE_DIR, f"{digest.decode()}.meta"))
+    if meta is not None:
+        _, width, height = (int(value) for value in meta.split())
+    else:
+        width, height = ASSUMED_SIZE
+    original_tokens = vision_tokens(width, height)
+    sent_tokens = vision_tokens(width, height, DETAIL)
+    _stats.record(images=1, estimated=0 if meta is not None else 1,
+                  original_tokens=original_tokens, sent_tokens=sent_tokens)
+    for observer in _observers:
+        try:
+            observer(0, 0, original_tokens, sent_tokens, cached=None)
+        except Exception as e:
+            print(f"Image observer failed: {str(e)}")
+
+
+def image_part(url: str) -> Dict:
+    """The chat message content part for one listing photo."""
+    if IMAGE_MODE == "low_detail":
+        _notify_by_url(url)
+        return {"type": "image_url", "image_url": {"url": url, "detail": DETAIL}}
+    if IMAGE_MODE != "inline" or url.startswith("data:"):
+        return {"type": "image_url", "image_url": {"url": url}}
+
+    try:
+        thumbnail, _ = _thumbnail(url)
+    except Exception as e:
+        # The model can still fetch the original itself
+        print(f"Could not preprocess image {url}: {str(e)}")
+        _stats.record(failures=1)
+        return {"type": "image_url", "image_url": {"url": url}}
+    data_url = "data:image/jpeg;base64," + base64.b64encode(thumbnail).decode("ascii")
+    return {"type": "image_url", "image_url": {"url": data_url, "detail": DETAIL}}
+
+
+def image_parts(image_urls: List[str]) -> List[Dict]:
+    """image_part for every URL, fetching uncached photos concurrently."""
+    image_urls = image_urls or []
+    if IMAGE_MODE != "inline" or len(image_urls) < 2:
+        return [image_part(url) for url in image_urls]
+    return list(_executor.map(image_part, image_urls))
+
+
+def image_stats() -> Dict:
+    return _stats.snapshot()
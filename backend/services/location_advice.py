@@ -1,12 +1,94 @@
-import openai
+import asyncio
 import json
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, List
+from .openai_client import get_client, get_async_client
+from .cache import make_cache
+from . import geohash
+from .streaming import Event, stream_json
 
 api_key = os.getenv("OPEN_AI_API_KEY")
 
+# Endpoints are snapped to geohash cells of this precision (6 is roughly 1.2km x 0.6km)
+CELL_PRECISION = int(os.getenv("LOCATION_CACHE_PRECISION", 6))
+# Previously suggested places within this distance of the midpoint can be reused
+POI_RADIUS_KM = float(os.getenv("LOCATION_POI_RADIUS_KM", 1.5))
+POI_MIN_RESULTS = int(os.getenv("LOCATION_POI_MIN_RESULTS", 3))
+
+location_cache = make_cache("location", default_ttl=24 * 60 * 60)
+
+
+class PoiIndex:
+    """Places returned by the model, bucketed by geohash so nearby lookups stay cheap."""
+
+    def __init__(self, radius_km: float, max_cells: int = 10000):
+        self.radius_km = radius_km
+        # Cells must be at least as wide as the search radius for the 3x3 neighbourhood to cover it
+        self.precision = geohash.precision_for_radius(radius_km)
+        self.max_cells = max_cells
+        self.hits = 0
+        self.misses = 0
+        self._cells = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, poi: Dict) -> None:
+        try:
+            lat = float(poi["SuitableLocationGPSLat"])
+            lon = float(poi["SuitableLocationGPSLong"])
+            name = poi["SuitableLocationName"]
+        except (KeyError, TypeError, ValueError):
+            return
+        cell = geohash.encode(lat, lon, self.precision)
+        with self._lock:
+            self._cells.setdefault(cell, {})[name] = (lat, lon, poi)
+            self._cells.move_to_end(cell)
+            while len(self._cells) > self.max_cells:
+                self._cells.popitem(last=False)
+
+    def nearby(self, lat: float, lon: float) -> List[Dict]:
+        """Known places within radius_km of (lat, lon), closest first."""
+        found = []
+        with self._lock:
+            for cell in geohash.neighbors(geohash.encode(lat, lon, self.precision)):
+                for poi_lat, poi_lon, poi in self._cells.get(cell, {}).values():
+                    distance = geohash.haversine_km(lat, lon, poi_lat, poi_lon)
+                    if distance <= self.radius_km:
+                        found.append((distance, poi))
+        found.sort(key=lambda item: item[0])
+        return [poi for _, poi in found]
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "cells": len(self._cells),
+                "precision": self.precision,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+poi_index = PoiIndex(POI_RADIUS_KM)
+
+
+def location_cache_key(lat1, lon1, lat2, lon2) -> str:
+    """Order-independent key for a buyer/seller pair of geohash cells."""
+    cells = sorted([
+        geohash.encode(lat1, lon1, CELL_PRECISION),
+        geohash.encode(lat2, lon2, CELL_PRECISION),
+    ])
+    return ":".join(cells)
+
 def decimal_to_dms(decimal):
     degrees = int(abs(decimal))
     minutes_full = (abs(decimal) - degrees) * 60
@@ -24,7 +106,7 @@ def format_coordinate(lat, lon):
 
     return  f"{lat_deg}°{lat_min}′{lat_sec:.0f}″ {lat_dir}", f"{lon_deg}°{lon_min}′{lon_sec:.0f}″ {lon_dir}"
 
-def generate_location(lat1, lon1, lat2, lon2):
+def location_messages(lat1, lon1, lat2, lon2) -> List[Dict]:
     prompt = (
     f"Find suitable locations to meet up in public between {format_coordinate(lat1, lon1)} and {format_coordinate(lat2, lon2)}.\n"
     "Suitable locations include surveilled coffee shops, restaurants, etc.\n\n"
@@ -42,24 +124,109 @@ def generate_location(lat1, lon1, lat2, lon2):
     "I want EXCLUSIVELY a JSON response with exact location data. Do not include any additional text."
     )
 
-    client = openai.OpenAI(api_key=api_key)
+    return [
+        {"role": "system", "content": "You are an exact location finder for safe and suitable meet-ups between buyers and sellers. You exclusively respond in JSON as per the prescribed format."},
+        {"role": "user", "content": prompt}
+    ]
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are an exact location finder for safe and suitable meet-ups between buyers and sellers. You exclusively respond in JSON as per the prescribed format."},
-            {"role": "user", "content": prompt}
-        ]
-    )
+LOCATION_FIELDS = ("SuitableLocationName", "SuitableLocationGPSLat", "SuitableLocationGPSLong", "SuitableLocationGoogleMapsLink")
 
-    output = response.choices[0].message.content.strip()
+def parse_locations(response) -> Dict:
+    return parse_location_output(response.choices[0].message.content)
+
+def parse_location_output(output: str) -> Dict:
+    output = output.strip()
     output = output.replace('```json', '').replace('```', '').strip()
     
     try:
-        json_output = json.loads(output)
-        print(json.dumps(json_output, indent=4))
+        return json.loads(output)
     except json.JSONDecodeError as je:
         print(f"JSON parsing error. Raw response: {output}")
         raise je
 
-    return json.dumps(json_output, indent=4)
\ No newline at end of file
+def validate_locations(json_output: Dict) -> None:
+    """Raise ValueError unless json_output is a list of places in the prescribed format."""
+    places = json_output.get("data") if isinstance(json_output, dict) else None
+    if not isinstance(places, list):
+        raise ValueError("Expected a 'data' list of locations")
+    for place in places:
+        if not isinstance(place, dict) or any(field not in place for field in LOCATION_FIELDS):
+            raise ValueError(f"Each location must have {', '.join(LOCATION_FIELDS)}")
+
+def suggest_locations(lat1, lon1, lat2, lon2) -> Dict:
+    client = get_client(api_key)
+    response = client.chat.completions.create(model="gpt-4o", messages=location_messages(lat1, lon1, lat2, lon2))
+    return parse_locations(response)
+
+async def suggest_locations_async(lat1, lon1, lat2, lon2) -> Dict:
+    client = get_async_client(api_key)
+    response = await client.chat.completions.create(model="gpt-4o", messages=location_messages(lat1, lon1, lat2, lon2))
+    return parse_locations(response)
+
+def _nearby_places(lat1, lon1, lat2, lon2):
+    """Places already suggested around the midpoint, or None when a model call is needed."""
+    mid_lat, mid_lon = (lat1 + lat2) / 2, (lon1 + lon2) / 2
+    nearby = poi_index.nearby(mid_lat, mid_lon)
+    if len(nearby) >= POI_MIN_RESULTS:
+        poi_index.record(hit=True)
+        return {"data": nearby[:max(POI_MIN_RESULTS, 5)]}
+    poi_index.record(hit=False)
+    return None
+
+def _index_places(json_output: Dict) -> None:
+    for poi in json_output.get("data", []):
+        poi_index.add(poi)
+
+def generate_location(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = float(lat1), float(lon1), float(lat2), float(lon2)
+    key = location_cache_key(lat1, lon1, lat2, lon2)
+
+    json_output = location_cache.get(key)
+    if json_output is None:
+        # Places already suggested around the midpoint can answer without a model call
+        json_output = _nearby_places(lat1, lon1, lat2, lon2)
+        if json_output is None:
+            json_output = suggest_locations(lat1, lon1, lat2, lon2)
+            # Malformed output raises ValueError here rather than being cached for the whole TTL
+            validate_locations(json_output)
+            _index_places(json_output)
+        location_cache.set(key, json_output)
+
+    print(json.dumps(json_output, indent=4))
+    return json.dumps(json_output, indent=4)
+
+async def generate_location_async(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = float(lat1), float(lon1), float(lat2), float(lon2)
+    key = location_cache_key(lat1, lon1, lat2, lon2)
+
+    json_output = await asyncio.to_thread(location_cache.get, key)
+    if json_output is None:
+        json_output = _nearby_places(lat1, lon1, lat2, lon2)
+        if json_output is None:
+            json_output = await suggest_locations_async(lat1, lon1, lat2, lon2)
+            validate_locations(json_output)
+            _index_places(json_output)
+        await asyncio.to_thread(location_cache.set, key, json_output)
+
+    print(json.dumps(json_output, indent=4))
+    return json.dumps(json_output, indent=4)
+
+def generate_location_stream(lat1, lon1, lat2, lon2) -> Iterator[Event]:
+    lat1, lon1, lat2, lon2 = float(lat1), float(lon1), float(lat2), float(lon2)
+    key = location_cache_key(lat1, lon1, lat2, lon2)
+
+    json_output = location_cache.get(key)
+    if json_output is None:
+        json_output = _nearby_places(lat1, lon1, lat2, lon2)
+        if json_output is not None:
+            location_cache.set(key, json_output)
+    if json_output is not None:
+        yield "result", json_output
+        return
+
+    request = {"model": "gpt-4o", "messages": location_messages(lat1, lon1, lat2, lon2)}
+    for event, data in stream_json(get_client(api_key), request, parse_location_output, validate_locations):
+        if event == "result":
+            _index_places(data)
+            location_cache.set(key, data)
+        yield event, data
@@ -1,14 +1,25 @@
-import openai
+import asyncio
+import contextlib
 import json
-from typing import List, Dict
+import hashlib
+from typing import Iterator, List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
-from dotenv import load_dotenv
+from .openai_client import get_client, get_async_client
+from .images import content_hash, image_parts
+from .cache import make_cache
+from .streaming import Event, stream_json
+from .valuation_model import Estimate, get_valuation_model
+from .single_flight import SingleFlight
 
-load_dotenv()
+# Repeat valuations of the same listing are served from here instead of the model
+valuation_cache = make_cache("valuation", default_ttl=6 * 60 * 60)
+# Concurrent valuations of the same listing share one model call
+valuation_flight = SingleFlight("valuation")
 
 class MarketAnalyzer:
     def __init__(self, api_key: str):
-        self.client = openai.OpenAI(api_key=api_key)
+        self.api_key = api_key
         self.system_prompt = """You are a market analysis assistant. Your goal is to calculate the fair market value (in EUR) of a product.
         Analyze the provided product details and/or images to determine current market value based on listings from Amazon, Facebook Marketplace,
         CEX, Ebay, Currys etc. Use at least 10 datapoints from the Republic of Ireland market.
@@ -31,6 +42,15 @@ class MarketAnalyzer:
             "goodDeal": <boolean>,
             "suggestion": "<20-word recommendation>"
         }"""
+        # Changing the prompt must invalidate cached valuations
+        self.prompt_version = hashlib.sha256(self.system_prompt.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def client(self):
+        return get_client(self.api_key)
+
+    def model_for(self, image_urls: List[str] = None) -> str:
+        return "gpt-4o-mini" if image_urls else "gpt-4"
 
     def prepare_messages(self, prompt: str, image_urls: List[str] = None) -> List[Dict]:
         messages = [
@@ -39,12 +59,7 @@ class MarketAnalyzer:
 
         if image_urls:
             content = [{"type": "text", "text": prompt}]
-            
-            for url in image_urls:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {"url": url}
-                })
+            content.extend(image_parts(image_urls))
             
             messages.append({
                 "role": "user",
@@ -55,41 +70,252 @@ class MarketAnalyzer:
 
         return messages
 
+    def completion_request(self, prompt: str, image_urls: List[str] = None) -> Dict:
+        return {
+            "model": self.model_for(image_urls),
+            "response_format": {"type": "json_object"},  # Force JSON response
+            "messages": self.prepare_messages(prompt, image_urls),
+            "max_tokens": 1000,
+            "temperature": 0.7,
+        }
+
+    def parse_response(self, response) -> Dict:
+        return self.parse_output(response.choices[0].message.content)
+
+    def parse_output(self, output: str) -> Dict:
+        output = output.strip()
+        output = output.replace('```json', '').replace('```', '').strip()
+        try:
+            return json.loads(output)
+        except json.JSONDecodeError as je:
+            print(f"JSON parsing error. Raw response: {output}")
+            raise je
+
+    def validate(self, result: Dict) -> None:
+        """Raise ValueError unless result has the fields the system prompt asks for."""
+        if not isinstance(result, dict):
+            raise ValueError("Expected a JSON object")
+        value = result.get("fairMarketValue")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("fairMarketValue must be a number")
+        if not isinstance(result.get("goodDeal"), bool):
+            raise ValueError("goodDeal must be a boolean")
+        if not isinstance(result.get("suggestion"), str):
+            raise ValueError("suggestion must be a string")
+
+    def error_result(self, e: Exception) -> Dict:
+        print(f"Error during analysis: {str(e)}")
+        return {
+            "error": str(e),
+            "fairMarketValue": None,
+            "goodDeal": None,
+            "suggestion": "Error analyzing market value"
+        }
+
     def analyze_market(self, prompt: str, image_urls: List[str] = None) -> Dict:
-        messages = self.prepare_messages(prompt, image_urls)
-        
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini" if image_urls else "gpt-4",  # Fixed model name
-                response_format={"type": "json_object"},  # Force JSON response
-                messages=messages,
-                max_tokens=1000,
-                temperature=0.7 
-            )
-            
-            output = response.choices[0].message.content.strip()
-            output = output.replace('```json', '').replace('```', '').strip()
-            try:
-                return json.loads(output)
-            except json.JSONDecodeError as je:
-                print(f"JSON parsing error. Raw response: {output}")
-                raise je
-                
+            response = self.client.chat.completions.create(**self.completion_request(prompt, image_urls))
+            return self.parse_response(response)
         except Exception as e:
-            print(f"Error during analysis: {str(e)}")
-            return {
-                "error": str(e),
-                "fairMarketValue": None,
-                "goodDeal": None,
-                "suggestion": "Error analyzing market value"
-            }
+            return self.error_result(e)
 
-def evaluate_price(desc, price, seller_name, image_urls):
+    async def analyze_market_async(self, prompt: str, image_urls: List[str] = None) -> Dict:
+        try:
+            client = get_async_client(self.api_key)
+            # Preparing the images may download them, which must not block the loop
+            request = await asyncio.to_thread(self.completion_request, prompt, image_urls)
+            response = await client.chat.completions.create(**request)
+            return self.parse_response(response)
+        except Exception as e:
+            return self.error_result(e)
+
+    def analyze_market_stream(self, prompt: str, image_urls: List[str] = None) -> Iterator[Event]:
+        """analyze_market as delta events followed by the validated result, see services/streaming.py."""
+        try:
+            request = self.completion_request(prompt, image_urls)
+        except Exception as e:
+            yield "error", self.error_result(e)
+            return
+        yield from stream_json(self.client, request, self.parse_output, self.validate)
+
+def _normalize_price(price) -> str:
+    try:
+        return f"{float(price):.2f}"
+    except (TypeError, ValueError):
+        return str(price).strip()
+
+def _image_fingerprint(url: str) -> str:
+    """
+    Identify an image by URL, or by the hash of its bytes when
+    VALUATION_CACHE_HASH_IMAGES is enabled so re-uploads of the same photo match.
+    """
+    if os.getenv("VALUATION_CACHE_HASH_IMAGES", "0") != "1":
+        return url
+    # Shares the guarded download and the per-URL hash cache of photo preprocessing
+    try:
+        return "sha256:" + content_hash(url)
+    except Exception as e:
+        print(f"Could not fetch image for cache key, falling back to URL: {str(e)}")
+        return url
+
+def valuation_cache_key(desc, price, seller_name, image_urls, model: str, prompt_version: str) -> str:
+    payload = {
+        "desc": " ".join(str(desc).lower().split()),
+        "price": _normalize_price(price),
+        "seller": (seller_name or "").strip().lower(),
+        "images": sorted(_image_fingerprint(url) for url in image_urls or []),
+        "model": model,
+        "prompt_version": prompt_version,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _should_cache(value: Dict) -> bool:
+    # Local estimates are cheap to recompute and improve as valuations are recorded
+    return "error" not in value and value.get("source") != "local"
+
+def _local_estimate(desc, price) -> Optional[Estimate]:
+    """The local valuation model's estimate, or None when it is disabled or unavailable."""
+    model = get_valuation_model()
+    if model is None:
+        return None
+    try:
+        return model.lookup(desc, price)
+    except Exception as e:
+        print(f"Local valuation failed: {str(e)}")
+        return None
+
+def _record_valuation(desc, price, result: Dict, estimate: Optional[Estimate]) -> None:
+    model = get_valuation_model()
+    if model is None:
+        return
+    try:
+        model.record(desc, price, result, estimate)
+    except Exception as e:
+        print(f"Recording valuation failed: {str(e)}")
+
+def _answers_locally(estimate: Optional[Estimate]) -> bool:
+    return estimate is not None and estimate.confident and not estimate.audit
+
+def _value_listing(analyzer: MarketAnalyzer, desc, price, prompt: str, image_urls) -> Dict:
+    """The local estimate when it is confident, otherwise the model's valuation, which is recorded."""
+    estimate = _local_estimate(desc, price)
+    if _answers_locally(estimate):
+        return estimate.result
+    result = analyzer.analyze_market(prompt, image_urls)
+    _record_valuation(desc, price, result, estimate)
+    return result
+
+async def _value_listing_async(analyzer: MarketAnalyzer, desc, price, prompt: str, image_urls) -> Dict:
+    estimate = await asyncio.to_thread(_local_estimate, desc, price)
+    if _answers_locally(estimate):
+        return estimate.result
+    result = await analyzer.analyze_market_async(prompt, image_urls)
+    await asyncio.to_thread(_record_valuation, desc, price, result, estimate)
+    return result
+
+def analyze_listing(desc, price, seller_name, image_urls) -> Dict:
     prompt = f'{desc} (Asking: EUR {price}) sold by {seller_name}'
     api_key = os.getenv("OPEN_AI_API_KEY")
     analyzer = MarketAnalyzer(api_key)
-    
-    result = analyzer.analyze_market(prompt, image_urls)
+
+    key = valuation_cache_key(desc, price, seller_name, image_urls,
+                              analyzer.model_for(image_urls), analyzer.prompt_version)
+    return valuation_cache.get_or_compute(
+        key,
+        lambda: valuation_flight.do(key, lambda: _value_listing(analyzer, desc, price, prompt, image_urls)),
+        should_cache=_should_cache,
+    )
+
+async def analyze_listing_async(desc, price, seller_name, image_urls) -> Dict:
+    prompt = f'{desc} (Asking: EUR {price}) sold by {seller_name}'
+    api_key = os.getenv("OPEN_AI_API_KEY")
+    analyzer = MarketAnalyzer(api_key)
+
+    # The key may need the image bytes, so it is built off the event loop
+    key = await asyncio.to_thread(valuation_cache_key, desc, price, seller_name, image_urls,
+                                  analyzer.model_for(image_urls), analyzer.prompt_version)
+    return await valuation_cache.get_or_compute_async(
+        key,
+        lambda: valuation_flight.do_async(
+            key, lambda: _value_listing_async(analyzer, desc, price, prompt, image_urls)),
+        should_cache=_should_cache,
+    )
+
+def evaluate_price(desc, price, seller_name, image_urls):
+    result = analyze_listing(desc, price, seller_name, image_urls)
+    print("Analysis Result:")
+    print(json.dumps(result, indent=4))
+    return json.dumps(result, indent=4)
+
+async def evaluate_price_async(desc, price, seller_name, image_urls):
+    result = await analyze_listing_async(desc, price, seller_name, image_urls)
     print("Analysis Result:")
     print(json.dumps(result, indent=4))
-    return json.dumps(result, indent=4)
\ No newline at end of file
+    return json.dumps(result, indent=4)
+
+def evaluate_price_stream(desc, price, seller_name, image_urls) -> Iterator[Event]:
+    prompt = f'{desc} (Asking: EUR {price}) sold by {seller_name}'
+    api_key = os.getenv("OPEN_AI_API_KEY")
+    analyzer = MarketAnalyzer(api_key)
+
+    key = valuation_cache_key(desc, price, seller_name, image_urls,
+                              analyzer.model_for(image_urls), analyzer.prompt_version)
+    cached = valuation_cache.get(key)
+    if cached is not None:
+        yield "result", cached
+        return
+    estimate = _local_estimate(desc, price)
+    if _answers_locally(estimate):
+        yield "result", estimate.result
+        return
+    for event, data in analyzer.analyze_market_stream(prompt, image_urls):
+        if event == "result":
+            valuation_cache.set(key, data)
+            _record_valuation(desc, price, data, estimate)
+        yield event, data
+
+def _evaluate_batch_item(listing, admit=None) -> Dict:
+    if not isinstance(listing, dict):
+        raise ValueError("Listing must be an object")
+    desc = listing.get("desc")
+    price = listing.get("price")
+    image_urls = listing.get("image_urls")
+    if desc is None or price is None or image_urls is None:
+        raise ValueError("Missing parameters")
+    with admit() if admit is not None else contextlib.nullcontext():
+        return analyze_listing(desc, price, listing.get("seller"), image_urls)
+
+def evaluate_prices(listings: List[Dict], concurrency: int, admit=None) -> Iterator[Dict]:
+    """
+    Value several listings concurrently, yielding one result per listing in
+    completion order. A failing listing yields an error entry instead of
+    aborting the rest of the batch. admit, when given, returns a context
+    manager entered around each valid listing's valuation; an exception it
+    raises becomes that listing's error, with its retry_after if it has one.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = {
+            executor.submit(_evaluate_batch_item, listing, admit): index
+            for index, listing in enumerate(listings)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            listing = listings[index]
+            item = {"index": index}
+            if isinstance(listing, dict) and "id" in listing:
+                item["id"] = listing["id"]
+            try:
+                result = future.result()
+            except Exception as e:
+                item["error"] = str(e)
+                if getattr(e, "retry_after", None) is not None:
+                    item["retry_after"] = e.retry_after
+            else:
+                if "error" in result:
+                    item["error"] = result["error"]
+                item["result"] = result
+            yield item
+    finally:
+        # Stop queued work if the client goes away mid-stream
+        executor.shutdown(wait=False, cancel_futures=True)
\ No newline at end of file
@@ -0,0 +1,260 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+# Connection pool tuning, per worker process
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 20))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 10))
+KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", 60))
+CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", 5))
+REQUEST_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 2))
+
+
+class PoolStats:
+    """Counts requests and freshly opened connections to derive the reuse rate."""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self._lock = threading.Lock()
+
+    def on_request(self, request) -> None:
+        with self._lock:
+            self.requests += 1
+        attempts = _attempts.get()
+        if attempts is not None:
+            attempts[0] += 1
+        # httpcore only emits connect events when the pool has to open a connection
+        request.extensions["trace"] = self._trace
+
+    async def on_request_async(self, request) -> None:
+        # httpx.AsyncClient hooks and httpcore async traces must be awaitable
+        self.on_request(request)
+        request.extensions["trace"] = self._trace_async
+
+    def _trace(self, event_name: str, info: Dict) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+
+    async def _trace_async(self, event_name: str, info: Dict) -> None:
+        self._trace(event_name, info)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            requests, new_connections = self.requests, self.new_connections
+        reused = max(0, requests - new_connections)
+        return {
+            "requests": requests,
+            "new_connections": new_connections,
+            "reused_connections": reused,
+            "reuse_rate": reused / requests if requests else 0.0,
+        }
+
+
+# HTTP attempts made by the completion call running in the current context
+_attempts = contextvars.ContextVar("openai_attempts", default=None)
+# Callables notified after every completion call, e.g. to record metrics
+_call_observers: List[Callable] = []
+
+
+def add_call_observer(observer: Callable) -> None:
+    """
+    Register observer(model, duration, response=, messages=, attempts=, error=)
+    to be called after every chat completion made through a pooled client.
+    """
+    if observer not in _call_observers:
+        _call_observers.append(observer)
+
+
+def _notify_observers(kwargs, duration, response, attempts, error) -> None:
+    for observer in _call_observers:
+        try:
+            observer(kwargs.get("model"), duration, response=response, messages=kwargs.get("messages"),
+                     attempts=max(attempts, 1), error=error)
+        except Exception as e:
+            print(f"OpenAI call observer failed: {str(e)}")
+
+
+class _ObservedStream:
+    """
+    Wraps a streamed completion so observers hear of the call when the last
+    chunk arrives, with the usage reported in it, rather than when the
+    response headers do.
+    """
+
+    def __init__(self, stream, kwargs, started, attempts):
+        self._stream = stream
+        self._kwargs = kwargs
+        self._started = started
+        self._attempts = attempts
+        self._last = None
+        self._done = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._last = chunk
+                yield chunk
+        except Exception as e:
+            self._finish(e)
+            raise
+        self._finish(None)
+
+    def _finish(self, error) -> None:
+        if not self._done:
+            self._done = True
+            _notify_observers(self._kwargs, time.perf_counter() - self._started, self._last, self._attempts, error)
+
+    def close(self) -> None:
+        self._stream.close()
+        self._finish(None)
+
+
+def _observed(create):
+    @functools.wraps(create)
+    def wrapper(*args, **kwargs):
+        attempts = [0]
+        token = _attempts.set(attempts)
+        started = time.perf_counter()
+        response = error = None
+        try:
+            response = create(*args, **kwargs)
+            if kwargs.get("stream"):
+                response = _ObservedStream(response, kwargs, started, attempts[0])
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _attempts.reset(token)
+            if not isinstance(response, _ObservedStream):
+                _notify_observers(kwargs, time.perf_counter() - started, response, attempts[0], error)
+    return wrapper
+
+
+def _observed_async(create):
+    @functools.wraps(create)
+    async def wrapper(*args, **kwargs):
+        attempts = [0]
+        token = _attempts.set(attempts)
+        started = time.perf_counter()
+        response = error = None
+        try:
+            response = await create(*args, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _attempts.reset(token)
+            _notify_observers(kwargs, time.perf_counter() - started, response, attempts[0], error)
+    return wrapper
+
+
+_clients = {}
+_async_clients = {}
+_stats = PoolStats()
+_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # Sockets inherited from the parent must not be shared with it, so each
+    # forked worker starts with an empty registry and fresh counters.
+    global _clients, _async_clients, _stats, _pid, _lock
+    _clients = {}
+    _async_clients = {}
+    _stats = PoolStats()
+    _pid = os.getpid()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _http_options(on_request) -> Dict:
+    import httpx
+
+    return {
+        "limits": httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+        "event_hooks": {"request": [on_request]},
+    }
+
+
+def _build_client(api_key: str):
+    # The SDKs are imported on first use; they dominate worker import time
+    import httpx
+    import openai
+
+    http_client = httpx.Client(**_http_options(_stats.on_request))
+    return openai.OpenAI(api_key=api_key, http_client=http_client, max_retries=MAX_RETRIES)
+
+
+def _build_async_client(api_key: str):
+    import httpx
+    import openai
+
+    http_client = httpx.AsyncClient(**_http_options(_stats.on_request_async))
+    return openai.AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=MAX_RETRIES)
+
+
+def get_client(api_key: str = None):
+    """Return the pooled OpenAI client for this process, creating it on first use."""
+    if os.getpid() != _pid:
+        _reset_after_fork()
+    api_key = api_key or os.getenv("OPEN_AI_API_KEY")
+    client = _clients.get(api_key)
+    if client is None:
+        with _lock:
+            client = _clients.get(api_key)
+            if client is None:
+                client = _build_client(api_key)
+                completions = client.chat.completions
+                completions.create = _observed(completions.create)
+                _clients[api_key] = client
+    return client
+
+
+def get_async_client(api_key: str = None):
+    """
+    Return the pooled AsyncOpenAI client for this process. Its connections are
+    bound to the loop that first uses them, so only await it on the loop from
+    services.event_loop.
+    """
+    if os.getpid() != _pid:
+        _reset_after_fork()
+    api_key = api_key or os.getenv("OPEN_AI_API_KEY")
+    client = _async_clients.get(api_key)
+    if client is None:
+        with _lock:
+            client = _async_clients.get(api_key)
+            if client is None:
+                client = _build_async_client(api_key)
+                completions = client.chat.completions
+                completions.create = _observed_async(completions.create)
+                _async_clients[api_key] = client
+    return client
+
+
+def pool_stats() -> Dict:
+    stats = _stats.snapshot()
+    stats.update({
+        "pid": _pid,
+        "clients": len(_clients),
+        "async_clients": len(_async_clients),
+        "max_connections": MAX_CONNECTIONS,
+        "max_keepalive_connections": MAX_KEEPALIVE_CONNECTIONS,
+        "keepalive_expiry": KEEPALIVE_EXPIRY,
+    })
+    return stats
@@ -0,0 +1,246 @@
+"""
+Single-flight coalescing of identical in-flight AI calls.
+
+When many buyers ask for the same valuation or condition check at once,
+the first call for a key (the leader) goes to the model. Callers that
+arrive while it is in flight wait for it and receive a copy of its result
+instead of starting their own call.
+
+Within a worker this covers threads, and coroutines on the worker's event
+loop. With SINGLE_FLIGHT_DIR set, the leader also holds an exclusive lock
+on a file for the key, so a call for the same key in another worker on the
+host waits for the lock and reads the leader's result from a file next to
+it. A lock is released when its holder exits, so a crashed leader only
+hands the call to the next waiter. Cross-worker coalescing needs fcntl and
+applies to the threaded path only.
+
+Leaders sweep the directory at most once per SINGLE_FLIGHT_RESULT_TTL,
+deleting result files that have expired and lock files older than that
+which nobody holds, so the directory does not grow with every distinct key.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Directory for the lock and result files shared by the workers; unset coalesces within each worker only
+SHARED_DIR = os.getenv("SINGLE_FLIGHT_DIR")
+# A result file older than this is never used, even if a waiter missed its flight
+RESULT_TTL = float(os.getenv("SINGLE_FLIGHT_RESULT_TTL", 30))
+
+# Callables notified for every coalesced call, e.g. to record metrics
+_observers: List[Callable] = []
+_flights: Dict[str, "SingleFlight"] = {}
+
+
+def add_flight_observer(observer: Callable) -> None:
+    """
+    Register observer(name, outcome) to be called for every call through a
+    single flight, with outcome "leader" for calls that ran, "collapsed" for
+    calls that shared an in-process flight and "shared" for calls that
+    used another worker's result.
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def _fcntl():
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    return fcntl
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, name: str, shared_dir: Optional[str] = SHARED_DIR, result_ttl: float = RESULT_TTL):
+        self.name = name
+        self.shared_dir = shared_dir if shared_dir and _fcntl() is not None else None
+        self.result_ttl = result_ttl
+        self.counts = {"leader": 0, "collapsed": 0, "shared": 0}
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        if self.shared_dir:
+            os.makedirs(self.shared_dir, exist_ok=True)
+        _flights[name] = self
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.counts[outcome] += 1
+        for observer in _observers:
+            try:
+                observer(self.name, outcome)
+            except Exception as e:
+                print(f"Single flight observer failed: {str(e)}")
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """fn() for the first caller of key; concurrent callers with the same key wait and get a copy of its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            self._count("collapsed")
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.value)
+
+        try:
+            value = self._run(key, fn)
+            call.value = copy.deepcopy(value)
+            return value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """do() for coroutines on one event loop; coalesces within the worker only."""
+        future = self._async_calls.get(key)
+        if future is not None:
+            self._count("collapsed")
+            # A waiter that is cancelled must not cancel the leader's call
+            return copy.deepcopy(await asyncio.shield(future))
+
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        self._count("leader")
+        try:
+            value = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(copy.deepcopy(value))
+            return value
+        finally:
+            del self._async_calls[key]
+
+    def _run(self, key: str, fn: Callable[[], Any]) -> Any:
+        if not self.shared_dir:
+            self._count("leader")
+            return fn()
+
+        fcntl = _fcntl()
+        path = os.path.join(self.shared_dir, f"{self.name}-{hashlib.sha256(key.encode('utf-8')).hexdigest()}")
+        waiting_since = time.time()
+        with open(path + ".lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is making this call; its result is written before the lock is released
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                shared = self._read_result(path + ".json", waiting_since)
+                if shared is not None:
+                    self._count("shared")
+                    return shared["value"]
+
+            self._count("leader")
+            value = fn()
+            self._write_result(path + ".json", value)
+        self._sweep()
+        return value
+
+    def _sweep(self) -> None:
+        """Delete this flight's files that are older than result_ttl, except locks that are held."""
+        now = time.time()
+        with self._lock:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + self.result_ttl
+        fcntl = _fcntl()
+        try:
+            names = os.listdir(self.shared_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith(f"{self.name}-"):
+                continue
+            path = os.path.join(self.shared_dir, name)
+            try:
+                if os.stat(path).st_mtime >= now - self.result_ttl:
+                    continue
+                if name.endswith(".lock"):
+                    with open(path, "a") as lock_file:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os.unlink(path)
+                else:
+                    os.unlink(path)
+            except OSError:
+                # Held by a call in flight, or already deleted by another worker
+                continue
+
+    def _read_result(self, path: str, written_after: float) -> Optional[Dict]:
+        try:
+            modified = os.stat(path).st_mtime
+            if modified < written_after or modified < time.time() - self.result_ttl:
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_result(self, path: str, value: Any) -> None:
+        descriptor, temporary = tempfile.mkstemp(dir=self.shared_dir, prefix=f"{self.name}-", suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+                json.dump({"value": value}, f)
+            os.replace(temporary, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not share single flight result: {str(e)}")
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+    def reset(self) -> None:
+        """Forget calls in flight, whose leaders do not exist in a forked child."""
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            calls = sum(self.counts.values())
+            return {
+                "calls": calls,
+                "leaders": self.counts["leader"],
+                "collapsed": self.counts["collapsed"],
+                "shared": self.counts["shared"],
+                "in_flight": len(self._calls) + len(self._async_calls),
+                "collapse_rate": (self.counts["collapsed"] + self.counts["shared"]) / calls if calls else 0.0,
+                "cross_worker": self.shared_dir is not None,
+            }
+
+
+def _reset_after_fork() -> None:
+    for flight in _flights.values():
+        flight.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def single_flight_stats() -> Dict:
+    return {name: flight.stats() for name, flight in _flights.items()}
@@ -0,0 +1,47 @@
+"""
+Streamed model calls for the ?stream variants of the AI endpoints.
+
+A streamed call produces events as (name, data) pairs:
+- ("delta", {"text": ...}) for each piece of model output as it arrives;
+- ("result", {...}) once, with the complete output parsed and validated;
+- ("error", {"error": ...}) instead of the result when the call or the
+  validation fails.
+Answers served from a cache skip the model and produce only the result.
+"""
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+Event = Tuple[str, Dict]
+
+
+def stream_completion(client, request: Dict) -> Iterator[str]:
+    """Content deltas of a chat completion, as the model produces them."""
+    stream = client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+    try:
+        for chunk in stream:
+            # The last chunk only carries the usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        # Closing the stream early, e.g. when the client goes away, stops the generation
+        stream.close()
+
+
+def stream_json(client, request: Dict, parse: Callable[[str], Dict],
+                validate: Optional[Callable[[Dict], None]] = None) -> Iterator[Event]:
+    """
+    Forward the deltas of a completion that answers in JSON, then parse the
+    whole output and finish with its result or an error event.
+    """
+    parts = []
+    try:
+        for text in stream_completion(client, request):
+            parts.append(text)
+            yield "delta", {"text": text}
+        result = parse("".join(parts))
+        if validate is not None:
+            validate(result)
+    except Exception as e:
+        print(f"Error during streamed analysis: {str(e)}")
+        yield "error", {"error": str(e)}
+        return
+    yield "result", result
@@ -0,0 +1,322 @@
+"""
+Local valuation model that answers common price checks without a model call.
+
+Every valuation the OpenAI model makes is recorded in a SQLite store shared
+by the workers on the host: the normalized description, asking price, fair
+market value, good-deal verdict and time. Each worker keeps a nearest-
+neighbour index over the recorded descriptions, as TF-IDF weighted token
+vectors in an inverted index, and refreshes it from the store as other
+workers add to it.
+
+A new listing is valued from the observations of its most similar
+descriptions. The estimate is returned instead of calling the model only
+when it is confident: enough recent observations, near-identical
+descriptions and values that agree with each other. Photos and the seller
+are not part of the estimate, so a listing whose description differs from
+the catalogue (a cracked screen, an unusual bundle) falls through to the
+model.
+
+Each model answer is compared with the estimate the index would have given,
+and a small share of confident estimates are sent to the model anyway, so
+stats() reports how often the index answers and how far off it is.
+"""
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+ENABLED = os.getenv("VALUATION_MODEL_ENABLED", "1") == "1"
+STORE_PATH = os.getenv("VALUATION_MODEL_PATH", os.path.join("cache", "valuations.sqlite3"))
+# Observations older than this are ignored, as market prices drift
+MAX_AGE_DAYS = float(os.getenv("VALUATION_MODEL_MAX_AGE_DAYS", 30))
+# Thresholds an estimate must meet to be returned without a model call
+MIN_CONFIDENCE = float(os.getenv("VALUATION_MODEL_MIN_CONFIDENCE", 0.85))
+MIN_OBSERVATIONS = int(os.getenv("VALUATION_MODEL_MIN_OBSERVATIONS", 3))
+MIN_SIMILARITY = float(os.getenv("VALUATION_MODEL_MIN_SIMILARITY", 0.8))
+# Share of confident estimates still sent to the model to measure their error
+AUDIT_RATE = float(os.getenv("VALUATION_MODEL_AUDIT_RATE", 0.05))
+# Seconds between reads of valuations recorded by other workers
+REFRESH_SECONDS = float(os.getenv("VALUATION_MODEL_REFRESH_SECONDS", 5))
+NEIGHBOURS = 5
+# Most recent observations kept per description
+MAX_OBSERVATIONS = 20
+# Terms in more than this share of descriptions, such as "used", do not select neighbours
+# once there are more than MIN_COMMON_TERM descriptions
+MAX_TERM_SHARE = 0.5
+MIN_COMMON_TERM = 10
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+# Callables notified of every lookup and every measured estimate, e.g. to record metrics
+_observers: List[Callable] = []
+
+
+def add_estimate_observer(observer: Callable) -> None:
+    """
+    Register observer(outcome, error=None) to be called for every lookup,
+    with outcome "hit", "low_confidence", "no_match" or "audit", and with
+    outcome "measured" and the relative error of an estimate once the model
+    has valued the same listing.
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def _notify(outcome: str, error: float = None) -> None:
+    for observer in _observers:
+        try:
+            observer(outcome, error=error)
+        except Exception as e:
+            print(f"Valuation model observer failed: {str(e)}")
+
+
+def normalize_description(desc) -> str:
+    return " ".join(_TOKEN.findall(str(desc).lower()))
+
+
+class Estimate:
+    """What the index knows about a listing; result is None when it has no similar descriptions."""
+
+    def __init__(self, result: Optional[Dict] = None, confidence: float = 0.0, observations: int = 0):
+        self.result = result
+        self.confidence = confidence
+        self.observations = observations
+        self.confident = result is not None and confidence >= MIN_CONFIDENCE and observations >= MIN_OBSERVATIONS
+        # A confident estimate picked to be checked against the model
+        self.audit = self.confident and random.random() < AUDIT_RATE
+
+
+def _suggestion(value: float, price: float, observations: int) -> str:
+    difference = (price - value) / value * 100 if value else 0.0
+    direction = "above" if difference > 0 else "below"
+    return (f"{observations} similar listings were valued around EUR {value:.0f}; "
+            f"this asking price is {abs(difference):.0f}% {direction} that.")
+
+
+class ValuationModel:
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        # description -> {"terms": {term: count}, "observations": [(price, value, good_deal, created_at)]}
+        self._descriptions = {}
+        # term -> set of descriptions containing it
+        self._postings = {}
+        self._last_id = 0
+        self._refreshed_at = 0.0
+        self.lookups = 0
+        self.hits = 0
+        self.audits = 0
+        # "confident" or "low_confidence" -> [count, summed relative error, good-deal agreements]
+        self._errors = {}
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS valuations ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, description TEXT NOT NULL, price REAL NOT NULL, "
+                "fair_market_value REAL NOT NULL, good_deal INTEGER, estimate REAL, confidence REAL, "
+                "created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS valuations_created ON valuations (created_at)")
+            conn.execute("DELETE FROM valuations WHERE created_at < ?", (self._cutoff(),))
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def _cutoff(self) -> float:
+        return time.time() - MAX_AGE_DAYS * 24 * 60 * 60
+
+    def _add(self, description: str, price: float, value: float, good_deal, created_at: float) -> None:
+        entry = self._descriptions.get(description)
+        if entry is None:
+            terms = {}
+            for term in description.split():
+                terms[term] = terms.get(term, 0) + 1
+            entry = self._descriptions[description] = {"terms": terms, "observations": []}
+            for term in terms:
+                self._postings.setdefault(term, set()).add(description)
+        entry["observations"].append((price, value, good_deal, created_at))
+        del entry["observations"][:-MAX_OBSERVATIONS]
+
+    def refresh(self, force: bool = False) -> None:
+        """Load the valuations recorded since the last refresh, by any worker."""
+        if not force and time.monotonic() - self._refreshed_at < REFRESH_SECONDS:
+            return
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, description, price, fair_market_value, good_deal, created_at FROM valuations "
+                "WHERE id > ? AND created_at >= ? ORDER BY id", (self._last_id, self._cutoff()),
+            ).fetchall()
+        with self._lock:
+            for row_id, description, price, value, good_deal, created_at in rows:
+                if row_id > self._last_id:
+                    self._last_id = row_id
+                    self._add(description, price, value, None if good_deal is None else bool(good_deal), created_at)
+            self._refreshed_at = time.monotonic()
+
+    def _idf(self, term: str) -> float:
+        return math.log((1 + len(self._descriptions)) / (1 + len(self._postings.get(term, ())))) + 1
+
+    def _vector(self, terms: Dict[str, int]) -> Dict[str, float]:
+        vector = {term: count * self._idf(term) for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def _neighbours(self, description: str) -> List:
+        """(similarity, observations) of the most similar recorded descriptions."""
+        terms = {}
+        for term in description.split():
+            terms[term] = terms.get(term, 0) + 1
+        query = self._vector(terms)
+        common = max(MAX_TERM_SHARE * len(self._descriptions), MIN_COMMON_TERM)
+        candidates = set()
+        for term in terms:
+            postings = self._postings.get(term, ())
+            if len(postings) <= common:
+                candidates.update(postings)
+        cutoff = self._cutoff()
+        scored = []
+        for candidate in candidates:
+            entry = self._descriptions[candidate]
+            vector = self._vector(entry["terms"])
+            similarity = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+            observations = [observation for observation in entry["observations"] if observation[3] >= cutoff]
+            if similarity >= MIN_SIMILARITY and observations:
+                scored.append((similarity, observations))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return scored[:NEIGHBOURS]
+
+    def estimate(self, desc, price) -> Estimate:
+        """Value a listing from its nearest recorded neighbours, see Estimate."""
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            return Estimate()
+        self.refresh()
+        with self._lock:
+            neighbours = self._neighbours(normalize_description(desc))
+        if not neighbours:
+            return Estimate()
+
+        weighted = [(similarity, value) for similarity, observations in neighbours for _, value, _, _ in observations]
+        total = sum(similarity for similarity, _ in weighted)
+        value = sum(similarity * value for similarity, value in weighted) / total
+        variance = sum(similarity * (observed - value) ** 2 for similarity, observed in weighted) / total
+        # Relative spread of the observed values; zero when they all agree
+        spread = math.sqrt(variance) / value if value > 0 else 1.0
+        confidence = max(0.0, total / len(weighted) * (1 - spread))
+        result = {
+            "fairMarketValue": round(value, 2),
+            "goodDeal": price <= value,
+            "suggestion": _suggestion(value, price, len(weighted)),
+            "source": "local",
+            "confidence": round(confidence, 3),
+        }
+        return Estimate(result, confidence, len(weighted))
+
+    def lookup(self, desc, price) -> Estimate:
+        """estimate() for a request, counting whether it can be answered without the model."""
+        estimate = self.estimate(desc, price)
+        if estimate.audit:
+            outcome = "audit"
+        elif estimate.confident:
+            outcome = "hit"
+        else:
+            outcome = "low_confidence" if estimate.result is not None else "no_match"
+        with self._lock:
+            self.lookups += 1
+            self.hits += outcome == "hit"
+            self.audits += outcome == "audit"
+        _notify(outcome)
+        return estimate
+
+    def record(self, desc, price, result: Dict, estimate: Optional[Estimate] = None) -> None:
+        """Store a model valuation and measure the estimate made for the same listing against it."""
+        if not isinstance(result, dict) or "error" in result:
+            return
+        value = result.get("fairMarketValue")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            return
+        good_deal = result.get("goodDeal")
+        good_deal = int(good_deal) if isinstance(good_deal, bool) else None
+
+        guess = estimate.result if estimate is not None else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO valuations (description, price, fair_market_value, good_deal, estimate, confidence, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (normalize_description(desc), price, float(value), good_deal,
+                 guess["fairMarketValue"] if guess else None, estimate.confidence if guess else None, time.time()),
+            )
+        self.refresh(force=True)
+
+        if guess and value:
+            error = abs(guess["fairMarketValue"] - value) / abs(value)
+            with self._lock:
+                errors = self._errors.setdefault("confident" if estimate.confident else "low_confidence", [0, 0.0, 0])
+                errors[0] += 1
+                errors[1] += error
+                errors[2] += good_deal is not None and bool(good_deal) == guess["goodDeal"]
+            _notify("measured", error=error)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            errors = {
+                kind: {
+                    "measured": count,
+                    "mean_relative_error": summed / count,
+                    "good_deal_agreement": agreed / count,
+                } for kind, (count, summed, agreed) in self._errors.items()
+            }
+            return {
+                "descriptions": len(self._descriptions),
+                "observations": sum(len(entry["observations"]) for entry in self._descriptions.values()),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "audits": self.audits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "errors": errors,
+            }
+
+
+_model = None
+_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # A lock held by another thread at fork time would never be released in the child
+    global _lock
+    _lock = threading.Lock()
+    if _model is not None:
+        _model._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_valuation_model() -> Optional[ValuationModel]:
+    """This process's valuation model, or None when VALUATION_MODEL_ENABLED is off."""
+    global _model
+    if not ENABLED:
+        return None
+    if _model is None:
+        with _lock:
+            if _model is None:
+                _model = ValuationModel()
+    return _model
+
+
+def valuation_model_stats() -> Dict:
+    model = get_valuation_model()
+    return model.stats() if model is not None else {"enabled": False}
@@ -1,6 +1,74 @@
+import base64
+import json
+import math
 import random
 import string
+from flask import Response, current_app, stream_with_context
 
 def generate_otp_token(length=15):
     """Generate a random OTP token consisting of uppercase letters and digits."""
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
\ No newline at end of file
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+
+def encode_page_token(values):
+    """Turn the order-by values of the last document into an opaque cursor."""
+    raw = json.dumps(values).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_page_token(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise ValueError("Malformed page token")
+    if not isinstance(values, list):
+        raise ValueError("Malformed page token")
+    return values
+
+
+def parse_price(value):
+    """A price as a finite number, or None when it is not one. Numeric strings are converted."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        if value.is_integer():
+            value = int(value)
+    if not isinstance(value, (int, float)) or not math.isfinite(value):
+        return None
+    return value
+
+
+def ndjson_response(records):
+    """
+    Stream an iterable of dicts as newline-delimited JSON. Records are
+    serialized one at a time so memory stays flat regardless of collection size.
+    """
+    def generate():
+        for record in records:
+            yield current_app.json.dumps(record) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def sse_event(event, data, event_id=None):
+    """Format one Server-Sent Event with a JSON data field."""
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {current_app.json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def sse_response(chunks):
+    """
+    Stream already formatted events as text/event-stream, telling proxies
+    not to cache or buffer them so each event reaches the client at once.
+    """
+    return Response(stream_with_context(chunks), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
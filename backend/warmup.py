@@ -0,0 +1,36 @@
+import time
+
+
+def warm_up():
+    """
+    Create this process's clients, product search index, document cache and
+    valuation model ahead of its first request. Meant to run in each worker
+    after gunicorn forks it (see gunicorn.conf.py), so nothing created here
+    is ever shared with the master process.
+    Returns the seconds spent on each step.
+    """
+    from db_config import get_db
+    from doc_cache import get_document_cache
+    from passwords import get_hasher
+    from routes.stripe import get_stripe
+    from search_index import get_search
+    from services import get_client
+    from services.valuation_model import get_valuation_model
+    import metrics
+
+    timings = {}
+    for name, init in (("firestore", get_db), ("openai", get_client),
+                       ("stripe", get_stripe), ("password_hasher", get_hasher),
+                       ("product_search", get_search), ("document_cache", get_document_cache),
+                       ("valuation_model", get_valuation_model)):
+        started = time.perf_counter()
+        try:
+            init()
+        except Exception as e:
+            # A failed warm-up only costs the first request the same work
+            print(f"Warm-up of {name} failed: {str(e)}")
+        timings[name] = time.perf_counter() - started
+        metrics.record_startup(f"warmup_{name}", timings[name])
+
+    print("Worker warm-up: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in timings.items()))
+    return timings
@@ -6,4 +6,11 @@ else
     echo "No Firebase config provided!"
 fi
 
+# Start every deployment with an empty multiprocess metrics directory,
+# before gunicorn imports the app and opens files in it
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 exec "$@"
@@ -38,7 +38,7 @@ class ApiService {
   }
 
   public getChatMessages(chatId: string) {
-    return this.request(`/chats/${chatId}`, 'GET');
+    return this.request(`/chats/${chatId}?recent=5`, 'GET');
   }
 
   public sendMessage(chatId: string, message: { sender: string; text: string }) {